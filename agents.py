@@ -1,48 +1,203 @@
 import openai
 import os
-from typing import Any, Dict
+import time
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List
+from response_cache import ResponseCache
+import request_scheduler
+import tracing
 
 
 class GeneralAgent(object):
     """A general agent that interacts with OpenAI's models."""
 
     role_: str = ""
+    # The response cache used by the agents created without one, e.g. set once at the start of a run.
+    default_response_cache_: ResponseCache | None = None
+    # The max number of recent calls whose timings are kept, the older ones only count in the totals.
+    max_call_metrics_: int = 1000
 
-    def __init__(self, model: str = 'gpt-3.5-turbo'):
+    def __init__(self,
+                 model: str = 'gpt-3.5-turbo',
+                 response_cache: ResponseCache | None = None,
+                 priority: int = request_scheduler.INTERACTIVE):
         """
         Initializes a GeneralAgent.
 
         Args:
             model (str, optional): The name of the model to use (default is 'gpt-3.5-turbo').
+            response_cache (ResponseCache | None, optional): The cache of responses to the identical requests.
+                If None, then GeneralAgent.default_response_cache_ is used.
+            priority (int, optional): The priority class of the requests in the request scheduler,
+                INTERACTIVE for the answers a user waits for, BULK e.g. for the summaries of many sources.
         """
         self.system_message_: Dict[str, Any] = {"role": "system", "content": self.role_}
         self.model_: str = model
+        self.response_cache_: ResponseCache | None = response_cache
+        self.priority_: int = priority
+        # The timings of the recent calls of this agent, in the order the calls ended, and the totals of all the calls.
+        # Guarded by metrics_lock_, as the calls of an agent may run in several threads.
+        self.call_metrics_: Deque[Dict[str, Any]] = deque(maxlen=self.max_call_metrics_)
+        self.num_calls_: int = 0
+        self.num_cached_calls_: int = 0
+        self.total_time_to_first_token_: float = 0.0
+        self.total_time_: float = 0.0
+        self.metrics_lock_ = threading.Lock()
 
-    def query(self, user_query: str, temperature: int = 0) -> str:
+    def query(self,
+              user_query: str,
+              temperature: int = 0,
+              on_token: Callable[[str], None] | None = None) -> str:
         """
         Sends a user query to OpenAI and returns the response.
 
         Args:
             user_query (str): The user's query.
+            on_token (Callable[[str], None] | None): If given, the response is streamed
+                and this callback is called on each token as it arrives.
 
         Returns:
             str: The response generated by OpenAI.
         """
-        print("####################### Sending request to OpenAI:  #########################")  # With automatic line wrapping
-        print(user_query)
-        print("####################### Response from OpenAI: #########################")
+        if on_token is not None:
+            tokens = []
+            for token in self.stream_query(user_query, temperature):
+                on_token(token)
+                tokens.append(token)
+            return ''.join(tokens)
+
+        tracing.log("####################### Sending request to OpenAI:  #########################")  # With automatic line wrapping
+        tracing.log(user_query)
+        tracing.log("####################### Response from OpenAI: #########################")
         messages = [self.system_message_,
                     {"role": "user", "content": user_query}]
-        response = openai.ChatCompletion.create(
-            model=self.model_, 
-            messages=messages,
-            temperature=temperature,
-        )
-        answer = response.choices[0]["message"]["content"]
-        print(answer)
-        print("####################### Ended & Returned the response. #########################")
+        start_time = time.perf_counter()
+        response_cache = self.response_cache_ or GeneralAgent.default_response_cache_
+        answer = response_cache.lookup(self.model_, messages, temperature) if response_cache else None
+        cached = answer is not None
+        if cached:
+            tracing.log("(Served from the response cache.)")
+        else:
+            with tracing.span('chat', model=self.model_, streamed=False):
+                response = request_scheduler.call(
+                    self.model_,
+                    self._prompt_tokens(messages),
+                    lambda: openai.ChatCompletion.create(
+                        model=self.model_,
+                        messages=messages,
+                        temperature=temperature,
+                    ),
+                    self.priority_,
+                )
+            answer = response.choices[0]["message"]["content"]
+            self._record_usage(messages, answer, response.get("usage"))
+            if response_cache:
+                response_cache.store(self.model_, messages, temperature, answer)
+        total_time = time.perf_counter() - start_time
+        # Without streaming, the first token arrives together with the whole response.
+        self._record_call(streamed=False, cached=cached, time_to_first_token=total_time, total_time=total_time)
+        tracing.log(answer)
+        tracing.log("####################### Ended & Returned the response. #########################")
         return answer
 
+    def stream_query(self, user_query: str, temperature: int = 0) -> Iterator[str]:
+        """
+        Sends a user query to OpenAI and yields the tokens of the response as they arrive.
+
+        Args:
+            user_query (str): The user's query.
+
+        Yields:
+            str: The next token of the response, or the whole response when it is served from the cache.
+        """
+        tracing.log("####################### Streaming request to OpenAI:  #########################")
+        tracing.log(user_query)
+        messages = [self.system_message_,
+                    {"role": "user", "content": user_query}]
+        start_time = time.perf_counter()
+        response_cache = self.response_cache_ or GeneralAgent.default_response_cache_
+        answer = response_cache.lookup(self.model_, messages, temperature) if response_cache else None
+        if answer is not None:
+            total_time = time.perf_counter() - start_time
+            self._record_call(streamed=True, cached=True, time_to_first_token=total_time, total_time=total_time)
+            yield answer
+            return
+
+        time_to_first_token = None
+        tokens = []
+        with tracing.span('chat', model=self.model_, streamed=True):
+            # Only opening the stream is retried, the tokens already yielded cannot be taken back.
+            stream = request_scheduler.call(
+                self.model_,
+                self._prompt_tokens(messages),
+                lambda: openai.ChatCompletion.create(
+                    model=self.model_,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                ),
+                self.priority_,
+            )
+            for chunk in stream:
+                token = chunk.choices[0]["delta"].get("content")
+                if not token:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start_time
+                tokens.append(token)
+                yield token
+        total_time = time.perf_counter() - start_time
+        # The streamed responses carry no usage, so the tokens are counted locally.
+        self._record_usage(messages, ''.join(tokens))
+        if response_cache:
+            response_cache.store(self.model_, messages, temperature, ''.join(tokens))
+        self._record_call(streamed=True, cached=False,
+                          time_to_first_token=time_to_first_token if time_to_first_token is not None else total_time,
+                          total_time=total_time)
+        tracing.log("####################### Ended the streamed response. #########################")
+
+    def _prompt_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(tracing.count_tokens(self.model_, message["content"]) for message in messages)
+
+    def _record_usage(self, messages: List[Dict[str, Any]], answer: str, usage: Dict[str, int] | None = None):
+        if usage:
+            prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+        else:
+            prompt_tokens = self._prompt_tokens(messages)
+            completion_tokens = tracing.count_tokens(self.model_, answer)
+        # The request was scheduled with its prompt tokens, the completion ones count against the quota too.
+        request_scheduler.settle(self.model_, completion_tokens)
+        tracing.record_usage(self.model_, prompt_tokens, completion_tokens)
+
+    def _record_call(self, streamed: bool, cached: bool, time_to_first_token: float, total_time: float):
+        tracing.log(f"Time to first token: {time_to_first_token:.3f}s, total generation time: {total_time:.3f}s.")
+        with self.metrics_lock_:
+            self.call_metrics_.append({
+                'model': self.model_,
+                'streamed': streamed,
+                'cached': cached,
+                'time_to_first_token': time_to_first_token,
+                'total_time': total_time,
+            })
+            self.num_calls_ += 1
+            self.num_cached_calls_ += cached
+            self.total_time_to_first_token_ += time_to_first_token
+            self.total_time_ += total_time
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: The number of calls of this agent and of the ones served from the cache,
+                and the mean time to first token and total time of a call.
+        """
+        with self.metrics_lock_:
+            return {
+                'calls': self.num_calls_,
+                'cached_calls': self.num_cached_calls_,
+                'mean_time_to_first_token': self.total_time_to_first_token_ / self.num_calls_ if self.num_calls_ else 0.0,
+                'mean_total_time': self.total_time_ / self.num_calls_ if self.num_calls_ else 0.0,
+            }
 
 class Researcher(GeneralAgent):
     """A specialized agent act as professional researcher."""
@@ -0,0 +1,525 @@
+import io
+import os
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import functools
+import contextlib
+import tracemalloc
+import numpy as np
+import openai
+from collections import deque
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Tuple
+from openai.openai_object import OpenAIObject
+from langchain.docstore.document import Document
+from agents import GeneralAgent
+from paper_class import Paper
+from paper_collection import PaperCollection
+from paper_collection_chat import PaperCollectionChat
+from paper_source import PaperSource
+from main import ResearchTopicComposer
+from document_source import DocumentSource
+from embedding_backends import HashingEmbeddings
+from embedding_cache import QueryEmbeddingCache
+
+# The words of the synthetic texts by research field, so that the queries of a field retrieve its papers.
+VOCABULARY: Dict[str, List[str]] = {
+    'medical': ['medical', 'imaging', 'patient', 'diagnosis', 'clinical', 'tumor', 'segmentation', 'mri',
+                'alzheimer', 'biomarker', 'cohort', 'disease', 'longitudinal', 'scan', 'radiology'],
+    'language': ['language', 'model', 'transformer', 'token', 'prompt', 'alignment', 'instruction', 'corpus',
+                 'pretraining', 'decoder', 'attention', 'reasoning', 'benchmark', 'dialogue', 'retrieval'],
+    'generative': ['generative', 'diffusion', 'adversarial', 'latent', 'sampling', 'variational', 'prior',
+                   'posterior', 'bayesian', 'inference', 'likelihood', 'stylegan', 'synthesis', 'noise', 'score'],
+    'molecular': ['molecular', 'protein', 'dynamics', 'binding', 'ligand', 'folding', 'simulation', 'energy',
+                  'conformation', 'docking', 'chemistry', 'force', 'trajectory', 'residue', 'enzyme'],
+}
+COMMON_WORDS: List[str] = ['the', 'of', 'and', 'we', 'propose', 'method', 'results', 'show', 'that', 'our',
+                           'approach', 'data', 'performance', 'analysis', 'experiments', 'with', 'on', 'for']
+
+
+def synthetic_text(rng: random.Random, field: str, num_words: int) -> str:
+    """
+    Returns:
+        str: Random sentences mixing the words of a field with common words.
+    """
+    words = [rng.choice(VOCABULARY[field]) if rng.random() < 0.6 else rng.choice(COMMON_WORDS)
+             for _ in range(num_words)]
+    sentences = [' '.join(words[start:start + 12]).capitalize() + '.' for start in range(0, len(words), 12)]
+    return ' '.join(sentences)
+
+
+def write_synthetic_pdf(path: str, lines: List[str], lines_per_page: int = 60):
+    """
+    Write the lines of text into a minimal PDF, one Helvetica text object per page.
+
+    Args:
+        path (str): The filepath of the PDF.
+        lines (List[str]): The lines of text, in ASCII.
+        lines_per_page (int): The number of lines per page.
+    """
+    def escape(line: str) -> str:
+        return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    pages = [lines[start:start + lines_per_page] for start in range(0, len(lines), lines_per_page)] or [[]]
+    # The catalog, the page tree and the font come first, then a page and its content stream for each page.
+    page_ids = [4 + 2 * index for index in range(len(pages))]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        f'<< /Type /Pages /Kids [{" ".join(f"{id} 0 R" for id in page_ids)}] /Count {len(pages)} >>'.encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for page_id, page in zip(page_ids, pages):
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> '
+                       f'/Contents {page_id + 1} 0 R >>'.encode())
+        stream = 'BT /F1 9 Tf 11 TL 40 760 Td ' + ' '.join(f'({escape(line)}) Tj T*' for line in page) + ' ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream'.encode())
+    content = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for id, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f'{id} 0 obj\n'.encode() + body + b'\nendobj\n'
+    xref = len(content)
+    content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    content += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def synthetic_papers(folder: str, base_url: str, num_papers: int, num_pages: int, seed: int = 0) -> Dict[str, Paper]:
+    """
+    Write the full texts of synthetic papers as PDFs, each with a body and a reference section.
+
+    Args:
+        folder (str): The folder the PDFs are written to, served at base_url.
+        base_url (str): The URL of the folder.
+        num_papers (int): The number of papers.
+        num_pages (int): The number of pages of the body of each paper.
+        seed (int): The seed of the texts, the papers of different seeds share no chunks.
+
+    Returns:
+        Dict[str, Paper]: The papers keyed by title, with their abstracts and the URLs of their PDFs.
+    """
+    rng = random.Random(seed)
+    fields = list(VOCABULARY)
+    papers = {}
+    os.makedirs(folder, exist_ok=True)
+    for index in range(num_papers):
+        field = fields[index % len(fields)]
+        title = f'Synthetic {field} study {seed}-{index}'
+        file_name = f'synthetic-{seed}-{index:05d}'
+        body = synthetic_text(rng, field, 60 * 14 * num_pages)
+        lines = [title, ''] + [body[start:start + 100] for start in range(0, len(body), 100)]
+        lines += ['', 'References']
+        lines += [f'[{ref + 1}] A. Author. {synthetic_text(rng, field, 6)} arXiv preprint arXiv:2{ref % 10}01.{index:05d}, 2021.'
+                  for ref in range(30)]
+        write_synthetic_pdf(os.path.join(folder, file_name), lines)
+        papers[title] = Paper(
+            title=title,
+            summary=synthetic_text(rng, field, 150),
+            url=f'{base_url}/{file_name}',
+            authors=['Synthetic Author', f'Coauthor {index}'],
+            publish_date=datetime(2021 + index % 3, 1, 1),
+        )
+    return papers
+
+
+@contextlib.contextmanager
+def serve_folder(folder: str):
+    """
+    Serve the files of a folder over HTTP on a free local port while in the context.
+
+    Yields:
+        str: The URL of the folder.
+    """
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=folder))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FakeOpenAI(object):
+    """An in-process stand-in of the OpenAI chat and embedding endpoints, patched over the openai module.
+
+    Every request waits for the configured latency, and the requests beyond the rate limit of an endpoint
+    either wait for a free slot, like a client retrying, or raise RateLimitError, like the API.
+    The embeddings are the hashed n-grams of the inputs, so that similar texts get similar vectors.
+    """
+
+    def __init__(self,
+                 latency: float = 0.05,
+                 token_latency: float = 0.001,
+                 requests_per_minute: int | None = None,
+                 rate_limit_error: bool = False,
+                 embedding_dimension: int = 1536,
+                 completion_words: int = 40,
+                 num_topics: int = 4):
+        """
+        Args:
+            latency (float): The seconds before the first token of a response.
+            token_latency (float): The seconds between two tokens of a chat response.
+            requests_per_minute (int | None): The max requests per minute of each endpoint. If None, then unlimited.
+            rate_limit_error (bool): Whether to raise RateLimitError beyond the rate limit instead of waiting.
+            embedding_dimension (int): The dimension of the embeddings.
+            completion_words (int): The number of words of a free-text chat response.
+            num_topics (int): The number of research topics the topic parser returns.
+        """
+        self.latency_: float = latency
+        self.token_latency_: float = token_latency
+        self.requests_per_minute_: int | None = requests_per_minute
+        self.rate_limit_error_: bool = rate_limit_error
+        self.embedding_: HashingEmbeddings = HashingEmbeddings(dimension=embedding_dimension)
+        self.completion_words_: int = completion_words
+        self.num_topics_: int = num_topics
+        self.counts_: Dict[str, int] = {
+            'chat_requests': 0,
+            'streamed_requests': 0,
+            'embedding_requests': 0,
+            'embedded_inputs': 0,
+            'throttled_requests': 0,
+            'rate_limited_requests': 0,
+        }
+        # The start times of the requests of the last minute, by endpoint.
+        self.windows_: Dict[str, deque] = {'chat': deque(), 'embedding': deque()}
+        self.lock_ = threading.Lock()
+        self.originals_: Dict[Any, Any] = {}
+
+    def __enter__(self) -> 'FakeOpenAI':
+        for endpoint, create in ((openai.ChatCompletion, self._chat), (openai.Embedding, self._embed)):
+            self.originals_[endpoint] = endpoint.__dict__['create']
+            endpoint.create = create
+        return self
+
+    def __exit__(self, *exc_info):
+        for endpoint, create in self.originals_.items():
+            endpoint.create = create
+        self.originals_.clear()
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock_:
+            return dict(self.counts_)
+
+    def _throttle(self, endpoint: str):
+        if self.requests_per_minute_ is None:
+            return
+        while True:
+            with self.lock_:
+                now = time.monotonic()
+                window = self.windows_[endpoint]
+                while window and now - window[0] >= 60:
+                    window.popleft()
+                if len(window) < self.requests_per_minute_:
+                    window.append(now)
+                    return
+                if self.rate_limit_error_:
+                    self.counts_['rate_limited_requests'] += 1
+                    raise openai.error.RateLimitError(f'Rate limit of {self.requests_per_minute_} requests per minute reached.')
+                self.counts_['throttled_requests'] += 1
+                wait = window[0] + 60 - now
+            time.sleep(wait)
+
+    def _answer(self, messages: List[Dict[str, str]]) -> str:
+        system_prompt, user_prompt = messages[0]['content'], messages[-1]['content']
+        rng = random.Random(user_prompt)
+        if 'python dict' in system_prompt:
+            return repr({f'Synthetic topic {index + 1}': synthetic_text(rng, field, 12)
+                         for index, field in zip(range(self.num_topics_), list(VOCABULARY) * self.num_topics_)})
+        match = re.search(r'JSON list of (\d+) strings', user_prompt)
+        if match:
+            return json.dumps([synthetic_text(rng, 'language', self.completion_words_) for _ in range(int(match.group(1)))])
+        return synthetic_text(rng, 'language', self.completion_words_)
+
+    def _chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0, stream: bool = False, **kwargs):
+        self._throttle('chat')
+        with self.lock_:
+            self.counts_['chat_requests'] += 1
+            self.counts_['streamed_requests'] += stream
+        answer = self._answer(messages)
+        words = answer.split(' ')
+        time.sleep(self.latency_)
+        if not stream:
+            time.sleep(self.token_latency_ * len(words))
+            return OpenAIObject.construct_from({
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+            })
+
+        def chunks():
+            for index, word in enumerate(words):
+                time.sleep(self.token_latency_)
+                yield OpenAIObject.construct_from({
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': word if index == 0 else f' {word}'}}],
+                })
+        return chunks()
+
+    def _embed(self, input: str | List, model: str = 'text-embedding-ada-002', **kwargs):
+        self._throttle('embedding')
+        # The inputs are texts, or the token ids of the texts when sent by OpenAIEmbeddings.
+        inputs = [input] if isinstance(input, str) or (input and isinstance(input[0], int)) else list(input)
+        texts = [text if isinstance(text, str) else ' '.join(map(str, text)) for text in inputs]
+        with self.lock_:
+            self.counts_['embedding_requests'] += 1
+            self.counts_['embedded_inputs'] += len(texts)
+        vectors = self.embedding_.embed_batch(texts)
+        time.sleep(self.latency_)
+        return OpenAIObject.construct_from({
+            'model': model,
+            'data': [{'index': index, 'embedding': vector.tolist()} for index, vector in enumerate(vectors)],
+        })
+
+
+def synthetic_abstracts(num_papers: int, seed: int) -> List[Paper]:
+    rng = random.Random(seed)
+    fields = list(VOCABULARY)
+    return [Paper(
+        title=f'Synthetic abstract {seed}-{index}',
+        summary=synthetic_text(rng, fields[index % len(fields)], 200),
+        url=f'https://arxiv.org/pdf/{seed}.{index:05d}',
+        authors=['Synthetic Author'],
+        publish_date=datetime(2021, 1, 1),
+    ) for index in range(num_papers)]
+
+
+def bench_add_paper(fake: FakeOpenAI, num_papers: int, embedding: str, seed: int, **kwargs) -> Tuple[List[float], dict]:
+    paper_collection = PaperCollection(openai_api_key=openai.api_key, chunk_size=1000, embedding=embedding)
+    latencies = []
+    for paper in synthetic_abstracts(num_papers, seed):
+        start_time = time.perf_counter()
+        paper_collection.add_paper(paper)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies, {'documents': paper_collection.document_source_.num_docs_}
+
+
+def bench_add_papers(fake: FakeOpenAI, num_papers: int, batch_size: int, embedding: str, seed: int,
+                     **kwargs) -> Tuple[List[float], dict]:
+    paper_collection = PaperCollection(openai_api_key=openai.api_key, chunk_size=1000, embedding=embedding)
+    papers = synthetic_abstracts(num_papers, seed)
+    start_time = time.perf_counter()
+    paper_collection.add_papers(papers, batch_size=batch_size)
+    return [time.perf_counter() - start_time], {'documents': paper_collection.document_source_.num_docs_}
+
+
+def bench_ingest(fake: FakeOpenAI, num_papers: int, num_pages: int, num_workers: int, embedding: str, seed: int,
+                 **kwargs) -> Tuple[List[float], dict]:
+    with serve_folder(os.path.abspath('fixtures')) as base_url:
+        papers = synthetic_papers('fixtures', base_url, num_papers, num_pages, seed)
+        start_time = time.perf_counter()
+        paper_source = PaperSource(papers, openai.api_key, num_workers=num_workers, embedding=embedding)
+        latency = time.perf_counter() - start_time
+    return [latency], {'chunks': paper_source.document_source_.num_docs_}
+
+
+def bench_retrieve(fake: FakeOpenAI, num_chunks: int, num_queries: int, vector_store: str, embedding: str, seed: int,
+                   **kwargs) -> Tuple[List[float], dict]:
+    rng = random.Random(seed)
+    fields = list(VOCABULARY)
+    document_source = DocumentSource(openai.api_key, embedding_cache_path=None, embedding=embedding,
+                                      vector_store=vector_store)
+    documents = [Document(page_content=synthetic_text(rng, fields[index % len(fields)], 80),
+                          metadata={'source': f'Synthetic paper {index // 20}'}) for index in range(num_chunks)]
+    start_time = time.perf_counter()
+    # Chroma bounds the size of one insertion.
+    for start in range(0, len(documents), 5000):
+        document_source.add_documents(documents[start:start + 5000])
+    add_seconds = time.perf_counter() - start_time
+    queries = [synthetic_text(rng, fields[index % len(fields)], 8) for index in range(num_queries)]
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        document_source.retrieve(query, num_retrieval=10, score_threshold=float('-inf'))
+        latencies.append(time.perf_counter() - start_time)
+    # The same queries again at once, with the query embeddings cleared.
+    DocumentSource.query_embedding_cache_ = QueryEmbeddingCache()
+    start_time = time.perf_counter()
+    document_source.retrieve_many(queries, num_retrieval=10, score_threshold=float('-inf'))
+    return latencies, {'add_seconds': add_seconds, 'retrieve_many_seconds': time.perf_counter() - start_time}
+
+
+def bench_source_and_summarize(fake: FakeOpenAI, num_papers: int, num_pages: int, num_topics: int, max_concurrency: int,
+                               embedding: str, seed: int, **kwargs) -> Tuple[List[float], dict]:
+    rng = random.Random(seed)
+    fields = list(VOCABULARY)
+    with serve_folder(os.path.abspath('fixtures')) as base_url:
+        paper_collection = PaperCollection(openai_api_key=openai.api_key, embedding=embedding)
+        paper_collection.add_paper_dict(synthetic_papers('fixtures', base_url, num_papers, num_pages, seed))
+        chat = PaperCollectionChat(paper_collection, openai.api_key, max_concurrency=max_concurrency,
+                                   summarize_batch_size=4, embedding=embedding)
+        latencies = []
+        for index in range(num_topics):
+            start_time = time.perf_counter()
+            chat.source_and_summarize(query=synthetic_text(rng, fields[index % len(fields)], 8),
+                                      num_retrieval=2, score_threshold=float('-inf'))
+            latencies.append(time.perf_counter() - start_time)
+    return latencies, {'chunks': chat.full_text_source_.document_source_.num_docs_}
+
+
+def bench_compose(fake: FakeOpenAI, num_papers: int, num_pages: int, num_topics: int, max_concurrency: int,
+                  num_workers: int, embedding: str, seed: int, **kwargs) -> Tuple[List[float], dict]:
+    fake.num_topics_ = num_topics
+    with serve_folder(os.path.abspath('fixtures')) as base_url:
+        papers = synthetic_papers('fixtures', base_url, num_papers, num_pages, seed)
+        start_time = time.perf_counter()
+        composer = ResearchTopicComposer(
+            research_interests=synthetic_text(random.Random(seed), 'generative', 30),
+            papers=papers,
+            num_retrieval=2,
+            score_threshold=float('-inf'),
+            max_concurrency=max_concurrency,
+            topic_concurrency=max_concurrency,
+            num_workers=num_workers,
+            embedding=embedding,
+        )
+        composer.get_research_topics()
+        composer.close()
+    return [time.perf_counter() - start_time], {}
+
+
+# The scenarios and the values of their scaled parameters at each scale.
+SCENARIOS: Dict[str, Tuple[Callable, Dict[str, Dict[str, List[Any]]]]] = {
+    'add_paper': (bench_add_paper, {
+        'small': {'num_papers': [8, 32]},
+        'medium': {'num_papers': [32, 128]},
+        'large': {'num_papers': [128, 512]},
+    }),
+    'add_papers': (bench_add_papers, {
+        'small': {'num_papers': [32], 'batch_size': [1000]},
+        'medium': {'num_papers': [128, 512], 'batch_size': [1000]},
+        'large': {'num_papers': [512, 2048], 'batch_size': [1000]},
+    }),
+    'ingest': (bench_ingest, {
+        'small': {'num_papers': [2, 8], 'num_pages': [2]},
+        'medium': {'num_papers': [8, 32], 'num_pages': [4]},
+        'large': {'num_papers': [32, 128], 'num_pages': [8]},
+    }),
+    'retrieve': (bench_retrieve, {
+        'small': {'num_chunks': [1000], 'num_queries': [20], 'vector_store': ['chroma', 'numpy']},
+        'medium': {'num_chunks': [5000, 20000], 'num_queries': [50], 'vector_store': ['chroma', 'numpy']},
+        'large': {'num_chunks': [20000, 100000], 'num_queries': [100], 'vector_store': ['chroma', 'numpy']},
+    }),
+    'source_and_summarize': (bench_source_and_summarize, {
+        'small': {'num_papers': [4], 'num_pages': [2], 'num_topics': [2]},
+        'medium': {'num_papers': [16], 'num_pages': [4], 'num_topics': [4, 8]},
+        'large': {'num_papers': [64], 'num_pages': [8], 'num_topics': [8, 16]},
+    }),
+    'compose': (bench_compose, {
+        'small': {'num_papers': [4], 'num_pages': [2], 'num_topics': [2]},
+        'medium': {'num_papers': [16], 'num_pages': [4], 'num_topics': [4, 8]},
+        'large': {'num_papers': [64], 'num_pages': [8], 'num_topics': [8, 16]},
+    }),
+}
+
+
+def parameter_grid(parameters: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    grid = [{}]
+    for name, values in parameters.items():
+        grid = [{**point, name: value} for point in grid for value in values]
+    return grid
+
+
+def run_scenario(name: str,
+                 function: Callable,
+                 fake: FakeOpenAI,
+                 parameters: Dict[str, Any],
+                 trace_memory: bool = True,
+                 verbose: bool = False) -> dict:
+    """
+    Run a scenario in a fresh working directory, so that no cache nor collection of another run is reused.
+
+    Returns:
+        dict: The parameters and the metrics of the run.
+    """
+    working_directory = os.getcwd()
+    folder = tempfile.mkdtemp(prefix=f'benchmark-{name}-')
+    counts_before = fake.counts()
+    DocumentSource.query_embedding_cache_ = QueryEmbeddingCache()
+    GeneralAgent.default_response_cache_ = None
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        os.chdir(folder)
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            latencies, extra = function(fake, **parameters)
+    finally:
+        total_seconds = time.perf_counter() - start_time
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        os.chdir(working_directory)
+        shutil.rmtree(folder, ignore_errors=True)
+    counts_after = fake.counts()
+    return {
+        'scenario': name,
+        'parameters': {key: value for key, value in parameters.items() if key != 'seed'},
+        'operations': len(latencies),
+        'total_seconds': total_seconds,
+        'throughput': len(latencies) / sum(latencies) if sum(latencies) else 0.0,
+        'p50_latency': float(np.percentile(latencies, 50)),
+        'p99_latency': float(np.percentile(latencies, 99)),
+        'peak_memory_bytes': peak_memory,
+        'requests': {key: counts_after[key] - counts_before[key] for key in counts_after},
+        **extra,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline offline, against a local stand-in of the OpenAI API.')
+    parser.add_argument('--scale', choices=['small', 'medium', 'large'], default='small')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.05, help='The seconds before the first token of a response.')
+    parser.add_argument('--token-latency', type=float, default=0.001, help='The seconds between two tokens of a chat response.')
+    parser.add_argument('--rpm', type=int, default=None, help='The max requests per minute of each endpoint.')
+    parser.add_argument('--rate-limit-error', action='store_true', help='Raise RateLimitError beyond the rate limit instead of waiting.')
+    parser.add_argument('--embedding', choices=['openai', 'hashing'], default='openai',
+                        help="'openai' embeds through the stand-in, 'hashing' locally.")
+    parser.add_argument('--max-concurrency', type=int, default=4)
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace the peak memory, which slows the runs down.')
+    parser.add_argument('--output', default='benchmark.json', help='The JSON file the results are written to.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the pipeline.')
+    args = parser.parse_args()
+
+    openai.api_key = 'sk-benchmark'
+    results = []
+    with FakeOpenAI(latency=args.latency,
+                    token_latency=args.token_latency,
+                    requests_per_minute=args.rpm,
+                    rate_limit_error=args.rate_limit_error) as fake:
+        for name in args.scenarios:
+            function, scales = SCENARIOS[name]
+            for seed, parameters in enumerate(parameter_grid(scales[args.scale])):
+                parameters = {**parameters, 'embedding': args.embedding, 'max_concurrency': args.max_concurrency,
+                              'num_workers': args.num_workers, 'seed': seed}
+                result = run_scenario(name, function, fake, parameters, not args.no_memory, args.verbose)
+                results.append(result)
+                scaled = ', '.join(f'{key}={value}' for key, value in parameters.items() if key in scales[args.scale])
+                memory = f"{result['peak_memory_bytes'] / 2 ** 20:.1f}MiB" if result['peak_memory_bytes'] is not None else '-'
+                print(f"{name:<22} {scaled:<50} {result['throughput']:>9.2f} op/s  p50 {result['p50_latency']:.3f}s  "
+                      f"p99 {result['p99_latency']:.3f}s  peak {memory}  requests {result['requests']}")
+
+    report = {
+        'scale': args.scale,
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'verbose')},
+        'created': datetime.now().isoformat(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {len(results)} results to {args.output}.')
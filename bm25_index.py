@@ -0,0 +1,93 @@
+import re
+import math
+import heapq
+import threading
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+from langchain.docstore.document import Document
+
+
+class BM25Index(object):
+    """An inverted index of documents built incrementally and scored with Okapi BM25."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            k1 (float): The saturation of the term frequencies.
+            b (float): The normalization of the scores by the document lengths, between 0 and 1.
+        """
+        self.k1_: float = k1
+        self.b_: float = b
+        # The frequency of each term in each document containing it, by document index.
+        self.postings_: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.lengths_: List[int] = []
+        self.total_length_: int = 0
+        self.documents_: List[Document] = []
+        self.ids_: Set[str] = set()
+        self.lock_ = threading.Lock()
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return re.findall(r'\w+', text.lower())
+
+    def __len__(self) -> int:
+        return len(self.documents_)
+
+    def add(self, documents: List[Document], ids: List[str] | None = None):
+        """
+        Index the documents.
+
+        Args:
+            documents (List[Document]): The documents to index.
+            ids (List[str] | None): The ids of the documents, the ones already indexed are skipped.
+                If None, then every document is indexed.
+        """
+        with self.lock_:
+            for document, id in zip(documents, ids or [None] * len(documents)):
+                if id is not None:
+                    if id in self.ids_:
+                        continue
+                    self.ids_.add(id)
+                index = len(self.documents_)
+                terms = self.tokenize(document.page_content)
+                for term in terms:
+                    postings = self.postings_[term]
+                    postings[index] = postings.get(index, 0) + 1
+                self.lengths_.append(len(terms))
+                self.total_length_ += len(terms)
+                self.documents_.append(document)
+
+    def search(self, query: str, k: int, sources: Set[str] | None = None) -> List[Tuple[Document, float]]:
+        """
+        Search the documents sharing terms with the query.
+
+        Args:
+            query (str): The query string.
+            k (int): The max number of documents to return.
+            sources (Set[str] | None): Only search the documents of these sources. If None, then search all the documents.
+
+        Returns:
+            List[Tuple[Document, float]]: Copies of the k best matching documents and their BM25 scores, best first.
+        """
+        with self.lock_:
+            num_docs = len(self.documents_)
+            if num_docs == 0 or k <= 0:
+                return []
+            avg_length = self.total_length_ / num_docs
+            scores: Dict[int, float] = defaultdict(float)
+            for term in set(self.tokenize(query)):
+                postings = self.postings_.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for index, frequency in postings.items():
+                    norm = self.k1_ * (1 - self.b_ + self.b_ * self.lengths_[index] / avg_length)
+                    scores[index] += idf * frequency * (self.k1_ + 1) / (frequency + norm)
+            if sources is not None:
+                scores = {index: score for index, score in scores.items()
+                          if self.documents_[index].metadata.get('source') in sources}
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            # Return copies, the callers annotate and concatenate the retrieved documents.
+            return [(Document(page_content=self.documents_[index].page_content,
+                              metadata=dict(self.documents_[index].metadata)), score)
+                    for index, score in best]
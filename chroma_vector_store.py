@@ -0,0 +1,48 @@
+from typing import Callable, List, Tuple
+from langchain.docstore.document import Document
+from langchain.vectorstores import Chroma
+
+
+class ChromaVectorStore(Chroma):
+    """A Chroma store with the count and the batched search of NumpyVectorStore.
+
+    The langchain Chroma store searches one query at a time and does not count its documents,
+    both read the underlying chromadb collection here, the only place relying on the internals of Chroma.
+    """
+
+    def count(self) -> int:
+        return self._collection.count()
+
+    def similarity_search_by_vectors_with_score(self,
+                                                vectors: List[List[float]],
+                                                k: int = 4,
+                                                filter: dict | None = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Search the documents closest to several query vectors with one query of the collection.
+
+        Args:
+            vectors (List[List[float]]): The query vectors.
+            k (int): The max number of documents to return per query.
+            filter (dict | None): A Chroma metadata filter of the searched documents.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: For each query, the k closest documents and their distances, closest first.
+        """
+        if k <= 0 or len(vectors) == 0:
+            return [[] for _ in vectors]
+        response = self._collection.query(
+            query_embeddings=vectors,
+            n_results=k,
+            where=filter,
+            include=['documents', 'metadatas', 'distances'],
+        )
+        return [[(Document(page_content=content, metadata=metadata or {}), distance)
+                 for content, metadata, distance in zip(contents, metadatas, distances)]
+                for contents, metadatas, distances in zip(response['documents'], response['metadatas'], response['distances'])]
+
+    def relevance_score_fn(self) -> Callable[[float], float]:
+        """
+        Returns:
+            Callable[[float], float]: The function mapping a distance of the collection to a relevance score between 0 and 1.
+        """
+        return self._select_relevance_score_fn()
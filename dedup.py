@@ -0,0 +1,133 @@
+import re
+import zlib
+import hashlib
+import threading
+import numpy as np
+from typing import Dict, List, Set, Tuple
+
+# The Mersenne prime modulus of the MinHash permutations, (a * x + b) fits in 64 bits for 32-bit x and 31-bit a and b.
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class MinHashDeduplicator(object):
+    """Detects the texts duplicating an earlier one, exactly after whitespace and case normalization,
+    or nearly by the Jaccard similarity of their word shingles estimated with MinHash.
+
+    The candidates of a near duplicate are found by LSH: the signature is cut into bands,
+    and two texts are compared when any of their bands is identical.
+    """
+
+    def __init__(self,
+                 threshold: float = 0.9,
+                 num_permutations: int = 128,
+                 num_bands: int = 32,
+                 shingle_size: int = 3,
+                 seed: int = 0):
+        """
+        Args:
+            threshold (float): The min estimated Jaccard similarity of a near duplicate, between 0 and 1.
+            num_permutations (int): The length of the MinHash signatures, a longer one estimates more precisely.
+            num_bands (int): The number of LSH bands, dividing num_permutations. More bands find more candidates.
+            shingle_size (int): The number of words of each shingle.
+            seed (int): The seed of the permutations.
+
+        Raises:
+            ValueError: when the threshold is not in (0, 1] or the bands do not divide the permutations.
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Invalid threshold: {threshold}")
+        if num_bands <= 0 or num_permutations % num_bands:
+            raise ValueError(f"{num_bands} bands do not divide {num_permutations} permutations.")
+        self.threshold_: float = threshold
+        self.num_bands_: int = num_bands
+        self.rows_: int = num_permutations // num_bands
+        self.shingle_size_: int = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a_: np.ndarray = rng.integers(1, 1 << 31, num_permutations, dtype=np.uint64)
+        self.b_: np.ndarray = rng.integers(0, 1 << 31, num_permutations, dtype=np.uint64)
+        # The index of the text of each exact digest, and the indices of the texts of each LSH bucket.
+        self.digests_: Dict[str, int] = {}
+        self.buckets_: Dict[Tuple[int, bytes], List[int]] = {}
+        self.keys_: List[str] = []
+        # The indices of the texts removed.
+        self.removed_: Set[int] = set()
+        self.signatures_: List[np.ndarray] = []
+        self.num_checked_: int = 0
+        self.num_exact_: int = 0
+        self.num_near_: int = 0
+        self.lock_ = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(text.lower().split())
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: The MinHash signature of the word shingles of the normalized text.
+        """
+        words = re.findall(r'\w+', text.lower())
+        shingles = {' '.join(words[start:start + self.shingle_size_])
+                    for start in range(max(len(words) - self.shingle_size_ + 1, 1))}
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+        return ((hashes[:, np.newaxis] * self.a_ + self.b_) % _MERSENNE_PRIME).min(axis=0)
+
+    def add(self, text: str, key: str) -> str | None:
+        """
+        Check whether the text duplicates one added before, and add it when it does not.
+
+        Args:
+            text (str): The text to check.
+            key (str): The key of the text, e.g. the title of its paper, returned when a later text duplicates it.
+
+        Returns:
+            str | None: The key of the text duplicated, or None if the text is new.
+        """
+        digest = self._digest(text)
+        signature = self.signature(text)
+        bands = [(band, signature[band * self.rows_:(band + 1) * self.rows_].tobytes()) for band in range(self.num_bands_)]
+        with self.lock_:
+            self.num_checked_ += 1
+            if digest in self.digests_:
+                self.num_exact_ += 1
+                return self.keys_[self.digests_[digest]]
+            candidates = {index for band in bands for index in self.buckets_.get(band, ())}
+            for index in sorted(candidates):
+                if index not in self.removed_ and np.mean(self.signatures_[index] == signature) >= self.threshold_:
+                    self.num_near_ += 1
+                    return self.keys_[index]
+            self.digests_[digest] = len(self.keys_)
+            for band in bands:
+                self.buckets_.setdefault(band, []).append(len(self.keys_))
+            self.keys_.append(key)
+            self.signatures_.append(signature)
+            return None
+
+    def remove(self, text: str):
+        """
+        Remove an added text, e.g. one failed to store, so that it is not a duplicate when added again.
+
+        Args:
+            text (str): The text to remove.
+        """
+        with self.lock_:
+            index = self.digests_.pop(self._digest(text), None)
+            if index is not None:
+                self.removed_.add(index)
+
+    def _digest(self, text: str) -> str:
+        return hashlib.sha1(self.normalize(text).encode('utf-8')).hexdigest()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of texts checked, of exact and near duplicates found, and the ratio of duplicates.
+        """
+        with self.lock_:
+            num_duplicates = self.num_exact_ + self.num_near_
+            return {
+                'checked': self.num_checked_,
+                'exact_duplicates': self.num_exact_,
+                'near_duplicates': self.num_near_,
+                'duplicate_ratio': num_duplicates / self.num_checked_ if self.num_checked_ else 0.0,
+            }
@@ -3,23 +3,101 @@ __import__('pysqlite3')
 import sys
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
-from typing import Dict, List
+from typing import Dict, Iterable, List
+import os
+import json
 import uuid
 import math
+import hashlib
+import threading
 from langchain.docstore.document import Document
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from chroma_vector_store import ChromaVectorStore
+from numpy_vector_store import NumpyVectorStore
+from bm25_index import BM25Index
+from dedup import MinHashDeduplicator
+from embedding_cache import CachedEmbeddings, EmbeddingCache, QueryEmbeddingCache
+from embedding_backends import HashingEmbeddings, ScheduledEmbeddings, create_embedding, embedding_model_name, has_model_name
+import request_scheduler
+import tracing
+
+# Embedding caches shared by all the DocumentSource objects of this process, keyed by the file path.
+_EMBEDDING_CACHES: Dict[str, EmbeddingCache] = {}
+
+
+def corpus_collection_name(prefix: str, keys: Iterable[str]) -> str:
+    """
+    Derive a deterministic collection name from the keys identifying a corpus.
+
+    Args:
+        prefix (str): A readable prefix of the name, e.g. the kind of the collection.
+        keys (Iterable[str]): The keys identifying the corpus, the order does not matter.
+
+    Returns:
+        str: A valid Chroma collection name, identical for the same prefix and set of keys.
+    """
+    digest = hashlib.sha256('\x00'.join(sorted(keys)).encode('utf-8')).hexdigest()
+    return f'{prefix}-{digest[:32]}'
+
+
+def document_id(document: Document) -> str:
+    """
+    Compute the content-addressed id of a document so that re-adding it to a collection is a no-op.
+
+    Args:
+        document (Document): The document to identify.
+
+    Returns:
+        str: The hex sha256 digest of the metadata and the content of the document.
+    """
+    metadata = json.dumps(document.metadata, sort_keys=True, default=str)
+    return hashlib.sha256(f'{metadata}\x00{document.page_content}'.encode('utf-8')).hexdigest()
 
 
 class DocumentSource:
+    # The query vectors shared by all the DocumentSource objects of this process, e.g. the same query is
+    # searched in the paper collection and then in the full texts. If None, then every query is embedded.
+    query_embedding_cache_: QueryEmbeddingCache | None = QueryEmbeddingCache()
+
     def __init__(self,
-                 openai_api_key: str):
+                 openai_api_key: str,
+                 collection_name: str | None = None,
+                 persist_directory: str | None = None,
+                 embedding_cache_path: str | None = os.path.join('cache', 'embeddings.sqlite'),
+                 embedding_cache_size: int = 200000,
+                 embedding: str | Embeddings = 'openai',
+                 vector_store: str = 'chroma',
+                 lexical_weight: float = 0.0,
+                 vector_weight: float = 1.0,
+                 rrf_k: int = 60,
+                 dedup_threshold: float | None = 0.9):
         """
         Initializes with a dictionary of papers and an OpenAI API key.
 
         Args:
             papers (list[Document]): A list containing documents.
             openai_api_key (str): The OpenAI API key for text embeddings.
+            collection_name (str | None): The name of the vector collection.
+                If None, then a random one is generated, so that the collection is never reused.
+            persist_directory (str | None): The directory to persist the vector collection in.
+                If None, then the collection only lives in memory.
+            embedding_cache_path (str | None): The SQLite file caching the document embeddings across runs.
+                If None, then every document is embedded through the API.
+            embedding_cache_size (int): The max number of embeddings kept in the cache file.
+            embedding (str | Embeddings): The embedding backend, 'openai', the local 'hashing', or an Embeddings object.
+            vector_store (str): The vector store backend, 'chroma', or 'numpy' keeping the vectors in one float32 matrix.
+            lexical_weight (float): The weight of the BM25 ranking in the reciprocal rank fusion with the vector ranking.
+                If 0, then no lexical index is built and the retrieval is pure vector similarity.
+                Otherwise, score_threshold only filters the vector candidates before the fusion, see retrieve.
+            vector_weight (float): The weight of the vector ranking in the reciprocal rank fusion.
+            rrf_k (int): The rank offset of the reciprocal rank fusion, a larger one flattens the weights of the top ranks.
+            dedup_threshold (float | None): The min estimated Jaccard similarity of the word shingles of a document
+                to a stored one of the same source for it to be skipped as a near duplicate, e.g. a repeated header.
+                If None, then only the documents already stored with the same content and metadata are skipped.
+
+        Raises:
+            ValueError: when the vector store backend is unknown or the dedup threshold is not in (0, 1].
 
         Vector store elements are structured as follows:
         [
@@ -33,50 +111,395 @@ class DocumentSource:
             },
         ]
         """
-        self.num_docs_ = 0
-        # Get embedding from OpenAI.
-        embedding = OpenAIEmbeddings(openai_api_key=openai_api_key)
+        if dedup_threshold is not None and not 0 < dedup_threshold <= 1:
+            raise ValueError(f"Invalid dedup threshold: {dedup_threshold}")
+        embedding = create_embedding(embedding, openai_api_key)
+        # The queries are embedded with the bare backend, they are rarely repeated across runs.
+        # A user waits for them, they go ahead of the documents being embedded.
+        self.query_embedding_: Embeddings = embedding
+        if isinstance(embedding, ScheduledEmbeddings):
+            self.query_embedding_ = embedding.with_priority(request_scheduler.INTERACTIVE)
+        self.embedding_model_: str = embedding_model_name(embedding)
+        # The query vectors are shared under the model name, an embedding only named after its class keeps its own.
+        if not has_model_name(embedding):
+            self.query_embedding_cache_ = None
+        # Read the vectors computed in the previous runs from the cache instead of embedding them again.
+        # Hashing locally is faster than a cache lookup.
+        if embedding_cache_path and not isinstance(embedding, HashingEmbeddings):
+            # Key by the absolute path, a relative one names another file after the working directory changes.
+            embedding_cache_path = os.path.abspath(embedding_cache_path)
+            if embedding_cache_path not in _EMBEDDING_CACHES:
+                _EMBEDDING_CACHES[embedding_cache_path] = EmbeddingCache(
+                    path=embedding_cache_path,
+                    max_entries=embedding_cache_size,
+                )
+            embedding = CachedEmbeddings(
+                embedding=embedding,
+                cache=_EMBEDDING_CACHES[embedding_cache_path],
+                model=embedding_model_name(embedding),
+            )
         # UUID4: Generates a random UUID in UUID class type.
-        db_uuid = str(uuid.uuid4())
+        db_name = collection_name or str(uuid.uuid4())
+        if persist_directory:
+            os.makedirs(persist_directory, exist_ok=True)
         # Compute embeddings for each chunk and store them in the database. Each with a unique id to avoid conflicts.
-        print(f'Initiating vectordb {db_uuid}.')
-        self.db_: Chroma = Chroma(
-            embedding_function=embedding,
-            collection_name=db_uuid,
-        )
+        tracing.log(f'Initiating vectordb {db_name}.')
+        # Both stores count their documents and search several query vectors at once.
+        if vector_store == 'chroma':
+            self.db_: VectorStore = ChromaVectorStore(
+                embedding_function=embedding,
+                collection_name=db_name,
+                persist_directory=persist_directory,
+            )
+        elif vector_store == 'numpy':
+            self.db_: VectorStore = NumpyVectorStore(
+                embedding=embedding,
+                persist_directory=os.path.join(persist_directory, db_name) if persist_directory else None,
+            )
+        else:
+            raise ValueError(f"Unknown vector store: {vector_store}")
+        # A persisted collection may already hold the documents of the previous runs.
+        self.num_docs_ = self.db_.count()
+        # Guards num_docs_ and source_counts_ against the documents added by concurrent threads.
+        self.lock_ = threading.Lock()
+        # The number of documents of each source counted so far, kept up to date as documents are added.
+        self.source_counts_: Dict[str, int] = {}
+        if self.num_docs_:
+            tracing.log(f'Loaded {self.num_docs_} documents from vectordb {db_name}.')
+        self.lexical_weight_: float = lexical_weight
+        self.vector_weight_: float = vector_weight
+        self.rrf_k_: int = rrf_k
+        # The lexical index and the deduplicators are not persisted, they are built from the stored documents
+        # the first time they are needed, so that opening a persisted collection does not read all its documents.
+        self.lexical_index_: BM25Index | None = None
+        self.dedup_threshold_: float | None = dedup_threshold
+        # The deduplicator of the documents of each source, a document only duplicates one of the same source,
+        # so that the same chunk in another source, e.g. another version of a paper, can still be retrieved from it.
+        self.deduplicators_: Dict[str, MinHashDeduplicator] = {}
+
+    def _lexical_index(self) -> BM25Index:
+        """
+        Returns:
+            BM25Index: The lexical index of the stored documents, built on the first call.
+        """
+        with self.lock_:
+            if self.lexical_index_ is None:
+                lexical_index = BM25Index()
+                if self.num_docs_:
+                    stored = self.db_.get()
+                    lexical_index.add([Document(page_content=content, metadata=metadata)
+                                       for content, metadata in zip(stored['documents'], stored['metadatas'])],
+                                      ids=stored['ids'])
+                self.lexical_index_ = lexical_index
+            return self.lexical_index_
+
+    def _deduplicator(self, source: str | None) -> MinHashDeduplicator:
+        """
+        Returns:
+            MinHashDeduplicator: The deduplicator of the documents of a source, holding its stored ones on the first call.
+        """
+        with self.lock_:
+            if source not in self.deduplicators_:
+                deduplicator = MinHashDeduplicator(threshold=self.dedup_threshold_)
+                if self.num_docs_ and source is not None:
+                    for content in self.db_.get(where={'source': source})['documents']:
+                        deduplicator.add(content, source)
+                self.deduplicators_[source] = deduplicator
+            return self.deduplicators_[source]
+
+    def contains_source(self, source: str) -> bool:
+        """
+        Check whether any document of a source is already stored.
+
+        Args:
+            source (str): The source of the documents, e.g. the title of a paper.
+
+        Returns:
+            bool: True if at least one document with this source is stored, False otherwise.
+        """
+        if not self.num_docs_:
+            return False
+        return len(self.db_.get(where={'source': source}, limit=1)['ids']) > 0
+
+    def count_source(self, source: str) -> int:
+        """
+        Returns:
+            int: The number of stored documents of a source, e.g. the chunks of a paper.
+        """
+        with self.lock_:
+            if source in self.source_counts_:
+                return self.source_counts_[source]
+        count = len(self.db_.get(where={'source': source})['ids']) if self.num_docs_ else 0
+        with self.lock_:
+            return self.source_counts_.setdefault(source, count)
 
     def add_documents(self, documents: list[Document]):
-        num_docs = len(documents)
-        self.num_docs_ += num_docs
-        print(f'Adding {num_docs} documents into database.')
-        self.db_.add_documents(documents=documents)
+        # Skip the documents already stored, e.g. by the previous runs on a persisted collection.
+        ids = [document_id(doc) for doc in documents]
+        new_docs = dict(zip(ids, documents))
+        # The documents repeated in the batch with the same content and metadata are duplicates, not stored ones.
+        num_duplicates = len(documents) - len(new_docs)
+        num_stored = 0
+        if new_docs and self.num_docs_:
+            for stored_id in self.db_.get(ids=list(new_docs))['ids']:
+                del new_docs[stored_id]
+                num_stored += 1
+        # Skip the documents duplicating a stored one or an earlier one of the batch, e.g. repeated boilerplate.
+        if self.dedup_threshold_ is not None:
+            for doc_id, doc in list(new_docs.items()):
+                source = doc.metadata.get('source')
+                if self._deduplicator(source).add(doc.page_content, source) is not None:
+                    del new_docs[doc_id]
+                    num_duplicates += 1
+        num_docs = len(new_docs)
+        tracing.log(f'Adding {num_docs} documents into database, {num_stored} already stored, {num_duplicates} duplicates skipped.')
+        if not new_docs:
+            return
+        try:
+            with tracing.span('embed', documents=num_docs, duplicates=num_duplicates, model=self.embedding_model_):
+                self.db_.add_documents(documents=list(new_docs.values()), ids=list(new_docs))
+        except BaseException:
+            # A later call adds the documents again, they do not duplicate themselves.
+            if self.dedup_threshold_ is not None:
+                for doc in new_docs.values():
+                    self._deduplicator(doc.metadata.get('source')).remove(doc.page_content)
+            raise
+        # The cached embeddings record the usage of the documents they embed themselves.
+        if not isinstance(self.db_.embeddings, CachedEmbeddings):
+            tracing.record_embedding_usage(self.embedding_model_, [doc.page_content for doc in new_docs.values()])
+        with self.lock_:
+            # An index built since the documents were stored already holds them, and skips them by id.
+            if self.lexical_index_ is not None:
+                self.lexical_index_.add(list(new_docs.values()), ids=list(new_docs))
+            self.num_docs_ += num_docs
+            for doc in new_docs.values():
+                source = doc.metadata.get('source')
+                if source in self.source_counts_:
+                    self.source_counts_[source] += 1
 
     def retrieve(self,
                  query: str,
                  num_retrieval: int | None = None,
-                 score_threshold: float = 0.5) -> List[Document]:
+                 score_threshold: float = 0.5,
+                 sources: List[str] | None = None,
+                 per_source: bool = False) -> List[Document]:
         """
         Search for documents related to a query using text embeddings and cosine distance.
+        With a lexical index, the vector ranking is fused with the BM25 ranking by reciprocal rank fusion.
 
         Args:
             query (str): The query string to search for related documents.
-            num_retrieval (int): The max number of docs to retrieve based on similarity.
-                If None, then use sqrt(num_docs) based on Plato distribution assumption.
+            num_retrieval (int): The max number of docs to retrieve based on similarity, of each source if per_source.
+                If None, then use sqrt(num_docs) based on Plato distribution assumption,
+                or sqrt of the number of documents of each source if per_source.
             score_threshold (float): The score between 0 to 1 to filter the retrieved docs when greater.
+                With a lexical index, it is applied before the fusion and only filters the vector candidates by their
+                vector similarity, the BM25 candidates are fused whatever their similarity. The returned scores are then
+                the fused ones normalized to 0 to 1, which are not on the scale of the threshold.
+            sources (List[str] | None): Only search the documents of these sources, e.g. paper titles.
+                If None, then search all the documents.
+            per_source (bool): Whether to rank the documents of each of the sources on its own, as if each source
+                had its own collection, so that every source returns up to num_retrieval documents however close
+                the documents of the other sources are. It requires the sources.
 
         Returns:
             List[Document]: A list of Document objects representing the related documents found.
+                If per_source, then the documents of all the sources, by descending score.
+
+        Raises:
+            ValueError: when per_source is set without sources.
         """
-        print(f'Searching for related works of: {query}...')
+        return self.retrieve_many([query], num_retrieval, score_threshold, sources, per_source)[0]
+
+    def retrieve_many(self,
+                      queries: List[str],
+                      num_retrieval: int | None = None,
+                      score_threshold: float = 0.5,
+                      sources: List[str] | None = None,
+                      per_source: bool = False,
+                      query_sources: List[List[str]] | None = None) -> List[List[Document]]:
+        """
+        Search for the documents related to each of several queries, embedding all the queries
+        in one request and searching them together.
+
+        Args:
+            queries (List[str]): The query strings to search for related documents.
+            num_retrieval, score_threshold, sources, per_source: The same as in retrieve, shared by all the queries.
+            query_sources (List[List[str]] | None): The sources searched by each query, e.g. the papers found for it,
+                instead of the sources shared by all the queries.
+
+        Returns:
+            List[List[Document]]: For each query, the related documents found, as retrieve returns them.
+
+        Raises:
+            ValueError: when per_source is set without sources, or query_sources has not one list per query.
+        """
+        if query_sources is None:
+            query_sources = [sources] * len(queries)
+        elif len(query_sources) != len(queries):
+            raise ValueError(f"{len(query_sources)} source lists were provided for {len(queries)} queries.")
+        if per_source and any(sources is None for sources in query_sources):
+            raise ValueError("The sources to rank on their own were not provided.")
+        with tracing.span('retrieve', queries=len(queries)) as attributes:
+            if per_source:
+                results = self._retrieve_per_source(queries, num_retrieval, score_threshold, query_sources)
+            else:
+                results = self._retrieve_many(queries, num_retrieval, score_threshold, query_sources)
+            attributes['documents'] = sum(len(documents) for documents in results)
+        return results
+
+    def _retrieve_many(self,
+                       queries: List[str],
+                       num_retrieval: int | None,
+                       score_threshold: float,
+                       query_sources: List[List[str] | None]) -> List[List[Document]]:
+        for query in queries:
+            tracing.log(f'Searching for related works of: {query}...')
         # Default number of retrieval is set to be sqrt(num_docs) based on the assumption that the important docs is in Plato distribution.
         if not num_retrieval:
             num_retrieval = int(math.sqrt(self.num_docs_))
-            print(f"Using the default num_retrieval = {num_retrieval} from totally {self.num_docs_} docs based on the Plato distribution assumption.")
-
-        sources: List[Document] = self.db_.similarity_search_with_relevance_scores(
-            query=query, 
-            k=num_retrieval,
-            score_threshold=score_threshold,
-        )
-        print(f'{len(sources)} sources found.')
-        return sources
+            tracing.log(f"Using the default num_retrieval = {num_retrieval} from totally {self.num_docs_} docs based on the Plato distribution assumption.")
+        results: List[List[Document]] = [[] for _ in queries]
+        if not num_retrieval:
+            return results
+        # The queries searching the same sources are searched together, the ones searching no source find nothing.
+        groups: Dict[tuple | None, List[int]] = {}
+        for index, sources in enumerate(query_sources):
+            if sources is None or len(sources) > 0:
+                groups.setdefault(None if sources is None else tuple(sources), []).append(index)
+        vectors = self._embed_searched_queries(queries, [index for indices in groups.values() for index in indices])
+        for sources, indices in groups.items():
+            for index, documents in zip(indices, self._search([queries[index] for index in indices],
+                                                              [vectors[index] for index in indices],
+                                                              num_retrieval, score_threshold,
+                                                              None if sources is None else list(sources))):
+                results[index] = documents
+        for documents in results:
+            tracing.log(f'{len(documents)} sources found.')
+        return results
+
+    def _retrieve_per_source(self,
+                             queries: List[str],
+                             num_retrieval: int | None,
+                             score_threshold: float,
+                             query_sources: List[List[str]]) -> List[List[Document]]:
+        for query in queries:
+            tracing.log(f'Searching for related works of: {query}...')
+        if not num_retrieval:
+            tracing.log("Using the default num_retrieval = sqrt(documents) of each source.")
+        # One search of the vector store per source, for all the queries searching it.
+        source_queries: Dict[str, List[int]] = {}
+        for index, sources in enumerate(query_sources):
+            for source in dict.fromkeys(sources):
+                source_queries.setdefault(source, []).append(index)
+        vectors = self._embed_searched_queries(queries, [index for index, sources in enumerate(query_sources) if sources])
+        results: List[List[Document]] = [[] for _ in queries]
+        for source, indices in source_queries.items():
+            # A source failed to index has no documents to search.
+            num_source_docs = self.count_source(source)
+            source_num_retrieval = num_retrieval or int(math.sqrt(num_source_docs))
+            if not num_source_docs or not source_num_retrieval:
+                continue
+            for index, documents in zip(indices, self._search([queries[index] for index in indices],
+                                                              [vectors[index] for index in indices],
+                                                              source_num_retrieval, score_threshold, [source])):
+                results[index] += documents
+        for documents in results:
+            documents.sort(key=lambda document: document[1], reverse=True)
+            tracing.log(f'{len(documents)} sources found.')
+        return results
+
+    def _embed_searched_queries(self, queries: List[str], indices: List[int]) -> Dict[int, List[float]]:
+        """
+        Returns:
+            Dict[int, List[float]]: The vector of each query at the indices, embedded in one request.
+        """
+        indices = sorted(indices)
+        if len(indices) == 0:
+            return {}
+        return dict(zip(indices, self._embed_queries([queries[index] for index in indices])))
+
+    def _search(self,
+                queries: List[str],
+                vectors: List[List[float]],
+                num_retrieval: int,
+                score_threshold: float,
+                sources: List[str] | None) -> List[List[Document]]:
+        # Chroma takes a single equality condition, or an $or of at least two.
+        source_filter = None
+        if sources is not None and len(sources) == 1:
+            source_filter = {'source': sources[0]}
+        elif sources is not None:
+            source_filter = {'$or': [{'source': source} for source in sources]}
+
+        # Fuse from a deeper candidate list of each ranking than the number of documents returned.
+        lexical_index = self._lexical_index() if self.lexical_weight_ > 0 else None
+        num_candidates = num_retrieval if lexical_index is None else 4 * num_retrieval
+        results: List[List[Document]] = []
+        for query, documents in zip(queries, self._search_by_vectors(vectors, num_candidates, source_filter)):
+            documents = [(doc, score) for doc, score in documents if score >= score_threshold]
+            if lexical_index is not None:
+                lexical_documents = lexical_index.search(
+                    query=query,
+                    k=num_candidates,
+                    sources=set(sources) if sources is not None else None,
+                )
+                documents = self._fuse(documents, lexical_documents, num_retrieval)
+            results.append(documents)
+        return results
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        cache = self.query_embedding_cache_
+        if cache is None:
+            return self._embed(queries)
+        queries = [cache.normalize(query) for query in queries]
+        vectors = cache.get_many(self.embedding_model_, queries)
+        missing_queries = list(dict.fromkeys(query for query, vector in zip(queries, vectors) if vector is None))
+        if missing_queries:
+            new_vectors = self._embed(missing_queries)
+            cache.put_many(self.embedding_model_, missing_queries, new_vectors)
+            new_vector_dict = dict(zip(missing_queries, new_vectors))
+            vectors = [new_vector_dict[query] if vector is None else vector for query, vector in zip(queries, vectors)]
+        return vectors
+
+    def _embed(self, queries: List[str]) -> List[List[float]]:
+        with tracing.span('embed', queries=len(queries), model=self.embedding_model_):
+            if len(queries) == 1:
+                vectors = [self.query_embedding_.embed_query(queries[0])]
+            else:
+                vectors = self.query_embedding_.embed_documents(queries)
+        tracing.record_embedding_usage(self.embedding_model_, queries)
+        return vectors
+
+    def _search_by_vectors(self, vectors: List[List[float]], k: int, source_filter: dict | None) -> List[list]:
+        """
+        Search the documents closest to several query vectors with one query of the vector store.
+
+        Returns:
+            List[list]: For each vector, the (Document, relevance score) tuples of the k closest documents, closest first.
+        """
+        results = self.db_.similarity_search_by_vectors_with_score(vectors, k, filter=source_filter)
+        relevance_score_fn = self.db_.relevance_score_fn()
+        return [[(doc, relevance_score_fn(distance)) for doc, distance in result] for result in results]
+
+    def _fuse(self, vector_documents: list, lexical_documents: list, num_retrieval: int) -> list:
+        """
+        Fuse two rankings of documents by weighted reciprocal rank fusion.
+
+        Args:
+            vector_documents (list): The (Document, score) tuples ranked by vector similarity.
+            lexical_documents (list): The (Document, score) tuples ranked by BM25.
+            num_retrieval (int): The max number of documents to return.
+
+        Returns:
+            list: The (Document, score) tuples ranked by fused score, normalized so that
+                a document ranked first by both rankings scores 1.
+        """
+        fused: Dict[str, list] = {}
+        for weight, ranking in ((self.vector_weight_, vector_documents), (self.lexical_weight_, lexical_documents)):
+            for rank, (doc, score) in enumerate(ranking):
+                entry = fused.setdefault(document_id(doc), [doc, 0.0])
+                entry[1] += weight / (self.rrf_k_ + rank + 1)
+        max_score = (self.vector_weight_ + self.lexical_weight_) / (self.rrf_k_ + 1)
+        ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)[:num_retrieval]
+        return [(doc, score / max_score) for doc, score in ranked]
@@ -0,0 +1,189 @@
+import numpy as np
+from typing import List, Tuple
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings, embed_with_retry
+import request_scheduler
+import tracing
+
+# 64-bit FNV-1a hashing constants.
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+class HashingEmbeddings(Embeddings):
+    """A local, CPU-only embedding of the hashed character n-grams of the texts, computed with NumPy in batches.
+
+    Each n-gram of the lower-cased UTF-8 bytes is hashed into one of `dimension` buckets with a random sign,
+    and the bucket counts are L2-normalized. It needs no network nor training, and is fully reproducible.
+    """
+
+    def __init__(self,
+                 dimension: int = 1024,
+                 ngram_range: Tuple[int, int] = (3, 5),
+                 batch_size: int = 1024):
+        """
+        Args:
+            dimension (int): The dimension of the vectors.
+            ngram_range (Tuple[int, int]): The min and max length in bytes of the hashed n-grams.
+            batch_size (int): The number of texts embedded at a time.
+
+        Raises:
+            ValueError: when the dimension, the n-gram range or the batch size is invalid.
+        """
+        if dimension <= 0:
+            raise ValueError(f"Invalid dimension: {dimension}")
+        if ngram_range[0] <= 0 or ngram_range[0] > ngram_range[1]:
+            raise ValueError(f"Invalid ngram range: {ngram_range}")
+        if batch_size <= 0:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        self.dimension_: int = dimension
+        self.ngram_range_: Tuple[int, int] = ngram_range
+        self.batch_size_: int = batch_size
+        # The name of the model, identifying the vectors e.g. in caches and persisted collections.
+        self.model: str = f'hashing-{dimension}-{ngram_range[0]}-{ngram_range[1]}'
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) == 0:
+            return []
+        batches = [self.embed_batch(texts[start:start + self.batch_size_])
+                   for start in range(0, len(texts), self.batch_size_)]
+        return np.vstack(batches).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_batch([text])[0].tolist()
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed the texts at once.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            np.ndarray: A float32 matrix with one L2-normalized row per text, all zeros for a text shorter than any n-gram.
+        """
+        encoded = [text.lower().encode('utf-8') for text in texts]
+        lengths = np.array([len(text) for text in encoded], dtype=np.int64)
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.uint64)
+        # The index of the text each byte of the concatenation belongs to.
+        text_ids = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+        counts = np.zeros(len(texts) * self.dimension_, dtype=np.float64)
+        for n in range(self.ngram_range_[0], self.ngram_range_[1] + 1):
+            num_ngrams = len(data) - n + 1
+            if num_ngrams <= 0:
+                break
+            hashes = np.full(num_ngrams, _FNV_OFFSET, dtype=np.uint64)
+            for offset in range(n):
+                hashes = (hashes ^ data[offset:offset + num_ngrams]) * _FNV_PRIME
+            # Drop the n-grams spanning two texts of the concatenation.
+            within_text = text_ids[:num_ngrams] == text_ids[n - 1:n - 1 + num_ngrams]
+            hashes = hashes[within_text]
+            buckets = (hashes % np.uint64(self.dimension_)).astype(np.int64)
+            signs = np.where((hashes >> np.uint64(32)) & np.uint64(1), -1.0, 1.0)
+            counts += np.bincount(text_ids[:num_ngrams][within_text] * self.dimension_ + buckets,
+                                  weights=signs, minlength=counts.size)
+        vectors = counts.reshape(len(texts), self.dimension_)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class ScheduledEmbeddings(Embeddings):
+    """An embedding sending its requests through the request scheduler of the process, one batch per request."""
+
+    def __init__(self, embedding: Embeddings, batch_size: int = 1000, priority: int = request_scheduler.BULK):
+        """
+        Args:
+            embedding (Embeddings): The embedding sending the requests, e.g. OpenAIEmbeddings without retries.
+            batch_size (int): The max number of texts per request, the one of the embedding.
+            priority (int): The priority class of the requests, INTERACTIVE or BULK.
+        """
+        self.embedding_: Embeddings = embedding
+        self.batch_size_: int = batch_size
+        self.priority_: int = priority
+        self.model: str = embedding_model_name(embedding)
+
+    def with_priority(self, priority: int) -> 'ScheduledEmbeddings':
+        """
+        Returns:
+            ScheduledEmbeddings: The same embedding sending its requests with another priority class.
+        """
+        return ScheduledEmbeddings(self.embedding_, self.batch_size_, priority)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size_):
+            batch = texts[start:start + self.batch_size_]
+            # Estimate the tokens from the characters, the embedding tokenizes the texts again to send them.
+            vectors += request_scheduler.call(
+                self.model,
+                sum(len(text) for text in batch) // tracing.ApproximateEncoding.CHARS_PER_TOKEN_,
+                lambda: self.embedding_.embed_documents(batch),
+                self.priority_,
+            )
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return request_scheduler.call(self.model, tracing.count_tokens(self.model, text),
+                                      lambda: self.embedding_.embed_query(text), self.priority_)
+
+
+class UntokenizedOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAIEmbeddings sending the texts as they are, for when the tokenizer of the model cannot be loaded, e.g. offline.
+
+    OpenAIEmbeddings always tokenizes the texts to split the ones beyond the context of the model,
+    here a text beyond the context fails at the API instead.
+    """
+
+    def embed_documents(self, texts: List[str], chunk_size: int | None = 0) -> List[List[float]]:
+        chunk_size = chunk_size or self.chunk_size
+        vectors = []
+        for start in range(0, len(texts), chunk_size):
+            response = embed_with_retry(self, input=texts[start:start + chunk_size], **self._invocation_params)
+            vectors += [data['embedding'] for data in response['data']]
+        return vectors
+
+
+def create_embedding(embedding: str | Embeddings, openai_api_key: str | None = None) -> Embeddings:
+    """
+    Create an embedding backend.
+
+    Args:
+        embedding (str | Embeddings): The name of a backend, 'openai' or 'hashing', or an Embeddings object used as is.
+        openai_api_key (str | None): The OpenAI API key, required by the 'openai' backend.
+
+    Returns:
+        Embeddings: The embedding backend.
+
+    Raises:
+        ValueError: when the backend name is unknown.
+    """
+    if isinstance(embedding, Embeddings):
+        return embedding
+    if embedding == 'openai':
+        # The scheduler paces and retries the requests, instead of the retries of OpenAIEmbeddings.
+        openai_embedding = OpenAIEmbeddings(openai_api_key=openai_api_key, max_retries=1)
+        if isinstance(tracing.encoding_for_model(openai_embedding.model), tracing.ApproximateEncoding):
+            openai_embedding = UntokenizedOpenAIEmbeddings(openai_api_key=openai_api_key, max_retries=1)
+        return ScheduledEmbeddings(openai_embedding)
+    if embedding == 'hashing':
+        return HashingEmbeddings()
+    raise ValueError(f"Unknown embedding backend: {embedding}")
+
+
+def embedding_model_name(embedding: Embeddings) -> str:
+    """
+    Returns:
+        str: The name of the model of an embedding backend, the class name when it has no model attribute.
+    """
+    return getattr(embedding, 'model', type(embedding).__name__)
+
+
+def has_model_name(embedding: Embeddings) -> bool:
+    """
+    Returns:
+        bool: Whether an embedding backend has a model attribute naming its vectors. The name of a backend without one
+            is its class name, shared by the instances of the class configured to compute other vectors.
+    """
+    if isinstance(embedding, ScheduledEmbeddings):
+        embedding = embedding.embedding_
+    return hasattr(embedding, 'model')
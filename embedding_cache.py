@@ -0,0 +1,242 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from langchain.embeddings.base import Embeddings
+import tracing
+
+
+class EmbeddingCache(object):
+    """An on-disk LRU cache of embedding vectors keyed by (embedding model, hash of text)."""
+
+    # SQLite limits the number of host parameters in one statement.
+    MAX_BATCH_: int = 500
+
+    def __init__(self,
+                 path: str = os.path.join('cache', 'embeddings.sqlite'),
+                 max_entries: int = 200000):
+        """
+        Initialize an EmbeddingCache backed by a SQLite file.
+
+        Args:
+            path (str): The path of the SQLite file, created when missing.
+            max_entries (int): The max number of vectors kept on disk, the least recently used ones are evicted first.
+
+        Raises:
+            ValueError: when max_entries <= 0.
+        """
+        if max_entries <= 0:
+            raise ValueError(f"Invalid max entries: {max_entries}")
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path_: str = path
+        self.max_entries_: int = max_entries
+        self.hits_: int = 0
+        self.misses_: int = 0
+        self.lock_ = threading.Lock()
+        self.conn_ = sqlite3.connect(path, check_same_thread=False)
+        self.conn_.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                           'key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)')
+        self.conn_.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        self.conn_.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        """
+        Compute the cache key of a text embedded by a model.
+
+        Args:
+            model (str): The name of the embedding model.
+            text (str): The embedded text.
+
+        Returns:
+            str: The hex sha256 digest of the model name and the text.
+        """
+        return hashlib.sha256(f'{model}\x00{text}'.encode('utf-8')).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up the cached vectors of the texts and mark the found ones as recently used.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (List[str]): The texts to look up.
+
+        Returns:
+            List[Optional[List[float]]]: The vectors in the order of texts, None for the ones not cached.
+        """
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        with self.lock_:
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), self.MAX_BATCH_):
+                batch = unique_keys[start:start + self.MAX_BATCH_]
+                rows = self.conn_.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(batch))})', batch)
+                found.update(rows.fetchall())
+            if found:
+                now = time.time()
+                self.conn_.executemany('UPDATE embeddings SET last_access = ? WHERE key = ?',
+                                       [(now, key) for key in found])
+                self.conn_.commit()
+            num_hits = sum(key in found for key in keys)
+            self.hits_ += num_hits
+            self.misses_ += len(keys) - num_hits
+        return [self._decode(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """
+        Store the vectors of the texts, then evict the least recently used ones beyond max_entries.
+
+        Args:
+            model (str): The name of the embedding model.
+            texts (List[str]): The embedded texts.
+            vectors (List[List[float]]): The vectors in the order of texts.
+        """
+        now = time.time()
+        rows = [(self.key(model, text), self._encode(vector), now) for text, vector in zip(texts, vectors)]
+        with self.lock_:
+            self.conn_.executemany('INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)', rows)
+            num_entries = self.conn_.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if num_entries > self.max_entries_:
+                tracing.log(f'Evicting {num_entries - self.max_entries_} least recently used embeddings from {self.path_}.')
+                self.conn_.execute('DELETE FROM embeddings WHERE key IN '
+                                   '(SELECT key FROM embeddings ORDER BY last_access LIMIT ?)',
+                                   (num_entries - self.max_entries_,))
+            self.conn_.commit()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of hits, misses and the hit rate since this cache was opened.
+        """
+        total = self.hits_ + self.misses_
+        return {
+            'hits': self.hits_,
+            'misses': self.misses_,
+            'hit_rate': self.hits_ / total if total else 0.0,
+        }
+
+    @staticmethod
+    def _encode(vector: List[float]) -> bytes:
+        # The vector stores keep float32 anyway, so there is no point in storing doubles.
+        return array('f', vector).tobytes()
+
+    @staticmethod
+    def _decode(blob: bytes) -> List[float]:
+        vector = array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+
+class QueryEmbeddingCache(object):
+    """An in-memory LRU cache of query vectors keyed by (embedding model, normalized query), shared across threads."""
+
+    def __init__(self, max_entries: int = 10000):
+        """
+        Args:
+            max_entries (int): The max number of cached query vectors, the least recently used ones are evicted first.
+
+        Raises:
+            ValueError: when max_entries <= 0.
+        """
+        if max_entries <= 0:
+            raise ValueError(f"Invalid max entries: {max_entries}")
+        self.max_entries_: int = max_entries
+        self.vectors_: OrderedDict = OrderedDict()
+        self.hits_: int = 0
+        self.misses_: int = 0
+        self.lock_ = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """
+        Returns:
+            str: The query with its runs of whitespace collapsed into single spaces, the case is kept
+                since the embedding models are case sensitive.
+        """
+        return ' '.join(query.split())
+
+    def get_many(self, model: str, queries: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up the cached vectors of the normalized queries and mark the found ones as recently used.
+
+        Args:
+            model (str): The name of the embedding model.
+            queries (List[str]): The normalized queries to look up.
+
+        Returns:
+            List[Optional[List[float]]]: The vectors in the order of queries, None for the ones not cached.
+        """
+        vectors = []
+        with self.lock_:
+            for query in queries:
+                key: Tuple[str, str] = (model, query)
+                vector = self.vectors_.get(key)
+                if vector is None:
+                    self.misses_ += 1
+                else:
+                    self.vectors_.move_to_end(key)
+                    self.hits_ += 1
+                vectors.append(vector)
+        return vectors
+
+    def put_many(self, model: str, queries: List[str], vectors: List[List[float]]):
+        """
+        Store the vectors of the normalized queries, then evict the least recently used ones beyond max_entries.
+        """
+        with self.lock_:
+            for query, vector in zip(queries, vectors):
+                self.vectors_[(model, query)] = vector
+                self.vectors_.move_to_end((model, query))
+            while len(self.vectors_) > self.max_entries_:
+                self.vectors_.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of hits, misses, the hit rate and the number of cached queries since this cache was created.
+        """
+        total = self.hits_ + self.misses_
+        return {
+            'hits': self.hits_,
+            'misses': self.misses_,
+            'hit_rate': self.hits_ / total if total else 0.0,
+            'entries': len(self.vectors_),
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embedding model so that document vectors already computed are read from an EmbeddingCache."""
+
+    def __init__(self, embedding: Embeddings, cache: EmbeddingCache, model: str):
+        """
+        Args:
+            embedding (Embeddings): The embedding model to call on cache misses.
+            cache (EmbeddingCache): The cache to consult before calling the embedding model.
+            model (str): The name of the embedding model, part of the cache key.
+        """
+        self.embedding_: Embeddings = embedding
+        self.cache_: EmbeddingCache = cache
+        self.model_: str = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache_.get_many(self.model_, texts)
+        missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        num_cached = sum(vector is not None for vector in vectors)
+        tracing.log(f'{num_cached} of {len(texts)} chunks found in the embedding cache.')
+        if missing_texts:
+            new_vectors = self.embedding_.embed_documents(missing_texts)
+            tracing.record_embedding_usage(self.model_, missing_texts)
+            self.cache_.put_many(self.model_, missing_texts, new_vectors)
+            new_vector_dict = dict(zip(missing_texts, new_vectors))
+            vectors = [new_vector_dict[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedding_.embed_query(text)
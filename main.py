@@ -2,16 +2,24 @@ import sys
 sys.path.append('MindSync')
 import openai
 import os
-import arxiv
 import functools
+import time
 
 openai.api_key =  ''
+# Vector collections are persisted here, so that reruns only embed the new papers and chunks.
+PERSIST_DIRECTORY = 'vectordb'
 
 from agents import GeneralAgent
+from response_cache import SQLiteResponseCache
 from paper_class import Paper
 from paper_collection import PaperCollection
 from paper_chat import PaperChat
 from paper_source import PaperSource
+from document_source import DocumentSource, corpus_collection_name
+from tools import map_concurrently
+from token_budget import TokenBudget
+import tracing
+import request_scheduler
 from datetime import datetime
 
 ############################################################################################################
@@ -64,16 +72,41 @@ class ResearchTopicComposer(object):
                  papers: dict[str, Paper],
                  model: str = 'gpt-3.5-turbo',
                  num_retrieval: int = None,
-                 score_threshold: float = 0.5):
+                 score_threshold: float = 0.5,
+                 persist_directory: str | None = None,
+                 max_concurrency: int = 1,
+                 topic_concurrency: int = 1,
+                 on_token=None,
+                 num_workers: int = 1,
+                 prefetch_workers: int = 0,
+                 embedding: str = 'openai',
+                 corpus_id: str | None = None):
         self.research_interests_ = research_interests
-
-        chat = PaperChat(PaperSource(papers, openai.api_key))
-
-        self.source_and_summarize_ = functools.partial(chat.source_and_summarize,
+        # The callback streaming the composed research topics token by token, if given.
+        # It is called with the raw topic and the token, as the topics may be composed concurrently.
+        self.on_token_ = on_token
+        # The max number of research topics refined concurrently.
+        self.topic_concurrency_ = topic_concurrency
+
+        # With prefetch workers, the papers are indexed in the background while the raw topics are generated.
+        # The papers are prefetched in the order of the dictionary, e.g. by descending relevance to the research interests.
+        # With a corpus, e.g. the papers of a professor, the full texts persist in one collection named after it,
+        # so that the next runs only index the papers new to the corpus. Otherwise, it is named after the papers.
+        collection_name = None
+        if persist_directory and corpus_id is not None:
+            collection_name = corpus_collection_name(prefix='papersource',
+                                                     keys=[f'corpus_id={corpus_id}', f'embedding={embedding}'])
+        self.paper_source_ = PaperSource(papers, openai.api_key, persist_directory=persist_directory,
+                                         num_workers=num_workers, collection_name=collection_name,
+                                         prefetch_workers=prefetch_workers, embedding=embedding)
+        chat = PaperChat(self.paper_source_, max_concurrency=max_concurrency)
+
+        self.source_and_summarize_many_ = functools.partial(chat.source_and_summarize_many,
             num_retrieval=num_retrieval,
             score_threshold=score_threshold)
 
         self.researcher_: ResearchAssistant = ResearchAssistant(model)
+        self.token_budget_: TokenBudget = TokenBudget(models=[model])
 
     def get_raw_research_topics(self) -> dict[str,str]:
         '''Generate research topics with the USER input (prompt)'''
@@ -103,22 +136,20 @@ Just return the bullet points only, no explanations needed:
         )
         return eval(parsed_topics)
 
-    def _refine_research_topic(self, raw_potential_research_topic: str):
+    def _refine_research_topic(self, raw_potential_research_topic: str, sources: list):
         '''
         Read the teacher's paper and combine with the interests to propose that somthing similar in teacher's research.
 
         Args:
             raw_potential_research_topic (str): The raw potential research topic from GPT.
+            sources (list): The summarized sources related to the topic, with their relevance scores.
 
         Returns:
             str: {raw_potential_research_topic}: {potential_topic}.
         '''
 
-        sources: list = self.source_and_summarize_(query=raw_potential_research_topic)
-
-        prof_related_research_works: str = '\n'.join([str(source[0].metadata) for source in sources])
-
-        prompt = f'''As a world-class researcher, you are gonging to write to another professor.
+        def compose_prompt(prof_related_research_works: str) -> str:
+            return f'''As a world-class researcher, you are gonging to write to another professor.
 You have a potential research topic {raw_potential_research_topic}. \
 Please take a deep breath and propose the detailed methodologies that we could ellaborate based on the recent research works for another professor:
 
@@ -137,11 +168,23 @@ Please DO NOT write "by Professor XXX".
 Please write in the first person to another professor.
 '''
 
-        potential_topic: str =  self.researcher_.query(
-            user_query=prompt,
-            temperature=0.5,
-            # temperature=1,
+        # Keep the most relevant research works fitting in the context of the model.
+        packed_works = self.token_budget_.pack(
+            prefix=compose_prompt(''),
+            texts=[str(source[0].metadata) for source in sources],
+            scores=[source[1] for source in sources],
+            system_prompt=ResearchAssistant.role_,
         )
+        prof_related_research_works: str = '\n'.join([work for index, work in packed_works])
+        prompt = compose_prompt(prof_related_research_works)
+
+        with tracing.span('compose', topic=raw_potential_research_topic):
+            potential_topic: str =  self.researcher_.query(
+                user_query=prompt,
+                temperature=0.5,
+                # temperature=1,
+                on_token=functools.partial(self.on_token_, raw_potential_research_topic) if self.on_token_ else None,
+            )
 
         return f"{raw_potential_research_topic}: {potential_topic}"
 
@@ -150,20 +193,42 @@ Please write in the first person to another professor.
         if not raw_potential_research_topics:
             raw_potential_research_topics: dict = self.get_raw_research_topics()
         finetuned_potential_research_topics = []
-        
-        for index, topic in enumerate(raw_potential_research_topics):
-            refined_topic = self._refine_research_topic(topic)
+
+        # The sources of all the topics are retrieved with one search, embedding the topics in one request.
+        raw_topics: list = list(raw_potential_research_topics)
+        sources_list: list = self.source_and_summarize_many_(queries=raw_topics)
+
+        # The topics are independent of each other, so they are refined concurrently and numbered in the input order.
+        refined_topics = map_concurrently(
+            lambda topic_and_sources: self._refine_research_topic(*topic_and_sources),
+            list(zip(raw_topics, sources_list)),
+            self.topic_concurrency_,
+        )
+        for index, refined_topic in enumerate(refined_topics):
             finetuned_potential_research_topics.append(f"{index+1}. {refined_topic}")
 
         # return all finetuned_potential_research_topics in str 'topic1:xxxx \n topic2:xxxx'
         return '\n\n'.join(finetuned_potential_research_topics)
 
+    def close(self):
+        '''Stop prefetching the papers not needed by the research topics composed.'''
+        self.paper_source_.close()
+
+
+
+if __name__ == '__main__':
+    # The spans and the token usage of the run are traced to a JSONL file and summarized at the end.
+    # Pass verbose=False to silence the log of every request, or a budget in USD to stop a run costing more.
+    tracing.Tracer.current_ = tracing.Tracer(trace_path=os.path.join('traces', f'run-{time.strftime("%Y%m%d-%H%M%S")}.jsonl'))
 
+    # Reruns with the same deterministic prompts are answered from disk instead of OpenAI,
+    # the creative ones at a temperature above 0 are always asked again.
+    GeneralAgent.default_response_cache_ = SQLiteResponseCache(ttl_seconds=7 * 24 * 3600, deterministic_only=True)
 
-professor = Professor(
-    first_name='Razvan',
-    last_name='Marinescu',
-    research_interests='''
+    professor = Professor(
+        first_name='Razvan',
+        last_name='Marinescu',
+        research_interests='''
 Machine Learning
 Generative ML Models
 Bayesian inference
@@ -172,37 +237,52 @@ Molecular Biology
 Molecular Dynamics
 Entrepreneurship
 '''
-)
+    )
 
-paper_collection = PaperCollection(
-    openai_api_key=openai.api_key,
-    chunk_size=2000,
-)
+    paper_collection = PaperCollection(
+        openai_api_key=openai.api_key,
+        chunk_size=2000,
+        corpus_id=professor.full_name_convert(),
+        persist_directory=PERSIST_DIRECTORY,
+    )
 
-# arXiv mode: get all your paper about query in arxiv
-paper_collection.add_from_arxiv(
-    search=arxiv.Search(
+    # arXiv mode: get all your paper about query in arxiv
+    # Only the papers not synced by the previous runs are fetched and embedded.
+    # Or sync all the papers of the professor with query=f'au:{professor.full_name_convert()}'.
+    paper_collection.sync_from_arxiv(
         id_list = ['2002.03419', '2107.09700'],
-        sort_by = arxiv.SortCriterion.SubmittedDate,
-        sort_order = arxiv.SortOrder.Descending
     )
-)
-
-# Customized mode
-# paper_collection.add_paper(Paper(
-#     title='',
-#     authors=[professor.full_name()],
-#     summary="Avoid",
-#     publish_date=datetime.strptime("2023", "%Y"),
-#     url=''),)
-
-research_topic_composer: ResearchTopicComposer = ResearchTopicComposer(
-    research_interests=professor.research_interests,
-    papers=paper_collection.papers,
-    num_retrieval=5,
-    score_threshold=0.5)
-
-email_content = Potential_Research.format(
-    research_interests=research_topic_composer.get_research_topics(),
-)
-print(email_content)
+
+    # Customized mode
+    # paper_collection.add_paper(Paper(
+    #     title='',
+    #     authors=[professor.full_name()],
+    #     summary="Avoid",
+    #     publish_date=datetime.strptime("2023", "%Y"),
+    #     url=''),)
+
+    research_topic_composer: ResearchTopicComposer = ResearchTopicComposer(
+        research_interests=professor.research_interests,
+        # The full texts of the papers most related to the research interests are prefetched first.
+        papers=paper_collection.rank_papers(professor.research_interests),
+        num_retrieval=5,
+        score_threshold=0.5,
+        persist_directory=PERSIST_DIRECTORY,
+        corpus_id=professor.full_name_convert(),
+        max_concurrency=8,
+        topic_concurrency=4,
+        # Bounded, as each parsing process holds a whole PDF in memory.
+        num_workers=min(os.cpu_count() or 1, 8),
+        prefetch_workers=2)
+
+    email_content = Potential_Research.format(
+        research_interests=research_topic_composer.get_research_topics(),
+    )
+    research_topic_composer.close()
+    print(email_content)
+    print(f'Response cache: {GeneralAgent.default_response_cache_.stats()}')
+    print(f'Query embedding cache: {DocumentSource.query_embedding_cache_.stats()}')
+    print(f'Paper deduplication: {paper_collection.deduplicator_.stats()}')
+    print(f'Request scheduler: {request_scheduler.RequestScheduler.current_.stats()}')
+    print(tracing.Tracer.current_.summary())
+    tracing.Tracer.current_.close()
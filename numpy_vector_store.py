@@ -0,0 +1,298 @@
+import os
+import json
+import threading
+import numpy as np
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+import tracing
+
+
+class NumpyVectorStore(VectorStore):
+    """An in-memory vector store keeping all the vectors in one contiguous float32 matrix.
+
+    A search is one matrix-vector product followed by argpartition. The relevance scores follow
+    the ones of the Chroma store with its default l2 space, 1 - squared_l2_distance / sqrt(2),
+    so that the same score_threshold keeps the same documents.
+    """
+
+    # A persisted store is three files. vectors.f32 holds the rows of the vectors as raw float32 in the native byte order,
+    # without the header of an .npy file, so that an add appends its rows without rewriting the file.
+    # Its dtype and row width are only known from meta.json, {"dimension": int}, and its number of rows
+    # from its size. documents.jsonl holds the id, content and metadata of each row, one JSON line per row.
+    # Both are appended to on each add, and the vectors are loaded with np.memmap.
+    VECTORS_FILE_: str = 'vectors.f32'
+    DOCUMENTS_FILE_: str = 'documents.jsonl'
+    META_FILE_: str = 'meta.json'
+
+    def __init__(self, embedding: Embeddings, persist_directory: str | None = None):
+        """
+        Initialize a NumpyVectorStore, loading the saved one if any.
+
+        Args:
+            embedding (Embeddings): The embedding of the documents and of the queries.
+            persist_directory (str | None): The directory to append the added documents to, and to load the store from.
+                If None, then the store only lives in memory.
+        """
+        self.embedding_: Embeddings = embedding
+        self.persist_directory_: str | None = persist_directory
+        self.lock_ = threading.Lock()
+        # Rows [0, size_) of vectors_ are used, the rest is capacity for the next adds.
+        self.vectors_: np.ndarray = np.zeros((0, 0), dtype=np.float32)
+        self.squared_norms_: np.ndarray = np.zeros(0, dtype=np.float32)
+        self.size_: int = 0
+        self.ids_: List[str] = []
+        self.id_rows_: Dict[str, int] = {}
+        self.documents_: List[Document] = []
+        # The index of the source of each row, to filter by source without looking at the metadata.
+        self.source_ids_: np.ndarray = np.zeros(0, dtype=np.int32)
+        self.sources_: Dict[str, int] = {}
+        if persist_directory and os.path.exists(os.path.join(persist_directory, self.META_FILE_)):
+            self._load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_
+
+    def count(self) -> int:
+        return self.size_
+
+    def add_texts(self,
+                  texts: Iterable[str],
+                  metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None,
+                  **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(self.size_ + index) for index in range(len(texts))]
+        vectors = np.asarray(self.embedding_.embed_documents(texts), dtype=np.float32)
+        squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+        with self.lock_:
+            self._reserve(self.size_ + len(texts), vectors.shape[1])
+            size = self.size_
+            rows = []
+            for index, (text, metadata, id) in enumerate(zip(texts, metadatas, ids)):
+                document = Document(page_content=text, metadata=metadata)
+                # An id already stored replaces its row, as Chroma upserts it.
+                row = self.id_rows_.get(id)
+                if row is None:
+                    row = size
+                    size += 1
+                    self.id_rows_[id] = row
+                    self.ids_.append(id)
+                    self.documents_.append(document)
+                else:
+                    self.documents_[row] = document
+                self.vectors_[row] = vectors[index]
+                self.squared_norms_[row] = squared_norms[index]
+                self.source_ids_[row] = self._source_id(metadata.get('source'))
+                rows.append(row)
+            # Publish the new rows last, so that a concurrent search never sees a row half written.
+            self.size_ = size
+            if self.persist_directory_:
+                self._append(rows)
+        return ids
+
+    def get(self, ids: List[str] | None = None, where: dict | None = None, limit: int | None = None) -> dict:
+        """
+        Get the stored documents by ids and/or metadata, as Chroma.get does.
+
+        Returns:
+            dict: The 'ids', 'documents' and 'metadatas' of the matching documents.
+        """
+        if ids is not None:
+            rows = [self.id_rows_[id] for id in ids if id in self.id_rows_]
+        else:
+            rows = range(self.size_)
+        if where is not None:
+            mask = self._filter_mask(where, self.size_)
+            rows = [row for row in rows if mask[row]]
+        rows = list(rows)[:limit]
+        return {
+            'ids': [self.ids_[row] for row in rows],
+            'documents': [self.documents_[row].page_content for row in rows],
+            'metadatas': [dict(self.documents_[row].metadata) for row in rows],
+        }
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, score in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(self,
+                                     query: str,
+                                     k: int = 4,
+                                     filter: dict | None = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        """
+        Returns:
+            List[Tuple[Document, float]]: The k documents closest to the query and their squared l2 distances, closest first.
+        """
+        if self.size_ == 0 or k <= 0:
+            return []
+        query_vector = self.embedding_.embed_query(query)
+        return self.similarity_search_by_vectors_with_score([query_vector], k, filter=filter)[0]
+
+    def similarity_search_by_vectors_with_score(self,
+                                                vectors: List[List[float]],
+                                                k: int = 4,
+                                                filter: dict | None = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Search the documents closest to several query vectors at once, with one matrix-matrix product.
+
+        Args:
+            vectors (List[List[float]]): The query vectors.
+            k (int): The max number of documents to return per query.
+            filter (dict | None): A Chroma metadata filter of the searched documents.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: For each query, the k closest documents and their squared l2 distances, closest first.
+        """
+        size = self.size_
+        if size == 0 or k <= 0 or len(vectors) == 0:
+            return [[] for _ in vectors]
+        query_vectors = np.asarray(vectors, dtype=np.float32)
+        candidates = np.arange(size)
+        if filter is not None:
+            candidates = np.flatnonzero(self._filter_mask(filter, size))
+        if len(candidates) == 0:
+            return [[] for _ in vectors]
+        candidate_vectors = self.vectors_[:size][candidates]
+        squared_distances = self.squared_norms_[:size][candidates][np.newaxis, :] \
+            - 2 * (query_vectors @ candidate_vectors.T) \
+            + np.einsum('ij,ij->i', query_vectors, query_vectors)[:, np.newaxis]
+        k = min(k, len(candidates))
+        top = np.argpartition(squared_distances, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(top, np.argsort(np.take_along_axis(squared_distances, top, axis=1), axis=1), axis=1)
+        # Return copies, the callers annotate and concatenate the retrieved documents.
+        return [[(self._copy(self.documents_[candidates[index]]), float(max(distances[index], 0.0))) for index in row]
+                for row, distances in zip(top, squared_distances)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return self._euclidean_relevance_score_fn
+
+    def relevance_score_fn(self) -> Callable[[float], float]:
+        """
+        Returns:
+            Callable[[float], float]: The function mapping a squared l2 distance to a relevance score between 0 and 1.
+        """
+        return self._select_relevance_score_fn()
+
+    @classmethod
+    def from_texts(cls,
+                   texts: List[str],
+                   embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> 'NumpyVectorStore':
+        store = cls(embedding=embedding, persist_directory=kwargs.pop('persist_directory', None))
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store
+
+    def _reserve(self, size: int, dimension: int):
+        # Grow the capacity geometrically, so that adding n vectors one batch at a time copies O(n) rows overall.
+        if size <= len(self.vectors_) and self.vectors_.flags.writeable:
+            return
+        capacity = max(size, 2 * len(self.vectors_), 256)
+        vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        squared_norms = np.zeros(capacity, dtype=np.float32)
+        source_ids = np.zeros(capacity, dtype=np.int32)
+        if self.size_:
+            vectors[:self.size_] = self.vectors_[:self.size_]
+            squared_norms[:self.size_] = self.squared_norms_[:self.size_]
+            source_ids[:self.size_] = self.source_ids_[:self.size_]
+        self.vectors_, self.squared_norms_, self.source_ids_ = vectors, squared_norms, source_ids
+
+    @staticmethod
+    def _copy(document: Document) -> Document:
+        return Document(page_content=document.page_content, metadata=dict(document.metadata))
+
+    def _source_id(self, source: Any) -> int:
+        key = str(source)
+        if key not in self.sources_:
+            self.sources_[key] = len(self.sources_)
+        return self.sources_[key]
+
+    def _filter_mask(self, where: dict, size: int) -> np.ndarray:
+        """
+        Evaluate a Chroma metadata filter, e.g. {'source': title} or {'$or': [{'source': title}, ...]}.
+
+        Returns:
+            np.ndarray: A boolean mask of the rows [0, size) matching the filter.
+        """
+        if '$or' in where or '$and' in where:
+            operator = '$or' if '$or' in where else '$and'
+            masks = [self._filter_mask(condition, size) for condition in where[operator]]
+            return np.logical_or.reduce(masks) if operator == '$or' else np.logical_and.reduce(masks)
+        mask = np.ones(size, dtype=bool)
+        for key, value in where.items():
+            if key == 'source':
+                mask &= self.source_ids_[:size] == self.sources_.get(str(value), -1)
+            else:
+                mask &= np.array([self.documents_[row].metadata.get(key) == value for row in range(size)], dtype=bool)
+        return mask
+
+    def _append(self, rows: List[int]):
+        """
+        Append the rows added or replaced to the files of the store, without rewriting the rows saved before.
+        The documents are appended last, a row is only loaded once its document line is complete.
+        """
+        os.makedirs(self.persist_directory_, exist_ok=True)
+        meta_path = os.path.join(self.persist_directory_, self.META_FILE_)
+        if not os.path.exists(meta_path):
+            with open(f'{meta_path}.tmp', 'w') as f:
+                json.dump({'dimension': self.vectors_.shape[1]}, f)
+            os.replace(f'{meta_path}.tmp', meta_path)
+        with open(os.path.join(self.persist_directory_, self.VECTORS_FILE_), 'ab') as f:
+            f.write(np.ascontiguousarray(self.vectors_[rows]).tobytes())
+        with open(os.path.join(self.persist_directory_, self.DOCUMENTS_FILE_), 'a') as f:
+            for row in rows:
+                f.write(json.dumps({'id': self.ids_[row], 'page_content': self.documents_[row].page_content,
+                                    'metadata': self.documents_[row].metadata}, default=str) + '\n')
+
+    def _load(self):
+        with open(os.path.join(self.persist_directory_, self.META_FILE_)) as f:
+            dimension = json.load(f)['dimension']
+        vectors_path = os.path.join(self.persist_directory_, self.VECTORS_FILE_)
+        documents_path = os.path.join(self.persist_directory_, self.DOCUMENTS_FILE_)
+        # The documents and the end offsets of their lines, a line cut by a crash during an add ends the store.
+        records, ends = [], []
+        if os.path.exists(documents_path):
+            with open(documents_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    records.append(json.loads(line))
+                    ends.append((ends[-1] if ends else 0) + len(line))
+        vectors_size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+        num_rows = min(len(records), vectors_size // (4 * dimension))
+        records = records[:num_rows]
+        # Cut what an interrupted add left past the rows loaded, so that the next add appends right after them.
+        with open(vectors_path, 'ab') as f:
+            f.truncate(num_rows * 4 * dimension)
+        with open(documents_path, 'ab') as f:
+            f.truncate(ends[num_rows - 1] if num_rows else 0)
+        if num_rows == 0:
+            return
+        # Memory-map the matrix, so that opening the store is near instant and pages are read on demand.
+        # The first add copies it into a writable matrix.
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(num_rows, dimension))
+        # A replaced id was appended again, its last row replaces its first one.
+        first_rows: Dict[str, int] = {}
+        for row, record in enumerate(records):
+            first_rows.setdefault(record['id'], row)
+        if len(first_rows) < num_rows:
+            last_rows = {record['id']: row for row, record in enumerate(records)}
+            kept_rows = [last_rows[id] for id in first_rows]
+            vectors = np.array(vectors[kept_rows])
+            records = [records[row] for row in kept_rows]
+        self.vectors_ = vectors
+        self.size_ = len(records)
+        self.squared_norms_ = np.einsum('ij,ij->i', self.vectors_, self.vectors_).astype(np.float32)
+        self.source_ids_ = np.zeros(self.size_, dtype=np.int32)
+        for row, record in enumerate(records):
+            self.ids_.append(record['id'])
+            self.id_rows_[record['id']] = row
+            self.documents_.append(Document(page_content=record['page_content'], metadata=record['metadata']))
+            self.source_ids_[row] = self._source_id(record['metadata'].get('source'))
+        tracing.log(f'Loaded {self.size_} vectors from {self.persist_directory_}.')
@@ -0,0 +1,176 @@
+import re
+import bisect
+from typing import Dict, Iterator, List, MutableMapping
+from paper_class import Paper
+
+
+class PaperCatalog(MutableMapping):
+    """A dictionary of papers keyed by title, with secondary indexes on their arXiv ID, URL, authors and publish year.
+
+    It is used as a plain Dict[str, Paper], and the lookups by the other keys and the year ranges
+    read the indexes instead of scanning the papers.
+    """
+
+    def __init__(self, papers: Dict[str, Paper] | None = None):
+        """
+        Args:
+            papers (Dict[str, Paper] | None): The papers to start with, keyed by title.
+        """
+        self.papers_: Dict[str, Paper] = {}
+        self.arxiv_ids_: Dict[str, str] = {}
+        self.urls_: Dict[str, str] = {}
+        # The titles of the papers of each author and of each year, in the order added.
+        self.authors_: Dict[str, List[str]] = {}
+        self.years_: Dict[int, List[str]] = {}
+        # The years of years_ in ascending order, to bisect the year ranges.
+        self.sorted_years_: List[int] = []
+        if papers:
+            self.update(papers)
+
+    def __getitem__(self, title: str) -> Paper:
+        return self.papers_[title]
+
+    def __setitem__(self, title: str, paper: Paper):
+        if title in self.papers_:
+            del self[title]
+        self.papers_[title] = paper
+        arxiv_id = paper.arxiv_id
+        if arxiv_id:
+            self.arxiv_ids_.setdefault(arxiv_id, title)
+        # An empty URL, e.g. of a paper added by hand, identifies no paper.
+        if paper.url:
+            self.urls_.setdefault(paper.url, title)
+        for author in paper.authors:
+            self.authors_.setdefault(author, []).append(title)
+        year = paper.publish_year
+        if year is not None:
+            if year not in self.years_:
+                bisect.insort(self.sorted_years_, year)
+            self.years_.setdefault(year, []).append(title)
+
+    def __delitem__(self, title: str):
+        paper = self.papers_.pop(title)
+        arxiv_id = paper.arxiv_id
+        if arxiv_id and self.arxiv_ids_.get(arxiv_id) == title:
+            del self.arxiv_ids_[arxiv_id]
+        if paper.url and self.urls_.get(paper.url) == title:
+            del self.urls_[paper.url]
+        for author in paper.authors:
+            self._unindex(self.authors_, author, title)
+        year = paper.publish_year
+        if year is not None and self._unindex(self.years_, year, title):
+            del self.sorted_years_[bisect.bisect_left(self.sorted_years_, year)]
+
+    @staticmethod
+    def _unindex(index: dict, key, title: str) -> bool:
+        """
+        Remove a title from the titles of a key of an index.
+
+        Returns:
+            bool: True if the key has no title left and was removed, False otherwise.
+        """
+        titles = index.get(key)
+        if titles is None or title not in titles:
+            return False
+        titles.remove(title)
+        if titles:
+            return False
+        del index[key]
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.papers_)
+
+    def __len__(self) -> int:
+        return len(self.papers_)
+
+    def __contains__(self, title) -> bool:
+        return title in self.papers_
+
+    def __repr__(self) -> str:
+        return f'PaperCatalog({len(self.papers_)} papers)'
+
+    def get_by_arxiv_id(self, arxiv_id: str) -> Paper | None:
+        """
+        Args:
+            arxiv_id (str): The arXiv ID, with or without its version, e.g. 2002.03419 or 2002.03419v2.
+
+        Returns:
+            Paper | None: The first paper added with this arXiv ID, or None if there is none.
+        """
+        title = self.arxiv_ids_.get(re.sub(r'v\d+$', '', arxiv_id))
+        return self.papers_[title] if title is not None else None
+
+    def get_by_url(self, url: str) -> Paper | None:
+        """
+        Returns:
+            Paper | None: The first paper added with this URL, or None if there is none or the URL is empty.
+        """
+        title = self.urls_.get(url) if url else None
+        return self.papers_[title] if title is not None else None
+
+    def find_duplicate(self, paper: Paper) -> Paper | None:
+        """
+        Find the paper of the catalog with the same title, arXiv ID or URL as a paper.
+
+        Returns:
+            Paper | None: The paper found, or None if the paper is new.
+        """
+        if paper.title in self.papers_:
+            return self.papers_[paper.title]
+        arxiv_id = paper.arxiv_id
+        return (self.get_by_arxiv_id(arxiv_id) if arxiv_id else None) or self.get_by_url(paper.url)
+
+    def by_author(self, author: str) -> List[Paper]:
+        """
+        Returns:
+            List[Paper]: The papers of the author, in the order added.
+        """
+        return [self.papers_[title] for title in self.authors_.get(author, ())]
+
+    def by_year(self, start: int, end: int | None = None) -> List[Paper]:
+        """
+        Get the papers published in a range of years.
+
+        Args:
+            start (int): The first year of the range.
+            end (int | None): The last year of the range, included. If None, then only the start year.
+
+        Returns:
+            List[Paper]: The papers published in the range, by ascending year.
+        """
+        return [self.papers_[title] for title in self._titles_by_year(start, start if end is None else end)]
+
+    def filter(self,
+               author: str | None = None,
+               start_year: int | None = None,
+               end_year: int | None = None) -> Dict[str, Paper]:
+        """
+        Get the papers matching all the given conditions, from the author index, else from the year index.
+
+        Args:
+            author (str | None): The author of the papers. If None, then any author.
+            start_year (int | None): The first year of the publications. If None, then unbounded.
+            end_year (int | None): The last year of the publications, included. If None, then unbounded.
+
+        Returns:
+            Dict[str, Paper]: The matching papers keyed by title.
+        """
+        if author is not None:
+            titles = self.authors_.get(author, [])
+        elif start_year is not None or end_year is not None:
+            titles = self._titles_by_year(start_year, end_year)
+        else:
+            return dict(self.papers_)
+        if author is not None and (start_year is not None or end_year is not None):
+            titles = [title for title in titles if self._in_years(self.papers_[title].publish_year, start_year, end_year)]
+        return {title: self.papers_[title] for title in titles}
+
+    @staticmethod
+    def _in_years(year: int | None, start: int | None, end: int | None) -> bool:
+        return year is not None and (start is None or start <= year) and (end is None or year <= end)
+
+    def _titles_by_year(self, start: int | None, end: int | None) -> List[str]:
+        begin = 0 if start is None else bisect.bisect_left(self.sorted_years_, start)
+        stop = len(self.sorted_years_) if end is None else bisect.bisect_right(self.sorted_years_, end)
+        return [title for year in self.sorted_years_[begin:stop] for title in self.years_[year]]
@@ -2,42 +2,68 @@ import openai
 from paper_source import PaperSource
 from paper_class import Paper
 from agents import Researcher
-from typing import List, Tuple
+import request_scheduler
+from tools import map_concurrently
+from token_budget import TokenBudget
+import tracing
+from typing import Dict, List, Tuple
 
 
 class PaperChat(object):
-    def __init__(self, paper_source: PaperSource):
+    def __init__(self,
+                 paper_source: PaperSource,
+                 max_concurrency: int = 1,
+                 token_budget: TokenBudget | None = None):
         """
         Initialize a PaperChat instance.
 
         Args:
             paper_source (PaperSource): A PaperSource object providing access to research papers.
+            max_concurrency (int): The max number of sources summarized concurrently.
+            token_budget (TokenBudget | None): Routes the prompts to the cheapest fitting model and packs the sources into it.
         """
         self.paper_source_: PaperSource = paper_source
         self.papers_: List[Paper] = paper_source.papers()
+        self.max_concurrency_: int = max_concurrency
+        self.token_budget_: TokenBudget = token_budget or TokenBudget()
+        # Researcher agents of each model the prompts may be routed to, and of each priority class:
+        # the answers of the queries go ahead of the bulk summarization.
+        self.researchers_: Dict[Tuple[str, int], Researcher] = {
+            (model, priority): Researcher(model=model, priority=priority)
+            for model in self.token_budget_.models_ for priority in (request_scheduler.INTERACTIVE, request_scheduler.BULK)}
+
+    def _researcher(self, user_input: str, priority: int = request_scheduler.BULK) -> Researcher:
+        return self.researchers_[(self.token_budget_.route(user_input, system_prompt=Researcher.role_), priority)]
 
     def query(self, **kwargs) -> Tuple[str, List[str]]:
         """
         Perform a query and provide an answer along with the relevant sources.
 
         Args:
-            **kwargs (dict): The args used by retrieve function of DocumentSource class.
+            **kwargs (dict): The args used by retrieve function of DocumentSource class,
+                and optionally on_token, a callback streaming the answer token by token as it arrives.
 
         Returns:
             tuple: A tuple containing the answer generated based on the query and a list of relevant source papers.
         """
+        on_token = kwargs.pop('on_token', None)
         user_query = kwargs['query']
-        print(f'Querying {user_query}')
+        tracing.log(f'Querying {user_query}')
 
         sources: List[Paper] = self.paper_source_.retrieve(**kwargs)
         user_input: str = f"{user_query} with the following paper contents as context for your reference:\n"
-        for source, score in sources:
+        # Keep the most relevant sources fitting in the largest context.
+        for index, source in self.token_budget_.pack(
+                prefix=user_input,
+                texts=[str(source) for source, score in sources],
+                scores=[score for source, score in sources],
+                system_prompt=Researcher.role_):
             user_input += f"{source}\n"
 
-        researcher: Researcher = Researcher(model='gpt-3.5-turbo-16k')
-        answer: str = researcher.query(user_input)  # Use this input to get the response
-        print('Answer: ', answer)
-        print('Sources: ', sources)
+        researcher: Researcher = self._researcher(user_input, request_scheduler.INTERACTIVE)
+        answer: str = researcher.query(user_input, on_token=on_token)  # Use this input to get the response
+        tracing.log('Answer: ', answer)
+        tracing.log('Sources: ', sources)
         return answer, sources
 
     def source_and_summarize(self, **kwargs) -> List[Paper]:
@@ -50,21 +76,42 @@ class PaperChat(object):
         Returns:
             list: A list of Paper objects with added summary information.
         """
-        user_query = kwargs['query']
-        print(f'Finding related works for {user_query}...')
-        sources: List[Paper] = self.paper_source_.retrieve(**kwargs)
-        if len(sources) == 0:
+        query = kwargs.pop('query')
+        return self.source_and_summarize_many([query], **kwargs)[0]
+
+    def source_and_summarize_many(self, queries: List[str], **kwargs) -> List[List[Paper]]:
+        """
+        Find and summarize related works for each of several user queries, retrieving them all with one search.
+
+        Args:
+            queries (List[str]): The user queries.
+            **kwargs (dict): The other args used by retrieve_many function of DocumentSource class.
+
+        Returns:
+            list: For each query, a list of Paper objects with added summary information.
+        """
+        for user_query in queries:
+            tracing.log(f'Finding related works for {user_query}...')
+        sources_list: List[List[Paper]] = self.paper_source_.retrieve_many(queries, **kwargs)
+        if any(len(sources) == 0 for sources in sources_list):
             raise ValueError('No sources found.')
-        agent: Researcher = Researcher(model='gpt-3.5-turbo')
-        for source, score in sources:
+        def summarize(query_and_source: tuple) -> str:
+            user_query, (source, score) = query_and_source
             user_input: str = f"Summarize the following paper contents with exactly ONE concise sentence for how it relates to {user_query}, " \
                              f"output it in the format of 'XXXXXXX (A Question/Method/Model/Concept/Results/Conclusion etc.) was proposed/raised/mentioned/analyzed/found " \
                              f"that XXXXX': {source.page_content}\nPlease do not mention 'this paper' or 'figure' or 'table' in the summary."
-            summary: str = agent.query(user_input)
-            print(summary)
+            with tracing.span('summarize', sources=1):
+                return self._researcher(user_input).query(user_input)
+
+        # The sources of all the queries are summarized together, sharing the concurrency.
+        queries_and_sources: List[tuple] = [(user_query, source)
+                                            for user_query, sources in zip(queries, sources_list) for source in sources]
+        summaries: List[str] = map_concurrently(summarize, queries_and_sources, self.max_concurrency_)
+        for (user_query, (source, score)), summary in zip(queries_and_sources, summaries):
+            tracing.log(summary)
             source.metadata['summary'] = summary  # Assuming you want to store the summary in source metadata
             source.metadata['score'] = score
-        return sources
+        return sources_list
 
 if __name__ == '__main__':
     from test_utils import get_test_papers
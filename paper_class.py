@@ -1,7 +1,10 @@
 import os
 import re
+import sys
+from datetime import datetime, timezone
 from typing import List, Union, Dict
 from tools import download_link
+import tracing
 import logging
 logging.basicConfig(level=logging.INFO)
 
@@ -13,8 +16,14 @@ LATEX_BIBLIOGRAPHY_TEMPLATE = """@misc{{{name},
 }}
 """
 
+# The arXiv ID in the URL of an arXiv abstract or PDF, without its version, e.g. 2002.03419 or hep-th/9901001.
+_ARXIV_URL_PATTERN = re.compile(r'arxiv\.org/(?:abs|pdf)/(.+?)(?:v\d+)?(?:\.pdf)?$')
+
 
 class Paper(object):
+    # Slots instead of a __dict__ per paper, so that a catalog of many papers stays small.
+    __slots__ = ('title', 'summary', 'url', 'authors', 'publish_date', 'on_arxiv')
+
     def __init__(self,
                  title: str,
                  summary: str,
@@ -36,13 +45,40 @@ class Paper(object):
         self.title: str = title
         self.summary: str = summary
         self.url: str = url
-        self.authors: List[str] = authors
+        # The same authors are shared by many papers, intern their names to store each only once.
+        self.authors: List[str] = [sys.intern(author) for author in authors]
         self.publish_date: Union[str, int, float] = publish_date
         self.on_arxiv: bool = on_arxiv
 
-    def download(self, folder: str = 'downloads', use_title: bool = False) -> str:
+    @property
+    def arxiv_id(self) -> str | None:
         """
-        Download the paper to a specified folder.
+        Returns:
+            str | None: The arXiv ID of the paper without its version, or None if its URL is not an arXiv one.
+        """
+        match = _ARXIV_URL_PATTERN.search(self.url)
+        return match.group(1) if match else None
+
+    @property
+    def publish_year(self) -> int | None:
+        """
+        A number below 10000 is taken as the year itself, a larger one as a POSIX timestamp.
+
+        Returns:
+            int | None: The year of the publication date, or None if it has none.
+        """
+        if hasattr(self.publish_date, 'year'):
+            return self.publish_date.year
+        if isinstance(self.publish_date, (int, float)) and not isinstance(self.publish_date, bool):
+            if abs(self.publish_date) < 10000:
+                return int(self.publish_date)
+            return datetime.fromtimestamp(self.publish_date, tz=timezone.utc).year
+        match = re.match(r'\d{4}', str(self.publish_date))
+        return int(match.group()) if match else None
+
+    def download_path(self, folder: str = 'downloads', use_title: bool = False) -> str:
+        """
+        Get the filepath the paper is downloaded to, creating the folder when missing.
 
         Args:
             folder (str, optional): The folder where the paper will be saved. Defaults to 'downloads'.
@@ -58,13 +94,26 @@ class Paper(object):
         else:
             file_name: str = url.split('/')[-1]
         os.makedirs(folder, exist_ok=True)
-        file_path: str = os.path.join(folder, file_name)
+        return os.path.join(folder, file_name)
+
+    def download(self, folder: str = 'downloads', use_title: bool = False) -> str:
+        """
+        Download the paper to a specified folder.
+
+        Args:
+            folder (str, optional): The folder where the paper will be saved. Defaults to 'downloads'.
+            use_title (bool, optional): Whether to use the paper's title as the filename. Defaults to False.
+
+        Returns:
+            str: The filepath where the paper is saved.
+        """
+        file_path: str = self.download_path(folder, use_title)
 
         # Check if the file already exists locally
         if os.path.exists(file_path):
-            print(f"The file '{file_path}' already exists locally.")
+            tracing.log(f"The file '{file_path}' already exists locally.")
         else:
-            download_link(url, file_path)
+            download_link(self.url, file_path)
 
         return file_path
 
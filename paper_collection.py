@@ -1,16 +1,38 @@
 import os
-from typing import Dict, List
+import json
+import time
+from datetime import datetime
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 import arxiv
+from langchain.docstore.document import Document
 from langchain.text_splitter import CharacterTextSplitter
 from paper_class import Paper
-from document_source import DocumentSource
+from paper_catalog import PaperCatalog
+from document_source import DocumentSource, corpus_collection_name
+from embedding_backends import create_embedding as create_embedding_backend, embedding_model_name
+from dedup import MinHashDeduplicator
+import tracing
+from langchain.embeddings.base import Embeddings
 
 
 class PaperCollection(object):
+    # The min number of words of an abstract checked for duplicates.
+    MIN_DEDUP_WORDS_: int = 20
+
     def __init__(self,
                  openai_api_key: str,
                  chunk_size: int = 2000,
-                 create_embedding: bool = True):
+                 create_embedding: bool = True,
+                 corpus_id: str | None = None,
+                 persist_directory: str | None = None,
+                 embedding: str | Embeddings = 'openai',
+                 vector_store: str = 'chroma',
+                 lexical_weight: float = 0.0,
+                 dedup_threshold: float | None = 0.9,
+                 vector_weight: float = 1.0,
+                 rrf_k: int = 60):
         """
         Initialize a PaperCollection instance.
 
@@ -18,11 +40,60 @@ class PaperCollection(object):
             openai_api_key (str): The API key for OpenAI.
             chunk_size (int, optional): The size (in characters) for splitting text chunks. Defaults to 2000.
             create_embedding (bool): Whether to create embeddings while adding the papers.
+            corpus_id (str | None): The identity of the corpus, e.g. the arXiv author query of a professor.
+                Together with chunk_size it names the persisted collection, defaults to the chunk size alone.
+            persist_directory (str | None): The directory to persist the abstract embeddings in.
+                If given, reopening the same corpus only embeds the papers not stored yet.
+            embedding (str | Embeddings): The embedding backend, 'openai', the local 'hashing', or an Embeddings object.
+            vector_store (str): The vector store backend, 'chroma', or 'numpy' keeping the vectors in one float32 matrix.
+            lexical_weight (float): The weight of the BM25 ranking fused with the vector ranking in the retrieval, 0 for pure vector retrieval.
+                With it, score_threshold only filters the vector candidates before the fusion, see DocumentSource.retrieve.
+            vector_weight (float): The weight of the vector ranking in the reciprocal rank fusion.
+            rrf_k (int): The rank offset of the reciprocal rank fusion, a larger one flattens the weights of the top ranks.
+            dedup_threshold (float | None): The min estimated Jaccard similarity of the abstract of a paper to the one of
+                a paper already added for it to be skipped as a duplicate, e.g. the same paper under another title.
+                The abstracts shorter than MIN_DEDUP_WORDS_ words are not compared.
+                If None, then only the papers with the same title are skipped.
+
+        With persist_directory, the papers added and the watermarks of sync_from_arxiv are saved next to the embeddings,
+        and reloaded here, so that the next sync only fetches and embeds the newer papers.
         """
         self.create_embedding_ = create_embedding
-        self.papers: Dict[str, Paper] = {}
-        self.document_source_: DocumentSource = DocumentSource(openai_api_key)
+        # The papers keyed by title, also indexed by arXiv ID, URL, author and publish year.
+        self.papers: PaperCatalog = PaperCatalog()
+        self.deduplicator_: MinHashDeduplicator | None = None
+        if dedup_threshold is not None:
+            self.deduplicator_ = MinHashDeduplicator(threshold=dedup_threshold)
+        # The name of the persisted collection, None when the collection only lives in memory.
+        self.collection_name_: str | None = None
+        embedding = create_embedding_backend(embedding, openai_api_key)
+        if persist_directory:
+            self.collection_name_ = corpus_collection_name(
+                prefix='papercollection',
+                keys=[f'corpus_id={corpus_id}', f'chunk_size={chunk_size}', f'embedding={embedding_model_name(embedding)}'],
+            )
+        self.document_source_: DocumentSource = DocumentSource(
+            openai_api_key,
+            collection_name=self.collection_name_,
+            persist_directory=persist_directory,
+            embedding=embedding,
+            vector_store=vector_store,
+            lexical_weight=lexical_weight,
+            vector_weight=vector_weight,
+            rrf_k=rrf_k,
+            dedup_threshold=dedup_threshold,
+        )
         self.text_splitter_: CharacterTextSplitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+        # The last published date and the IDs published then, seen by sync_from_arxiv for each query.
+        self.watermarks_: Dict[str, Dict[str, Any]] = {}
+        # The papers added are appended to a JSON lines log, and the watermarks are saved apart after each sync,
+        # so that a sync only writes its new papers instead of the whole collection.
+        self.papers_path_: str | None = None
+        self.watermarks_path_: str | None = None
+        if persist_directory:
+            self.papers_path_ = os.path.join(persist_directory, f'{self.collection_name_}-papers.jsonl')
+            self.watermarks_path_ = os.path.join(persist_directory, f'{self.collection_name_}-watermarks.json')
+            self._load_sync_state()
 
     def get_paper(self, title: str) -> Paper:
         """
@@ -46,18 +117,128 @@ class PaperCollection(object):
         Args:
             paper (Paper): The paper to add.
         """
-        print(f"Adding paper {paper.title} to the collection...")
-        if paper.title in self.papers:
-            print(f"Paper {paper.title} already exists in the collection.")
-            return
+        self.add_papers([paper])
+
+    def add_papers(self,
+                   papers: Iterable[Paper],
+                   batch_size: int = 1000,
+                   download: bool = False,
+                   download_workers: int = 8) -> List[Paper]:
+        """
+        Add papers to the collection, consumed one at a time, e.g. from a stream of search results.
+        The chunks of consecutive papers are accumulated and embedded together, one batch of at most
+        batch_size chunks at a time, instead of one embedding request per paper.
+
+        Args:
+            papers (Iterable[Paper]): The papers to add.
+            batch_size (int): The max number of chunks embedded in one batch.
+            download (bool): Whether to download the PDFs of the papers added, concurrently with the embedding.
+            download_workers (int): The number of threads downloading the PDFs.
 
+        Returns:
+            List[Paper]: The papers added, without the ones already in the collection.
+
+        Raises:
+            ValueError: when batch_size <= 0.
+        """
+        if batch_size <= 0:
+            raise ValueError(f"Invalid batch size: {batch_size}")
+        added: List[Paper] = []
+        batch: List[Document] = []
+        # The papers whose chunks are not all stored yet, with the number of chunks collected up to their last one.
+        unstored: Deque[Tuple[Paper, int]] = deque()
+        num_chunks = 0
+        num_stored = 0
+        downloads: Dict[str, Future] = {}
+        downloader = ThreadPoolExecutor(max_workers=download_workers) if download else None
+        try:
+            for paper in papers:
+                if not self._register_paper(paper):
+                    continue
+                added.append(paper)
+                if downloader is not None:
+                    downloads[paper.title] = downloader.submit(paper.download, use_title=True)
+                if not self.create_embedding_:
+                    continue
+                docs = self._paper_documents(paper)
+                batch.extend(docs)
+                num_chunks += len(docs)
+                unstored.append((paper, num_chunks))
+                while len(batch) >= batch_size:
+                    self._embed_batch(batch[:batch_size], len(added))
+                    batch = batch[batch_size:]
+                    num_stored += batch_size
+                    while unstored and unstored[0][1] <= num_stored:
+                        unstored.popleft()
+            if batch:
+                self._embed_batch(batch, len(added))
+        except BaseException:
+            # Unregister the papers not fully stored, e.g. when a batch fails to embed, so that adding them again
+            # stores them instead of skipping them as duplicates. Their chunks already stored are skipped by id.
+            for paper, _ in unstored:
+                self._unregister_paper(paper)
+            # Log the papers stored before the failure, so that they are still in the collection after a restart.
+            unstored_titles = {paper.title for paper, _ in unstored}
+            self._append_papers([paper for paper in added if paper.title not in unstored_titles])
+            raise
+        finally:
+            if downloader is not None:
+                downloader.shutdown(wait=True)
+        for title, future in downloads.items():
+            if future.exception() is not None:
+                tracing.log(f"Failed to download paper {title}: {future.exception()}")
+        self._append_papers(added)
+        tracing.log(f"Added {len(added)} papers to the collection.")
+        return added
+
+    def _register_paper(self, paper: Paper) -> bool:
+        """
+        Add a paper to the catalog of the collection, unless it duplicates a paper of the collection.
+
+        Returns:
+            bool: True if the paper was added, False if it is a duplicate.
+        """
+        tracing.log(f"Adding paper {paper.title} to the collection...")
+        duplicated_paper = self.papers.find_duplicate(paper)
+        if duplicated_paper is not None:
+            tracing.log(f"Paper {paper.title} already exists in the collection as {duplicated_paper.title}.")
+            return False
+        if self._dedups_abstract(paper):
+            duplicated_title = self.deduplicator_.add(paper.summary, paper.title)
+            if duplicated_title is not None:
+                tracing.log(f"Paper {paper.title} duplicates paper {duplicated_title} of the collection, skipped.")
+                return False
         self.papers[paper.title] = paper
-        if not self.create_embedding_:
-            return
+        return True
+
+    def _dedups_abstract(self, paper: Paper) -> bool:
+        """
+        Returns:
+            bool: Whether the abstract of a paper is checked for duplicates, only when it is long enough to identify
+                the paper. An empty or placeholder abstract, e.g. of a paper added by hand, would duplicate every other one.
+        """
+        return self.deduplicator_ is not None and len(paper.summary.split()) >= self.MIN_DEDUP_WORDS_
+
+    def _unregister_paper(self, paper: Paper):
+        """
+        Remove a registered paper from the catalog and the deduplicator of the collection.
+        """
+        del self.papers[paper.title]
+        if self._dedups_abstract(paper):
+            self.deduplicator_.remove(paper.summary)
+
+    def _paper_documents(self, paper: Paper) -> List[Document]:
         docs = self.text_splitter_.create_documents([f'Title: {paper.title}\nAbstract: {paper.summary}'])
         for doc in docs:
             doc.metadata['source'] = paper.title
+        return docs
+
+    def _embed_batch(self, docs: List[Document], num_papers_added: int):
+        start_time = time.perf_counter()
         self.document_source_.add_documents(docs)
+        seconds = time.perf_counter() - start_time
+        tracing.log(f"Embedded a batch of {len(docs)} chunks in {seconds:.2f}s, {len(docs) / max(seconds, 1e-9):.1f} chunks/s, "
+                    f"{num_papers_added} papers added so far.")
 
     def add_paper_dict(self, paper_dict: Dict[str, Paper]):
         """
@@ -66,25 +247,34 @@ class PaperCollection(object):
         Args:
             paper_dict (Dict[str, Paper]): A dictionary of papers to add.
         """
-        self.papers.update(paper_dict)
-        for _, paper in paper_dict.items():
-            self.add_paper(paper)
+        self.add_papers(paper_dict.values())
 
     def add_from_arxiv(self,
                        search,
-                       download: bool = False):
+                       download: bool = False,
+                       page_size: int = 100,
+                       batch_size: int = 1000) -> List[Paper]:
         """
         Search for papers on arXiv and optionally download them.
+        The results are fetched one page at a time, and the papers of each page are added
+        while the next pages are still to fetch.
 
         Args:
             search: A container of arXiv search results.
             download (bool, optional): Whether to download the papers. Defaults to False.
+            page_size (int): The number of results fetched per arXiv API request.
+            batch_size (int): The max number of chunks embedded in one batch.
+
+        Returns:
+            List[Paper]: The papers added, without the ones already in the collection.
         """
-        output_directory: str = "arxiv_papers"
-        os.makedirs(output_directory, exist_ok=True)
+        return self.add_papers(self._arxiv_papers(search, page_size), batch_size=batch_size, download=download)
 
-        for result in search.results():
-            paper: Paper = Paper(
+    @staticmethod
+    def _arxiv_papers(search, page_size: int) -> Iterator[Paper]:
+        results = arxiv.Client(page_size=page_size).results(search) if isinstance(search, arxiv.Search) else search.results()
+        for result in results:
+            yield Paper(
                 title=result.title,
                 summary=result.summary,
                 url=result.pdf_url,
@@ -92,12 +282,136 @@ class PaperCollection(object):
                 publish_date=result.published,
                 on_arxiv=True,
             )
-            self.add_paper(paper)
-            if download:
-                paper.download(use_title=True)
+
+    def sync_from_arxiv(self,
+                        query: str | None = None,
+                        id_list: List[str] | None = None,
+                        download: bool = False,
+                        page_size: int = 100,
+                        batch_size: int = 1000) -> List[Paper]:
+        """
+        Add the papers published on arXiv since the last sync of the same query, e.g. the new papers of an author.
+        The results are fetched newest first and the fetching stops at the watermark of the query, the last published
+        date and IDs seen, so that a sync with no new paper costs a single page request.
+
+        Args:
+            query (str | None): The arXiv query, e.g. f'au:{professor.full_name_convert()}'.
+            id_list (List[str] | None): The arXiv IDs of the papers, the ones already in the collection are not fetched.
+                Without a query, only the IDs not in the collection are fetched, and no watermark is needed.
+            download (bool, optional): Whether to download the new papers. Defaults to False.
+            page_size (int): The number of results fetched per arXiv API request.
+            batch_size (int): The max number of chunks embedded in one batch.
+
+        Returns:
+            List[Paper]: The papers added by this sync.
+
+        Raises:
+            ValueError: when neither a query nor an ID list is given.
+        """
+        if not query and not id_list:
+            raise ValueError("No query nor ID list was provided.")
+        key = query if query else 'id_list=' + ','.join(sorted(id_list))
+        if id_list:
+            id_list = [arxiv_id for arxiv_id in id_list if self.papers.get_by_arxiv_id(arxiv_id) is None]
+            if not query and not id_list:
+                tracing.log(f"Synced {key}: all the papers are already in the collection.")
+                return []
+        no_watermark = {'published': None, 'ids': []}
+        watermark = self.watermarks_.get(key, no_watermark) if query else no_watermark
+        tracing.log(f"Syncing arXiv papers of {key} published since {watermark['published'] or 'ever'}...")
+        search = arxiv.Search(
+            query=query or '',
+            id_list=id_list or [],
+            sort_by=arxiv.SortCriterion.SubmittedDate,
+            sort_order=arxiv.SortOrder.Descending,
+        )
+        seen: List[Paper] = []
+        added = self.add_papers(
+            self._newer_papers(self._arxiv_papers(search, page_size), watermark, seen),
+            batch_size=batch_size,
+            download=download,
+        )
+        if query and seen:
+            published = max(paper.publish_date.isoformat() for paper in seen)
+            ids = [paper.arxiv_id for paper in seen if paper.publish_date.isoformat() == published]
+            if published == watermark['published']:
+                ids = sorted(set(ids) | set(watermark['ids']))
+            self.watermarks_[key] = {'published': published, 'ids': ids}
+            self._save_watermarks()
+        tracing.log(f"Synced {key}: {len(seen)} new results, {len(added)} papers added.")
+        return added
+
+    @staticmethod
+    def _newer_papers(papers: Iterator[Paper], watermark: Dict[str, Any], seen: List[Paper]) -> Iterator[Paper]:
+        """
+        Yield the papers, newest first, until the first one not newer than the watermark,
+        collecting them into seen.
+        """
+        for paper in papers:
+            published = paper.publish_date.isoformat()
+            if watermark['published'] is not None:
+                # The results are sorted by date, the next pages are not even fetched.
+                if published < watermark['published']:
+                    return
+                if published == watermark['published'] and paper.arxiv_id in watermark['ids']:
+                    continue
+            seen.append(paper)
+            yield paper
+
+    def _append_papers(self, papers: List[Paper]):
+        if not self.papers_path_ or not papers:
+            return
+        lines = [json.dumps({
+            'title': paper.title,
+            'summary': paper.summary,
+            'url': paper.url,
+            'authors': paper.authors,
+            'publish_date': paper.publish_date.isoformat() if isinstance(paper.publish_date, datetime) else paper.publish_date,
+            'on_arxiv': paper.on_arxiv,
+        }) + '\n' for paper in papers]
+        with open(self.papers_path_, 'a') as f:
+            f.write(''.join(lines))
+
+    def _save_watermarks(self):
+        if not self.watermarks_path_:
+            return
+        # Write to a temporary file first, so that a crash never leaves the watermarks half saved.
+        with open(f'{self.watermarks_path_}.tmp', 'w') as f:
+            json.dump(self.watermarks_, f)
+        os.replace(f'{self.watermarks_path_}.tmp', self.watermarks_path_)
+
+    def _load_sync_state(self):
+        records = []
+        if os.path.exists(self.papers_path_):
+            with open(self.papers_path_, 'rb+') as f:
+                data = f.read()
+                # Drop the last line left incomplete by a crash, so that the next papers are appended after a full line.
+                complete = data[:data.rfind(b'\n') + 1]
+                if len(complete) < len(data):
+                    f.truncate(len(complete))
+            records = [json.loads(line) for line in complete.decode('utf-8').splitlines()]
+        if records and not self.document_source_.num_docs_ and self.create_embedding_:
+            # The embeddings were deleted, sync again from scratch to embed the papers again.
+            tracing.log(f"Ignoring the synced papers {self.papers_path_}, the collection has no embedding.")
+            return
+        if os.path.exists(self.watermarks_path_):
+            with open(self.watermarks_path_) as f:
+                self.watermarks_ = json.load(f)
+        for record in records:
+            if isinstance(record['publish_date'], str):
+                try:
+                    record['publish_date'] = datetime.fromisoformat(record['publish_date'])
+                except ValueError:
+                    pass
+            paper = Paper(**record)
+            self.papers[paper.title] = paper
+            if self._dedups_abstract(paper):
+                self.deduplicator_.add(paper.summary, paper.title)
+        if records:
+            tracing.log(f"Loaded {len(self.papers)} papers of the collection from {self.papers_path_}.")
 
     def latex_bibliography(self) -> list:
-        return [paper.get_latex_citation() for title, paper in self.papers.items()]
+        return [paper.get_latex_citation() for paper in self.papers.values()]
 
     def query_papers(self, **kwargs) -> dict[str, Paper]:
         """
@@ -109,20 +423,57 @@ class PaperCollection(object):
         Returns:
             Dict[str, Paper]: A dictionary of papers related to the topic.
         """
-        print(f"Sourcing the papers related to with query {str(kwargs)}...")
+        query = kwargs.pop('query')
+        return self.retrieve_many([query], **kwargs)[0]
+
+    def retrieve_many(self, queries: List[str], **kwargs) -> List[dict[str, Paper]]:
+        """
+        Retrieve the papers related to each of several queried topics, embedding all the queries in one request.
+
+        Args:
+            queries (List[str]): The queried topics.
+            **kwargs (dict): The other args used by retrieve_many function of DocumentSource class, shared by all the queries.
+
+        Returns:
+            List[Dict[str, Paper]]: For each query, a dictionary of papers related to the topic.
+        """
+        tracing.log(f"Sourcing the papers related to with queries {queries} and {str(kwargs)}...")
         if len(self.papers) == 0:
             raise ValueError("The paper collection is empty.")
 
-        source_documents = self.document_source_.retrieve(**kwargs)
+        paper_dicts = []
+        for source_documents in self.document_source_.retrieve_many(queries, **kwargs):
+            paper_dict = {}
+            for doc, score in source_documents:
+                title = doc.metadata['source']
+                # The chunks of a paper unregistered after some of them were stored belong to no paper.
+                if title not in paper_dict and title in self.papers:
+                    tracing.log(f"Found paper with score {score:.2f}: {title};")
+                    paper_dict[title] = self.papers[title]
+            paper_dicts.append(paper_dict)
 
-        paper_dict = {}
-        for doc, score in source_documents:
-            title = doc.metadata['source']
-            if title not in paper_dict:
-                print(f"Found paper with score {score:.2f}: {title};")
-                paper_dict[title] = self.papers[title]
+        return paper_dicts
 
-        return paper_dict
+    def rank_papers(self, query: str) -> Dict[str, Paper]:
+        """
+        Order the papers of the collection by the relevance of their abstracts to a query,
+        e.g. to index the full texts of the most relevant papers first.
+
+        Args:
+            query (str): The query the abstracts are ranked against, e.g. the research interests.
+
+        Returns:
+            Dict[str, Paper]: All the papers keyed by title, the ones related to the query first by descending relevance,
+                then the others in the order of the collection.
+        """
+        if len(self.papers) == 0:
+            return {}
+        ranked_papers: Dict[str, Paper] = self.query_papers(
+            query=query,
+            num_retrieval=max(self.document_source_.num_docs_, 1),
+            score_threshold=0.0,
+        )
+        return {**ranked_papers, **self.papers}
 
 if __name__ == '__main__':
     from test_utils import get_test_papers
@@ -1,33 +1,101 @@
-import functools
+import json
+import uuid
 import openai
 from langchain.docstore.document import Document
 from paper_source import PaperSource
 from paper_class import Paper
 from paper_collection import PaperCollection
+from document_source import corpus_collection_name
+from langchain.embeddings.base import Embeddings
+from embedding_backends import create_embedding, embedding_model_name
 from agents import Researcher
-from typing import List, Tuple
+import request_scheduler
+from tools import map_concurrently
+from token_budget import TokenBudget
+import tracing
+from typing import Dict, List, Tuple
 
 
 class PaperCollectionChat(object):
     def __init__(self,
                  paper_collection: PaperCollection,
                  openai_api_key: str,
-                 ignore_references: bool = True):
+                 ignore_references: bool = True,
+                 persist_directory: str | None = None,
+                 max_concurrency: int = 1,
+                 summarize_batch_size: int = 1,
+                 summarize_batch_tokens: int = 3000,
+                 token_budget: TokenBudget | None = None,
+                 prefetch_workers: int = 0,
+                 embedding: str | Embeddings = 'openai',
+                 vector_store: str = 'chroma',
+                 lexical_weight: float = 0.0,
+                 vector_weight: float = 1.0,
+                 rrf_k: int = 60):
         """
         Initialize a PaperChat instance.
 
         Args:
             paper_source (PaperSource): A PaperSource object providing access to research papers.
+            persist_directory (str | None): The directory to persist the full-text embeddings of the papers in.
+            max_concurrency (int): The max number of sources summarized concurrently.
+            summarize_batch_size (int): The max number of sources summarized in one request. 1 sends a request per source.
+            summarize_batch_tokens (int): The max total tokens of the sources summarized in one request.
+            token_budget (TokenBudget | None): Routes the prompts to the cheapest fitting model and packs the sources into it.
+            prefetch_workers (int): The number of background threads indexing the full text of the papers given to prefetch.
+            embedding (str | Embeddings): The embedding backend of the full-text index, 'openai', the local 'hashing', or an Embeddings object.
+            vector_store (str): The vector store backend of the full-text index, 'chroma', or 'numpy' keeping the vectors in one float32 matrix.
+            lexical_weight (float): The weight of the BM25 ranking fused with the vector ranking in the retrieval, 0 for pure vector retrieval.
+                With it, score_threshold only filters the vector candidates before the fusion, see DocumentSource.retrieve.
+            vector_weight (float): The weight of the vector ranking in the reciprocal rank fusion.
+            rrf_k (int): The rank offset of the reciprocal rank fusion, a larger one flattens the weights of the top ranks.
         """
         self.paper_collection_ = paper_collection
-        self.paper_source_ = functools.partial(PaperSource,
+        embedding = create_embedding(embedding, openai_api_key)
+        # An in-memory index gets a random name, so that it is never shared with another chat.
+        collection_name = corpus_collection_name(
+            prefix='fulltext',
+            keys=[f'collection={paper_collection.collection_name_}', f'ignore_references={ignore_references}',
+                  f'embedding={embedding_model_name(embedding)}']
+            if persist_directory else [str(uuid.uuid4())],
+        )
+        # The full-text chunk index shared by all the papers of the collection, growing as they are queried or prefetched.
+        self.full_text_source_: PaperSource = PaperSource(
+            papers={},
             openai_api_key=openai_api_key,
             ignore_references=ignore_references,
+            persist_directory=persist_directory,
+            collection_name=collection_name,
+            prefetch_workers=prefetch_workers,
+            embedding=embedding,
+            vector_store=vector_store,
+            lexical_weight=lexical_weight,
+            vector_weight=vector_weight,
+            rrf_k=rrf_k,
         )
-        self.paper_source_dict_ = {}
-        # Researcher agents
-        self.large_researcher_: Researcher = Researcher(model='gpt-3.5-turbo-16k')
-        self.small_researcher_: Researcher = Researcher(model='gpt-3.5-turbo')
+        self.max_concurrency_: int = max_concurrency
+        self.summarize_batch_size_: int = summarize_batch_size
+        self.summarize_batch_tokens_: int = summarize_batch_tokens
+        self.token_budget_: TokenBudget = token_budget or TokenBudget()
+        # Researcher agents of each model the prompts may be routed to, and of each priority class:
+        # the answers of the queries go ahead of the bulk summarization.
+        self.researchers_: Dict[Tuple[str, int], Researcher] = {
+            (model, priority): Researcher(model=model, priority=priority)
+            for model in self.token_budget_.models_ for priority in (request_scheduler.INTERACTIVE, request_scheduler.BULK)}
+
+    def prefetch(self, query: str | None = None):
+        """
+        Index the full text of the papers of the collection in the background, so that the queries
+        only wait for the papers not indexed yet.
+
+        Args:
+            query (str | None): The papers whose abstracts are most related to this query are indexed first.
+                If None, then the papers are indexed in the order of the collection.
+        """
+        papers: Dict[str, Paper] = self.paper_collection_.rank_papers(query) if query else self.paper_collection_.papers
+        if len(papers) == 0:
+            return
+        self.full_text_source_.prefetch(papers)
 
     def _source(self, **kwargs) -> list[(Document, int)]:
         """
@@ -40,27 +108,54 @@ class PaperCollectionChat(object):
             list of tuple: A list of tuple containing the answer generated based on the qfuery
                 and a list of relevant source papers and the relevance score.
         """
-        papers: dict[str, Paper] = self.paper_collection_.query_papers(**kwargs)
+        query = kwargs.pop('query')
+        return self._source_many([query], **kwargs)[0]
+
+    def _source_many(self, queries: List[str], **kwargs) -> List[list]:
+        """
+        Find the relevant sources of each of several queries, embedding all the queries in one request.
+
+        Args:
+            queries (List[str]): The query strings.
+            **kwargs (dict): The other args used by retrieve_many function of DocumentSource class.
+                num_retrieval is the max number of papers, and of chunks of each paper, as when each paper had its own index.
+
+        Returns:
+            List[list]: For each query, a list of tuple of a relevant source and its relevance score.
+        """
+        paper_dicts: List[Dict[str, Paper]] = self.paper_collection_.retrieve_many(queries, **kwargs)
+        papers: Dict[str, Paper] = {title: paper for paper_dict in paper_dicts for title, paper in paper_dict.items()}
+        if len(papers) == 0:
+            return [[] for _ in queries]
+
+        # Index the papers not prefetched yet, and wait for the ones being prefetched.
+        self.full_text_source_.add_papers(papers)
+
+        # Search each query over its own papers, and rank the chunks of each paper on its own, as if each paper had its own
+        # index, so that num_retrieval, by default sqrt of the chunks of the paper, is the max number of chunks of each paper.
+        sources_list: List[list] = self.full_text_source_.retrieve_many(
+            queries, query_sources=[list(paper_dict) for paper_dict in paper_dicts], per_source=True, **kwargs)
 
-        complete_source_list: list = []
-        for title, paper in papers.items():
-            if title in self.paper_source_dict_:
-                print(f"Paper source for paper {title} already exists.")
-            else:
-                print(f"Creating paper source for paper {title}...")
-                self.paper_source_dict_[title] = self.paper_source_(
-                    papers={title: paper})
+        complete_source_lists: List[list] = []
+        for paper_dict, sources in zip(paper_dicts, sources_list):
+            paper_source_lists: Dict[str, list] = {title: [] for title in paper_dict}
+            for source in sources:
+                source_list: list | None = paper_source_lists.get(source[0].metadata['source'])
+                if source_list is not None:
+                    source_list.append(source)
 
-            source_list: list = self.paper_source_dict_[title].retrieve(**kwargs)
-            if len(source_list) > 1:
-                concat_source = source_list[0]
-                concat_source[0].page_content = '\n\n'.join([source[0].page_content for source in source_list])
-                source_list = [concat_source]
-                print(f'Sources are concatenated into {source_list}')
+            complete_source_list: list = []
+            for title, source_list in paper_source_lists.items():
+                if len(source_list) > 1:
+                    concat_source = source_list[0]
+                    concat_source[0].page_content = '\n\n'.join([source[0].page_content for source in source_list])
+                    source_list = [concat_source]
+                    tracing.log(f'Sources are concatenated into {source_list}')
 
-            complete_source_list += source_list
+                complete_source_list += source_list
+            complete_source_lists.append(complete_source_list)
 
-        return complete_source_list
+        return complete_source_lists
         
 
     def query(self, **kwargs) -> Tuple[str, List[str]]:
@@ -68,37 +163,92 @@ class PaperCollectionChat(object):
         Perform a query and provide an answer along with the relevant sources.
 
         Args:
-            **kwargs (dict): The args used by retrieve function of DocumentSource class.
+            **kwargs (dict): The args used by retrieve function of DocumentSource class,
+                and optionally on_token, a callback streaming the answer token by token as it arrives.
 
         Returns:
             tuple: A tuple containing the answer generated based on the query and a list of relevant source papers.
         """
+        on_token = kwargs.pop('on_token', None)
         user_query = kwargs['query']
-        print(f'Querying {user_query}')
+        tracing.log(f'Querying {user_query}')
 
         sources: List[(Document, int)] = self._source(**kwargs)
         user_input: str = f"{user_query} with the following paper contents as context for your reference:\n"
-        for source, score in sources:
+        # Keep the most relevant sources fitting in the largest context.
+        for index, source in self.token_budget_.pack(
+                prefix=user_input,
+                texts=[str(source) for source, score in sources],
+                scores=[score for source, score in sources],
+                system_prompt=Researcher.role_):
             user_input += f"{source}\n"
 
-        researcher: Researcher = Researcher(model='gpt-3.5-turbo-16k')
-        answer: str = researcher.query(user_input)  # Use this input to get the response
-        print('Answer: ', answer)
-        print('Sources: ', sources)
+        researcher: Researcher = self._researcher(user_input, request_scheduler.INTERACTIVE)
+        answer: str = researcher.query(user_input, on_token=on_token)  # Use this input to get the response
+        tracing.log('Answer: ', answer)
+        tracing.log('Sources: ', sources)
         return answer, sources
 
+    def _researcher(self, user_input: str, priority: int = request_scheduler.BULK) -> Researcher:
+        return self.researchers_[(self.token_budget_.route(user_input, system_prompt=Researcher.role_), priority)]
+
     def _summarize(self, user_query: str, source: str) -> str:
-        user_input: str = f"Summarize the following paper contents with exactly ONE concise sentence for how it relates to {user_query}, " \
-                            f"output it in the format of 'XXXXXXX (A Question/Method/Model/Concept/Results/Conclusion etc.) was proposed/raised/mentioned/analyzed/found " \
-                            f"that XXXXX': {source}\nPlease do not mention 'this paper' or 'figure' or 'table' in the summary."
-        len_user_input = len(user_input)
-        if len_user_input < 10000:
-            print(f"length of user input is {len_user_input}, employing small researcher...")
-            agent = self.small_researcher_
-        else:
-            print(f"length of user input is {len_user_input}, employing large researcher...")
-            agent = self.large_researcher_
-        return agent.query(user_input)
+        def prompt(source: str) -> str:
+            return f"Summarize the following paper contents with exactly ONE concise sentence for how it relates to {user_query}, " \
+                   f"output it in the format of 'XXXXXXX (A Question/Method/Model/Concept/Results/Conclusion etc.) was proposed/raised/mentioned/analyzed/found " \
+                   f"that XXXXX': {source}\nPlease do not mention 'this paper' or 'figure' or 'table' in the summary."
+
+        # Trim a long concatenated source so that the prompt fits in the largest context.
+        packed = self.token_budget_.pack(prefix=prompt(''), texts=[source], scores=[1.0], system_prompt=Researcher.role_)
+        user_input: str = prompt(packed[0][1] if packed else '')
+        return self._researcher(user_input).query(user_input)
+
+    def _summarize_batch(self, user_query: str, sources: List[str]) -> List[str]:
+        """
+        Summarize several sources in one request, sharing the instruction prefix between them.
+
+        Args:
+            user_query (str): The query the summaries relate to.
+            sources (List[str]): The contents of the sources.
+
+        Returns:
+            List[str]: The summaries in the order of sources. When the response cannot be parsed
+                into one summary per source, the sources are summarized one request each instead.
+        """
+        if len(sources) == 1:
+            return [self._summarize(user_query=user_query, source=sources[0])]
+        numbered_sources: str = '\n\n'.join([f"[{index + 1}] {source}" for index, source in enumerate(sources)])
+        user_input: str = f"Summarize each of the following {len(sources)} numbered paper contents with exactly ONE concise sentence for how it relates to {user_query}, " \
+                            f"output each in the format of 'XXXXXXX (A Question/Method/Model/Concept/Results/Conclusion etc.) was proposed/raised/mentioned/analyzed/found " \
+                            f"that XXXXX'. Please do not mention 'this paper' or 'figure' or 'table' in the summaries. " \
+                            f"Return ONLY a JSON list of {len(sources)} strings, the i-th string being the summary of the paper contents [i]:\n{numbered_sources}"
+        response: str = self._researcher(user_input).query(user_input)
+        try:
+            summaries = json.loads(response[response.index('['):response.rindex(']') + 1])
+        except ValueError:
+            summaries = None
+        if not isinstance(summaries, list) or len(summaries) != len(sources) \
+                or not all(isinstance(summary, str) for summary in summaries):
+            tracing.log(f"Failed to parse {len(sources)} summaries from the batched response, summarizing the sources one by one...")
+            return [self._summarize(user_query=user_query, source=source) for source in sources]
+        return summaries
+
+    def _batch(self, sources: List[str]) -> List[List[str]]:
+        """
+        Group consecutive sources into batches of at most summarize_batch_size sources and summarize_batch_tokens tokens.
+        A source longer than summarize_batch_tokens makes a batch of its own.
+        """
+        batches: List[List[str]] = []
+        batch_tokens: int = 0
+        for source in sources:
+            num_tokens: int = self.token_budget_.count(source)
+            if not batches or len(batches[-1]) >= self.summarize_batch_size_ \
+                    or batch_tokens + num_tokens > self.summarize_batch_tokens_:
+                batches.append([])
+                batch_tokens = 0
+            batches[-1].append(source)
+            batch_tokens += num_tokens
+        return batches
 
     def source_and_summarize(self, **kwargs) -> List[tuple]:
         """
@@ -111,20 +261,43 @@ class PaperCollectionChat(object):
             list of tuple: A list of tuple containing Document objects with added summary information
                 and relevance score.
         """
-        user_query = kwargs['query']
-        print(f'Finding related works for {user_query}...')
-        sources: List[(Document, int)] = self._source(**kwargs)
-        if len(sources) == 0:
+        query = kwargs.pop('query')
+        return self.source_and_summarize_many([query], **kwargs)[0]
+
+    def source_and_summarize_many(self, queries: List[str], **kwargs) -> List[List[tuple]]:
+        """
+        Find and summarize related works for each of several user queries, retrieving them all with one search.
+
+        Args:
+            queries (List[str]): The user queries.
+            **kwargs (dict): The other args used by retrieve_many function of DocumentSource class.
+
+        Returns:
+            list: For each query, a list of tuple containing Document objects with added summary information
+                and relevance score.
+        """
+        for user_query in queries:
+            tracing.log(f'Finding related works for {user_query}...')
+        sources_list: List[List[(Document, int)]] = self._source_many(queries, **kwargs)
+        if any(len(sources) == 0 for sources in sources_list):
             raise ValueError('No sources found.')
-        for source, score in sources:
-            summary: str = self._summarize(
-                user_query=user_query,
-                source=source.page_content,
-            )
-            print(summary)
+        # The batches of all the queries are summarized together, sharing the concurrency.
+        query_batches: List[Tuple[str, List[str]]] = [
+            (user_query, batch)
+            for user_query, sources in zip(queries, sources_list)
+            for batch in self._batch([source.page_content for source, score in sources])]
+        tracing.log(f"Summarizing {sum(len(sources) for sources in sources_list)} sources in {len(query_batches)} requests...")
+        def summarize(query_batch: Tuple[str, List[str]]) -> List[str]:
+            with tracing.span('summarize', sources=len(query_batch[1])):
+                return self._summarize_batch(user_query=query_batch[0], sources=query_batch[1])
+
+        batch_summaries: List[List[str]] = map_concurrently(summarize, query_batches, self.max_concurrency_)
+        summaries: List[str] = [summary for batch in batch_summaries for summary in batch]
+        for (source, score), summary in zip([source for sources in sources_list for source in sources], summaries):
+            tracing.log(summary)
             source.metadata['summary'] = summary  # Assuming you want to store the summary in source metadata
             source.metadata['score'] = score
-        return sources
+        return sources_list
 
 
 if __name__ == '__main__':
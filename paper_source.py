@@ -1,36 +1,274 @@
+import time
+import threading
+import multiprocessing
 from typing import Dict, List
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from langchain.docstore.document import Document
 from langchain.document_loaders import PyPDFLoader
 from langchain.text_splitter import CharacterTextSplitter
 from tools import *
+import tracing
 from paper_class import Paper
-from document_source import DocumentSource
+from document_source import DocumentSource, corpus_collection_name
+from embedding_backends import create_embedding, embedding_model_name
+from langchain.embeddings.base import Embeddings
+
+
+def split_pdf(pdf_path: str, title: str, ignore_references: bool = True, ignore_appendices: bool = False) -> List[Document]:
+    """
+    Extract the content of a downloaded PDF and split it into text chunks.
+
+    It is a module-level function so that it can run in a worker process.
+
+    Args:
+        pdf_path (str): The filepath of the PDF.
+        title (str): The title of the paper, assigned as the source of each chunk.
+        ignore_references (bool): Whether to ignore the reference section. It is cut out of the pages before splitting,
+            or if no reference heading is found, the chunks containing arXiv references are dropped.
+        ignore_appendices (bool): Whether to also ignore the appendices following the reference section.
+
+    Returns:
+        List[Document]: A list of Document objects, each containing a text chunk with metadata.
+    """
+    tracing.log(f"Loading PDF: {pdf_path}")
+
+    # Load the PDF content.
+    with tracing.span('parse', title=title) as attributes:
+        loader = PyPDFLoader(pdf_path)
+        pdf = loader.load()
+        attributes['pages'] = len(pdf)
+    tracing.log(f"Extracting & splitting text from paper: {title}")
+
+    with tracing.span('split', title=title) as attributes:
+        # Cut the reference section once per document, so that none of its chunks is embedded.
+        num_skipped = 0
+        if ignore_references:
+            pages, num_skipped = strip_reference_section([page.page_content for page in pdf], ignore_appendices)
+            for page, text in zip(pdf, pages):
+                page.page_content = text
+            attributes['skipped_chars'] = num_skipped
+            if num_skipped:
+                num_chars = sum(len(text) for text in pages) + num_skipped
+                tracing.log(f"Skipped the reference section of {title}: {num_skipped} of {num_chars} characters.")
+
+        # Initialize a text splitter.
+        text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+
+        # Split the PDF into text chunks (list of Document objects).
+        docs = text_splitter.split_documents(pdf)
+        attributes['chunks'] = len(docs)
+
+    # Assign the same title to each chunk.
+    doc_list = []
+    for doc in docs:
+        # Filter out the reference chunks if choose to ignore them and no reference section was found.
+        if ignore_references and num_skipped == 0 and contains_arxiv_reference(doc.page_content):
+            tracing.log('The reference section is skipped.')
+            continue
+        doc.metadata['source'] = title
+        doc_list.append(doc)
+
+    return doc_list
+
+
+def _split_pdf_in_worker(pdf_path: str, title: str, ignore_references: bool = True, ignore_appendices: bool = False) -> tuple:
+    """
+    Run split_pdf in a worker process, collecting its spans to be recorded by the parent process.
+
+    Returns:
+        tuple: The chunks of the PDF, and the span records.
+    """
+    tracer = tracing.Tracer.current_
+    tracing.Tracer.current_ = tracing.CollectingTracer(verbose=tracer.verbose_)
+    try:
+        return split_pdf(pdf_path, title, ignore_references, ignore_appendices), tracing.Tracer.current_.records_
+    finally:
+        tracing.Tracer.current_ = tracer
 
 
 class PaperSource:
     def __init__(self, 
                  papers: Dict[str, Paper], 
                  openai_api_key: str,
-                 ignore_references: bool = True):
+                 ignore_references: bool = True,
+                 persist_directory: str | None = None,
+                 num_workers: int = 1,
+                 collection_name: str | None = None,
+                 prefetch_workers: int = 0,
+                 embedding: str | Embeddings = 'openai',
+                 vector_store: str = 'chroma',
+                 lexical_weight: float = 0.0,
+                 ignore_appendices: bool = False,
+                 vector_weight: float = 1.0,
+                 rrf_k: int = 60,
+                 dedup_threshold: float | None = 0.9,
+                 failure_cooldown: float = 600):
         """
         Initializes a PaperSource object with a dictionary of papers and an OpenAI API key.
 
         Args:
             papers (Dict[str, Paper]): A dictionary containing paper titles as keys and object of class Paper as values.
+                It may only be empty when collection_name is given, for an index growing with add_papers or prefetch.
             openai_api_key (str): The OpenAI API key for text embeddings.
-            ignore_references (bool): Whether to ignore the chunks containing references.
+            ignore_references (bool): Whether to ignore the reference section of the papers.
+            persist_directory (str | None): The directory to persist the chunk embeddings in.
+                If given, the collection is named after the papers, so that reopening the same papers
+                reuses the stored chunks instead of downloading, parsing and embedding them again.
+            num_workers (int): The number of worker processes parsing the PDFs, and of threads downloading them.
+                1 processes the papers one after another. Either way, the papers failed to download are skipped,
+                and indexed again by a later call.
+            collection_name (str | None): The name of the collection, e.g. of an index growing with add_papers.
+                If None, then it is derived from the papers when persisted, and random otherwise.
+            prefetch_workers (int): The number of background threads indexing the papers given to prefetch.
+                If > 0, then the papers are prefetched instead of indexed before returning, and
+                retrieve only waits for the papers not indexed yet.
+            embedding (str | Embeddings): The embedding backend, 'openai', the local 'hashing', or an Embeddings object.
+            vector_store (str): The vector store backend, 'chroma', or 'numpy' keeping the vectors in one float32 matrix.
+            lexical_weight (float): The weight of the BM25 ranking fused with the vector ranking in the retrieval, 0 for pure vector retrieval.
+                With it, score_threshold only filters the vector candidates before the fusion, see DocumentSource.retrieve.
+            vector_weight (float): The weight of the vector ranking in the reciprocal rank fusion.
+            rrf_k (int): The rank offset of the reciprocal rank fusion, a larger one flattens the weights of the top ranks.
+            ignore_appendices (bool): Whether to also ignore the appendices following the reference section.
+            dedup_threshold (float | None): The min estimated Jaccard similarity of a chunk to a stored one
+                for it to be skipped as a near duplicate. If None, then only the exact same chunks are skipped.
+            failure_cooldown (float): The seconds a paper failed to download is skipped for, instead of being
+                downloaded again by every retrieval, e.g. from a dead URL.
         """
-        if len(papers) == 0:
+        if len(papers) == 0 and collection_name is None:
             raise ValueError("No papers was provided.")
 
         self.ignore_references_ = ignore_references
-        self.papers_: Dict[str, Paper] = papers
+        self.ignore_appendices_ = ignore_appendices
+        self.num_workers_ = num_workers
+        self.prefetch_workers_ = prefetch_workers
+        self.papers_: Dict[str, Paper] = {}
+        # The indexing of each paper, done once its chunks are stored. Guarded by lock_.
+        self.indexed_: Dict[str, Future] = {}
+        # The time each paper last failed to download at. Guarded by lock_.
+        self.failures_: Dict[str, float] = {}
+        self.failure_cooldown_: float = failure_cooldown
+        self.lock_ = threading.Lock()
+        self.prefetcher_: ThreadPoolExecutor | None = None
+        embedding = create_embedding(embedding, openai_api_key)
+        if persist_directory and not collection_name:
+            collection_name = corpus_collection_name(
+                prefix='papersource',
+                keys=[f'{title}\x00{paper.url}' for title, paper in papers.items()] +
+                     [f'ignore_references={ignore_references}', f'embedding={embedding_model_name(embedding)}'] +
+                     (['ignore_appendices=True'] if ignore_appendices else []),
+            )
         self.document_source_ = DocumentSource(
             openai_api_key=openai_api_key,
+            collection_name=collection_name,
+            persist_directory=persist_directory,
+            embedding=embedding,
+            vector_store=vector_store,
+            lexical_weight=lexical_weight,
+            vector_weight=vector_weight,
+            rrf_k=rrf_k,
+            dedup_threshold=dedup_threshold,
         )
+        if prefetch_workers > 0:
+            self.prefetch(papers)
+        else:
+            self.add_papers(papers)
+
+    def add_papers(self, papers: Dict[str, Paper]):
+        """
+        Download, split and embed the papers not stored in the paper source yet,
+        and wait for the ones being indexed by another thread, e.g. the prefetcher.
+
+        Args:
+            papers (Dict[str, Paper]): A dictionary containing paper titles as keys and object of class Paper as values.
+        """
+        new_papers: Dict[str, Paper] = {}
+        pending: List[Future] = []
+        num_cooling = 0
+        with self.lock_:
+            self.papers_.update(papers)
+            for title, paper in papers.items():
+                if title in self.indexed_:
+                    pending.append(self.indexed_[title])
+                    continue
+                if time.monotonic() - self.failures_.get(title, float('-inf')) < self.failure_cooldown_:
+                    num_cooling += 1
+                    continue
+                self.indexed_[title] = Future()
+                if self.document_source_.contains_source(title):
+                    tracing.log(f"Paper {title} is already stored in the paper source.")
+                    self.indexed_[title].set_result(None)
+                else:
+                    new_papers[title] = paper
+        if num_cooling:
+            tracing.log(f"Skipping {num_cooling} papers failed to download less than {self.failure_cooldown_:.0f}s ago.")
+        try:
+            if self.num_workers_ > 1 and len(new_papers) > 1:
+                self._add_papers_parallel(new_papers, self.num_workers_)
+            else:
+                for title, paper in new_papers.items():
+                    try:
+                        docs = self._process_pdf(paper)  # Extract the PDF into chunks and append them to the doc_list.
+                    except ConnectionError as e:
+                        tracing.log(f"Skipping paper {title}: {e}")
+                        self._set_failed(title)
+                        continue
+                    self.document_source_.add_documents(docs)
+                    self._set_indexed(title)
+        finally:
+            # Release the waiters of the papers failed to index, a later call indexes them again.
+            with self.lock_:
+                for title in new_papers:
+                    if not self.indexed_[title].done():
+                        self.indexed_.pop(title).set_result(None)
+        if pending:
+            tracing.log(f"Waiting for {len(pending)} papers being indexed...")
+            wait(pending)
+
+    def prefetch(self, papers: Dict[str, Paper]):
+        """
+        Index the papers in the background, in the order of the dictionary, e.g. by descending priority.
+        Returns immediately, the papers are available to retrieve once indexed.
+
+        Args:
+            papers (Dict[str, Paper]): A dictionary containing paper titles as keys and object of class Paper as values.
+        """
+        with self.lock_:
+            self.papers_.update(papers)
+            if self.prefetcher_ is None:
+                self.prefetcher_ = ThreadPoolExecutor(max_workers=max(self.prefetch_workers_, 1))
+        tracing.log(f"Prefetching {len(papers)} papers in the background...")
         for title, paper in papers.items():
-            docs = self._process_pdf(paper)  # Extract the PDF into chunks and append them to the doc_list.
-            self.document_source_.add_documents(docs)
+            self.prefetcher_.submit(self._prefetch_paper, title, paper)
+
+    def close(self):
+        """
+        Stop the prefetcher, cancelling the papers not started yet and waiting for the ones being indexed.
+        """
+        with self.lock_:
+            prefetcher, self.prefetcher_ = self.prefetcher_, None
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> 'PaperSource':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _prefetch_paper(self, title: str, paper: Paper):
+        try:
+            self.add_papers({title: paper})
+        except Exception as e:
+            tracing.log(f"Failed to prefetch paper {title}: {e}")
+
+    def _set_indexed(self, title: str):
+        with self.lock_:
+            self.indexed_[title].set_result(None)
+            self.failures_.pop(title, None)
+
+    def _set_failed(self, title: str):
+        with self.lock_:
+            self.failures_[title] = time.monotonic()
 
     def papers(self) -> Dict[str, Paper]:
         """
@@ -53,43 +291,82 @@ class PaperSource:
         """
         # Download the PDF and obtain the file path.
         pdf_path = paper.download()
-        print(f"Loading PDF: {pdf_path}")
-        
-        # Load the PDF content.
-        loader = PyPDFLoader(pdf_path)
-        pdf = loader.load()
-        print(f"Extracting & splitting text from paper: {paper.title}")
-        
-        # Initialize a text splitter.
-        text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        
-        # Split the PDF into text chunks (list of Document objects).
-        docs = text_splitter.split_documents(pdf)
-        
-        # Assign the same title to each chunk.
-        doc_list = []
-        for doc in docs:
-            # Filter out reference sections if choose to ignore them.
-            if self.ignore_references_ and contains_arxiv_reference(doc.page_content):
-                print('The reference section is skipped.')
-                continue
-            doc.metadata['source'] = paper.title
-            doc_list.append(doc)
-        
-        return doc_list
+        return split_pdf(pdf_path, paper.title, self.ignore_references_, self.ignore_appendices_)
+
+    def _add_papers_parallel(self, papers: Dict[str, Paper], num_workers: int):
+        """
+        Download the papers in a thread pool, parse and split them in a process pool, and embed the chunks
+        of each paper as soon as they are ready, so that downloading, parsing and embedding overlap.
+
+        The worker processes are spawned rather than forked, as forking a process running other threads,
+        e.g. the prefetcher or the downloads, may copy locks held by those threads into the workers.
+
+        Args:
+            papers (Dict[str, Paper]): The papers to add, keyed by title.
+            num_workers (int): The number of download threads and of parsing processes.
+        """
+        tracing.log(f"Processing {len(papers)} papers with {num_workers} workers...")
+        with ThreadPoolExecutor(max_workers=num_workers) as downloader, \
+                ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as parser:
+            pending = {downloader.submit(paper.download): (title, 'download') for title, paper in papers.items()}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    title, stage = pending.pop(future)
+                    if stage == 'download':
+                        try:
+                            pdf_path = future.result()
+                        except ConnectionError as e:
+                            tracing.log(f"Skipping paper {title}: {e}")
+                            self._set_failed(title)
+                            continue
+                        pending[parser.submit(_split_pdf_in_worker, pdf_path, title,
+                                               self.ignore_references_, self.ignore_appendices_)] = (title, 'parse')
+                    else:
+                        docs, records = future.result()
+                        for record in records:
+                            tracing.Tracer.current_.record_span(**{key: value for key, value in record.items() if key != 'type'})
+                        self.document_source_.add_documents(docs)
+                        self._set_indexed(title)
 
     def retrieve(self, **kwargs) -> List[Document]:
         """
         Search for papers related to a query using text embeddings and cosine distance.
+        Waits for the searched papers still being prefetched, and indexes the ones not started yet.
 
         Args:
             query (str): The query string to search for related papers.
+            sources (List[str] | None): Only search the chunks of these paper titles. If None, then search all the papers.
 
         Returns:
             List[Document]: A list of Document objects representing the related papers found.
         """
+        with self.lock_:
+            titles = list(self.papers_) if kwargs.get('sources') is None else kwargs['sources']
+            papers = {title: self.papers_[title] for title in titles if title in self.papers_}
+        self.add_papers(papers)
         return self.document_source_.retrieve(**kwargs)
-    
+
+    def retrieve_many(self, queries: List[str], **kwargs) -> List[List[Document]]:
+        """
+        Search for the papers related to each of several queries, embedding all the queries in one request.
+        Waits for the searched papers still being prefetched, and indexes the ones not started yet.
+
+        Args:
+            queries (List[str]): The query strings to search for related papers.
+            **kwargs (dict): The other args used by retrieve_many function of DocumentSource class, shared by all the queries.
+
+        Returns:
+            List[List[Document]]: For each query, the related papers found.
+        """
+        with self.lock_:
+            if kwargs.get('query_sources') is not None:
+                titles = [title for sources in kwargs['query_sources'] for title in sources]
+            else:
+                titles = list(self.papers_) if kwargs.get('sources') is None else kwargs['sources']
+            papers = {title: self.papers_[title] for title in titles if title in self.papers_}
+        self.add_papers(papers)
+        return self.document_source_.retrieve_many(queries, **kwargs)
 
 if __name__ == '__main__':
     from test_utils import get_test_papers
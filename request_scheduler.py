@@ -0,0 +1,227 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+import openai
+from typing import Any, Callable, Dict, List, Tuple
+import tracing
+
+# The priority classes of the requests, the lower goes first.
+INTERACTIVE: int = 0
+BULK: int = 1
+
+# The requests and the tokens per minute of the models, e.g. of the OpenAI tier of the account.
+DEFAULT_LIMITS: Dict[str, Tuple[int, int]] = {
+    'gpt-3.5-turbo': (3500, 90000),
+    'gpt-3.5-turbo-16k': (3500, 180000),
+    'gpt-4': (200, 10000),
+    'gpt-4-32k': (200, 20000),
+    'text-embedding-ada-002': (3000, 1000000),
+}
+
+
+class TokenBucket(object):
+    """A bucket refilled continuously at a rate per minute, up to one minute of capacity."""
+
+    def __init__(self, rate_per_minute: float):
+        self.rate_: float = rate_per_minute / 60
+        self.capacity_: float = rate_per_minute
+        self.tokens_: float = rate_per_minute
+        self.updated_: float = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens_ = min(self.capacity_, self.tokens_ + (now - self.updated_) * self.rate_)
+        self.updated_ = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Returns:
+            float: The seconds until the amount is available, 0 if it is now.
+                An amount beyond the capacity is available once the bucket is full.
+        """
+        self._refill()
+        return max(min(amount, self.capacity_) - self.tokens_, 0.0) / self.rate_
+
+    def consume(self, amount: float):
+        """Take the amount out of the bucket, which may go below 0 to delay the next requests."""
+        self._refill()
+        self.tokens_ -= amount
+
+
+class RequestScheduler(object):
+    """Paces the OpenAI requests of the process under the requests and tokens per minute of each model.
+
+    The requests waiting for the buckets of a model are admitted by priority class, then in the order they arrived,
+    without waiting for the requests of the other models, and the requests failing with a rate limit or a server error are retried with a jittered exponential backoff.
+    """
+
+    # The scheduler all the agents and embeddings go through, e.g. replaced once at the start of a run.
+    current_: 'RequestScheduler'
+
+    def __init__(self,
+                 limits: Dict[str, Tuple[int, int]] | None = None,
+                 max_retries: int = 6,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        """
+        Args:
+            limits (Dict[str, Tuple[int, int]] | None): The requests and the tokens per minute of each model.
+                The models without limits are not paced, only retried. If None, then DEFAULT_LIMITS.
+            max_retries (int): The max number of retries of a failed request.
+            base_delay (float): The seconds before the first retry, doubled at each retry.
+            max_delay (float): The max seconds between two retries.
+        """
+        self.limits_: Dict[str, Tuple[int, int]] = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.max_retries_: int = max_retries
+        self.base_delay_: float = base_delay
+        self.max_delay_: float = max_delay
+        self.buckets_: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        # The waiting requests of each model as (priority, arrival, tokens), the first one of a model is admitted next.
+        self.queues_: Dict[str, List[Tuple[int, int, int]]] = {}
+        self.queue_depth_: int = 0
+        self.arrivals_ = itertools.count()
+        self.condition_ = threading.Condition()
+        self.num_requests_: int = 0
+        self.num_throttled_: int = 0
+        self.num_retries_: int = 0
+        self.wait_seconds_: float = 0.0
+        self.max_queue_depth_: int = 0
+
+    def call(self, model: str, tokens: int, function: Callable[[], Any], priority: int = BULK) -> Any:
+        """
+        Call a function sending a request to a model once the buckets of the model allow it,
+        and retry it when it fails with a rate limit or a server error.
+
+        Args:
+            model (str): The model of the request.
+            tokens (int): The estimated tokens of the request.
+            function (Callable[[], Any]): The function sending the request.
+            priority (int): The priority class of the request, INTERACTIVE or BULK.
+
+        Returns:
+            Any: The result of the function.
+
+        Raises:
+            openai.error.OpenAIError: when the request fails with another error, or still fails after the retries.
+        """
+        for attempt in range(self.max_retries_ + 1):
+            self._acquire(model, tokens, priority)
+            try:
+                return function()
+            except openai.error.OpenAIError as e:
+                if attempt == self.max_retries_ or not self._retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                with self.condition_:
+                    self.num_retries_ += 1
+                tracing.log(f"Request to {model} failed with {type(e).__name__}, retrying in {delay:.1f}s...")
+                time.sleep(delay)
+
+    def settle(self, model: str, tokens: int):
+        """
+        Take from the token bucket of a model the tokens of a request beyond its estimate, e.g. the completion tokens.
+        """
+        if model not in self.limits_ or tokens <= 0:
+            return
+        with self.condition_:
+            self._buckets(model)[1].consume(tokens)
+
+    def _acquire(self, model: str, tokens: int, priority: int):
+        if model not in self.limits_:
+            with self.condition_:
+                self.num_requests_ += 1
+            return
+        start_time = time.perf_counter()
+        entry = (priority, next(self.arrivals_), tokens)
+        with self.condition_:
+            queue = self.queues_.setdefault(model, [])
+            heapq.heappush(queue, entry)
+            self.queue_depth_ += 1
+            self.max_queue_depth_ = max(self.max_queue_depth_, self.queue_depth_)
+            throttled = False
+            try:
+                while True:
+                    wait_time = 0.0
+                    if queue[0] == entry:
+                        requests, token_bucket = self._buckets(model)
+                        wait_time = max(requests.wait_time(1), token_bucket.wait_time(tokens))
+                        if wait_time == 0:
+                            requests.consume(1)
+                            token_bucket.consume(tokens)
+                            heapq.heappop(queue)
+                            self.queue_depth_ -= 1
+                            break
+                    throttled = True
+                    # Wake up when the buckets refill, or when the head of the queue changes.
+                    self.condition_.wait(timeout=wait_time or None)
+            except BaseException:
+                # Never leave an interrupted request at the head of the queue, blocking the others.
+                queue.remove(entry)
+                heapq.heapify(queue)
+                self.queue_depth_ -= 1
+                self.condition_.notify_all()
+                raise
+            self.num_requests_ += 1
+            if throttled:
+                self.num_throttled_ += 1
+            self.wait_seconds_ += time.perf_counter() - start_time
+            self.condition_.notify_all()
+
+    def _buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self.buckets_:
+            requests_per_minute, tokens_per_minute = self.limits_[model]
+            self.buckets_[model] = (TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute))
+        return self.buckets_[model]
+
+    @staticmethod
+    def _retryable(error: openai.error.OpenAIError) -> bool:
+        # An exhausted quota is a rate limit error too, but no retry succeeds until it is raised.
+        if error.code == 'insufficient_quota':
+            return False
+        if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                              openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)):
+            return True
+        return isinstance(error, openai.error.APIError) and (error.http_status is None or error.http_status >= 500)
+
+    def _backoff(self, attempt: int, error: openai.error.OpenAIError) -> float:
+        # Full jitter, so that the requests throttled together do not retry together.
+        delay = random.uniform(0, min(self.max_delay_, self.base_delay_ * 2 ** attempt))
+        retry_after = (error.headers or {}).get('retry-after')
+        try:
+            return max(delay, float(retry_after)) if retry_after is not None else delay
+        except ValueError:
+            return delay
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of requests, of the ones throttled and of the retries, the seconds waited,
+                and the current and the max depths of the queue.
+        """
+        with self.condition_:
+            return {
+                'requests': self.num_requests_,
+                'throttled': self.num_throttled_,
+                'retries': self.num_retries_,
+                'wait_seconds': self.wait_seconds_,
+                'queue_depth': self.queue_depth_,
+                'queue_depth_by_priority': {priority: sum(entry[0] == priority
+                                                          for queue in self.queues_.values() for entry in queue)
+                                            for priority in (INTERACTIVE, BULK)},
+                'max_queue_depth': self.max_queue_depth_,
+            }
+
+
+RequestScheduler.current_ = RequestScheduler()
+
+
+def call(model: str, tokens: int, function: Callable[[], Any], priority: int = BULK) -> Any:
+    """Call a function sending a request to a model through the current scheduler."""
+    return RequestScheduler.current_.call(model, tokens, function, priority)
+
+
+def settle(model: str, tokens: int):
+    """Take the tokens of a request beyond its estimate from the buckets of the current scheduler."""
+    RequestScheduler.current_.settle(model, tokens)
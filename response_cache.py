@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+class ResponseCache(ABC):
+    """The interface of a cache of LLM responses keyed on the full request."""
+
+    def __init__(self, deterministic_only: bool = False):
+        """
+        Args:
+            deterministic_only (bool): Whether to only cache the requests with temperature 0,
+                whose responses are expected to be the same when asked again.
+        """
+        self.deterministic_only_: bool = deterministic_only
+        self.hits_: int = 0
+        self.misses_: int = 0
+        self.lock_ = threading.Lock()
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, Any]], temperature: float) -> str:
+        """
+        Compute the cache key of a request.
+
+        Args:
+            model (str): The name of the chat model.
+            messages (List[Dict[str, Any]]): The messages sent to the model, including the system role.
+            temperature (float): The sampling temperature.
+
+        Returns:
+            str: The hex sha256 digest of the request.
+        """
+        request = json.dumps({'model': model, 'messages': messages, 'temperature': temperature}, sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def cacheable(self, temperature: float) -> bool:
+        return not self.deterministic_only_ or temperature == 0
+
+    def lookup(self, model: str, messages: List[Dict[str, Any]], temperature: float) -> Optional[str]:
+        """
+        Look up the response of a request.
+
+        Returns:
+            Optional[str]: The cached response, None if it is not cached or the request is not cacheable.
+        """
+        if not self.cacheable(temperature):
+            return None
+        with self.lock_:
+            response = self._get(self.key(model, messages, temperature))
+            if response is None:
+                self.misses_ += 1
+            else:
+                self.hits_ += 1
+        return response
+
+    def store(self, model: str, messages: List[Dict[str, Any]], temperature: float, response: str):
+        """
+        Store the response of a request if the request is cacheable.
+        """
+        if not self.cacheable(temperature):
+            return
+        with self.lock_:
+            self._put(self.key(model, messages, temperature), response)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of hits, misses and the hit rate since this cache was created.
+        """
+        total = self.hits_ + self.misses_
+        return {
+            'hits': self.hits_,
+            'misses': self.misses_,
+            'hit_rate': self.hits_ / total if total else 0.0,
+        }
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[str]:
+        """
+        Returns:
+            Optional[str]: The response stored under the key, None if there is none.
+        """
+
+    @abstractmethod
+    def _put(self, key: str, response: str):
+        """Store a response under the key, replacing the one stored before."""
+
+
+class InMemoryResponseCache(ResponseCache):
+    """A ResponseCache living in the process memory, evicting the least recently used responses."""
+
+    def __init__(self, max_entries: int = 10000, deterministic_only: bool = False):
+        """
+        Args:
+            max_entries (int): The max number of cached responses.
+            deterministic_only (bool): Whether to only cache the requests with temperature 0.
+
+        Raises:
+            ValueError: when max_entries <= 0.
+        """
+        if max_entries <= 0:
+            raise ValueError(f"Invalid max entries: {max_entries}")
+        super().__init__(deterministic_only)
+        self.max_entries_: int = max_entries
+        self.responses_: OrderedDict = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        if key not in self.responses_:
+            return None
+        self.responses_.move_to_end(key)
+        return self.responses_[key]
+
+    def _put(self, key: str, response: str):
+        self.responses_[key] = response
+        self.responses_.move_to_end(key)
+        while len(self.responses_) > self.max_entries_:
+            self.responses_.popitem(last=False)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """A ResponseCache persisted in a SQLite file, with time-to-live and least-recently-used eviction."""
+
+    def __init__(self,
+                 path: str = os.path.join('cache', 'responses.sqlite'),
+                 ttl_seconds: float | None = None,
+                 max_entries: int = 100000,
+                 deterministic_only: bool = False):
+        """
+        Args:
+            path (str): The path of the SQLite file, created when missing.
+            ttl_seconds (float | None): The seconds a response stays valid after it was stored. If None, then it never expires.
+            max_entries (int): The max number of cached responses.
+            deterministic_only (bool): Whether to only cache the requests with temperature 0.
+
+        Raises:
+            ValueError: when max_entries <= 0 or ttl_seconds <= 0.
+        """
+        if max_entries <= 0:
+            raise ValueError(f"Invalid max entries: {max_entries}")
+        if ttl_seconds is not None and ttl_seconds <= 0:
+            raise ValueError(f"Invalid ttl seconds: {ttl_seconds}")
+        super().__init__(deterministic_only)
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path_: str = path
+        self.ttl_seconds_: float | None = ttl_seconds
+        self.max_entries_: int = max_entries
+        self.conn_ = sqlite3.connect(path, check_same_thread=False)
+        self.conn_.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)')
+        self.conn_.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.conn_.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self.conn_.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        response, created = row
+        now = time.time()
+        if self.ttl_seconds_ is not None and now - created > self.ttl_seconds_:
+            self.conn_.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.conn_.commit()
+            return None
+        self.conn_.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+        self.conn_.commit()
+        return response
+
+    def _put(self, key: str, response: str):
+        now = time.time()
+        self.conn_.execute('INSERT OR REPLACE INTO responses (key, response, created, last_access) VALUES (?, ?, ?, ?)',
+                           (key, response, now, now))
+        if self.ttl_seconds_ is not None:
+            self.conn_.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl_seconds_,))
+        num_entries = self.conn_.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if num_entries > self.max_entries_:
+            self.conn_.execute('DELETE FROM responses WHERE key IN '
+                               '(SELECT key FROM responses ORDER BY last_access LIMIT ?)',
+                               (num_entries - self.max_entries_,))
+        self.conn_.commit()
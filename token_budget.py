@@ -0,0 +1,131 @@
+import threading
+import tiktoken
+import tracing
+from typing import Dict, List, Sequence, Tuple
+
+# The context windows in tokens of the chat models, shared by the prompt and the completion.
+MODEL_CONTEXT_WINDOWS: Dict[str, int] = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+
+
+class TokenBudget(object):
+    """Counts the prompt tokens of the chat models, routes prompts to the cheapest model whose context fits,
+    and packs sources into the context by relevance score."""
+
+    # The tokens taken by the chat format around the system and the user messages.
+    MESSAGE_OVERHEAD_: int = 16
+
+    def __init__(self,
+                 models: Sequence[str] = ('gpt-3.5-turbo', 'gpt-3.5-turbo-16k'),
+                 completion_tokens: int = 1024):
+        """
+        Initialize a TokenBudget.
+
+        Args:
+            models (Sequence[str]): The candidate models, ordered from the cheapest to the most expensive.
+            completion_tokens (int): The tokens reserved in the context for the completion.
+
+        Raises:
+            ValueError: when no model is given or a model has no known context window.
+        """
+        if len(models) == 0:
+            raise ValueError("No models was provided.")
+        for model in models:
+            if model not in MODEL_CONTEXT_WINDOWS:
+                raise ValueError(f"Unknown context window of model: {model}")
+        self.models_: List[str] = list(models)
+        self.completion_tokens_: int = completion_tokens
+        self.encodings_: Dict[str, tiktoken.Encoding | tracing.ApproximateEncoding] = {}
+        self.lock_ = threading.Lock()
+
+    def _encoding(self, model: str) -> tiktoken.Encoding | tracing.ApproximateEncoding:
+        # Offline, the tokens are estimated from the characters.
+        with self.lock_:
+            if model not in self.encodings_:
+                self.encodings_[model] = tracing.encoding_for_model(model)
+            return self.encodings_[model]
+
+    def count(self, text: str, model: str | None = None) -> int:
+        """
+        Count the tokens of a text.
+
+        Args:
+            text (str): The text to count.
+            model (str | None): The model whose tokenizer is used, defaults to the cheapest candidate model.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return len(self._encoding(model or self.models_[0]).encode(text, disallowed_special=()))
+
+    def prompt_budget(self, model: str, system_prompt: str = '') -> int:
+        """
+        Returns:
+            int: The max tokens of a user prompt sent to the model together with the system prompt.
+        """
+        return MODEL_CONTEXT_WINDOWS[model] - self.completion_tokens_ - self.MESSAGE_OVERHEAD_ \
+            - self.count(system_prompt, model)
+
+    def route(self, prompt: str, system_prompt: str = '') -> str:
+        """
+        Pick the cheapest model whose context fits the prompt.
+
+        Args:
+            prompt (str): The user prompt.
+            system_prompt (str): The system prompt sent with it.
+
+        Returns:
+            str: The cheapest fitting model, or the one with the largest context when none fits.
+        """
+        for model in self.models_:
+            num_tokens = self.count(prompt, model)
+            if num_tokens <= self.prompt_budget(model, system_prompt):
+                tracing.log(f"Prompt of {num_tokens} tokens, routing to {model}...")
+                return model
+        model = max(self.models_, key=lambda model: MODEL_CONTEXT_WINDOWS[model])
+        tracing.log(f"Prompt of {self.count(prompt, model)} tokens exceeds every context, routing to {model}...")
+        return model
+
+    def pack(self,
+             prefix: str,
+             texts: List[str],
+             scores: List[float],
+             system_prompt: str = '',
+             model: str | None = None) -> List[Tuple[int, str]]:
+        """
+        Select the most relevant texts fitting in a prompt together with its prefix.
+
+        Texts are taken by descending score, the first one not fitting is trimmed to the remaining tokens
+        and the rest is dropped. Each text is followed by a new line in the prompt.
+
+        Args:
+            prefix (str): The part of the prompt before the texts.
+            texts (List[str]): The candidate texts, e.g. retrieved sources.
+            scores (List[float]): The relevance score of each text.
+            system_prompt (str): The system prompt sent with the prompt.
+            model (str | None): The model to fit, defaults to the candidate model with the largest context.
+
+        Returns:
+            List[Tuple[int, str]]: The indices of the kept texts and their possibly trimmed contents, in the original order.
+        """
+        if model is None:
+            model = max(self.models_, key=lambda model: MODEL_CONTEXT_WINDOWS[model])
+        encoding = self._encoding(model)
+        remaining = self.prompt_budget(model, system_prompt) - self.count(prefix, model)
+        packed: List[Tuple[int, str]] = []
+        for index in sorted(range(len(texts)), key=lambda index: -scores[index]):
+            tokens = encoding.encode(f"{texts[index]}\n", disallowed_special=())
+            if len(tokens) <= remaining:
+                packed.append((index, texts[index]))
+                remaining -= len(tokens)
+                continue
+            if remaining > 1:
+                packed.append((index, encoding.decode(tokens[:remaining - 1])))
+            break
+        if len(packed) < len(texts) or any(text is not texts[index] for index, text in packed):
+            tracing.log(f"Packed {len(packed)} of {len(texts)} texts into the {model} context.")
+        return sorted(packed)
@@ -1,10 +1,28 @@
 import os
+import time
+import random
+import threading
 import requests
 import feedparser
 import re
 import subprocess
-from typing import List, Union, Dict
+import tracing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple, Union, Dict
 
+_SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
+
+# A heading line of the reference section, optionally numbered, e.g. 'References' or '7. Bibliography'.
+_REFERENCE_HEADING = re.compile(
+    r'^[ \t]*(?:[0-9IVX]+\.?[ \t]*)?(?:References|Bibliography|Literature Cited|Works Cited)[ \t]*:?[ \t]*$',
+    re.MULTILINE | re.IGNORECASE,
+)
+# A heading line of an appendix, e.g. 'Appendix', 'A Appendix' or 'Supplementary Material'.
+_APPENDIX_HEADING = re.compile(
+    r'^[ \t]*(?:[A-Z]\.?[ \t]+)?(?:Appendix|Appendices|Supplementary Materials?)\b',
+    re.MULTILINE | re.IGNORECASE,
+)
 
 def contains_arxiv_reference(input_string: str) -> bool:
     """
@@ -25,33 +43,200 @@ def contains_arxiv_reference(input_string: str) -> bool:
     # If a match is found, return True; otherwise, return False
     return bool(match)
 
-def download_link(url: str, filepath: str, max_retry: int = 3) -> None:
+def strip_reference_section(pages: List[str], ignore_appendices: bool = False) -> Tuple[List[str], int]:
+    """
+    Cut the reference section out of the pages of a document, from its last References or Bibliography heading
+    up to the next appendix heading, or up to the end of the document.
+
+    Args:
+        pages (List[str]): The text of each page of the document.
+        ignore_appendices (bool): Whether to also cut the appendices following the reference section.
+
+    Returns:
+        Tuple[List[str], int]: The text of each page without the reference section, and the number of characters cut.
+            The pages are returned as is when no reference heading is found.
+    """
+    # The last heading is the section itself, earlier ones may be e.g. in a table of contents.
+    start = None
+    for index in reversed(range(len(pages))):
+        matches = list(_REFERENCE_HEADING.finditer(pages[index]))
+        if matches:
+            start = (index, matches[-1].start())
+            break
+    if start is None:
+        return pages, 0
+
+    end = (len(pages), 0)
+    if not ignore_appendices:
+        for index in range(start[0], len(pages)):
+            match = _APPENDIX_HEADING.search(pages[index], start[1] if index == start[0] else 0)
+            if match:
+                end = (index, match.start())
+                break
+
+    stripped, num_skipped = [], 0
+    for index, page in enumerate(pages):
+        if start[0] <= index <= end[0]:
+            cut_start = start[1] if index == start[0] else 0
+            cut_end = end[1] if index == end[0] else len(page)
+            num_skipped += cut_end - cut_start
+            page = page[:cut_start] + page[cut_end:]
+        stripped.append(page)
+    return stripped, num_skipped
+
+def _session() -> requests.Session:
+    """
+    Returns:
+        requests.Session: The HTTP session shared by all downloads, so that connections are pooled and reused.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+        return _SESSION
+
+def download_link(url: str,
+                  filepath: str,
+                  max_retry: int = 3,
+                  timeout: float = 30,
+                  backoff: float = 1,
+                  chunk_size: int = 1 << 16) -> None:
     """
     Download a file from a URL and save it to a specified filepath.
 
+    The file is streamed in chunks into filepath + '.part', which is renamed to filepath once as large as
+    the server announced, so an interrupted download never leaves a truncated file at filepath. A partial file left by
+    an interrupted download is resumed with an HTTP Range request when the server supports it.
+
     Args:
         url (str): The URL to download the file from.
         filepath (str): The filepath to save the downloaded file.
         max_retry (int): The max number of retrying.
+        timeout (float): The seconds to wait for the server to connect or send data.
+        backoff (float): The seconds to wait before the first retry, doubled for each following retry.
+        chunk_size (int): The number of bytes written at a time.
     
     Raises:
         ValueError: when max_retry <= 0.
-        ConnectionError: when downloading failed after max_retry times of retrying.
+        ConnectionError: when downloading failed after max_retry times of retrying,
+            or at once when the server answers with a client error, e.g. 404 or 403, that no retry fixes.
     """
     if max_retry <= 0:
         raise ValueError(f"Invalid max retry: {max_retry}")
-    # Download the file with retrying.
-    for idx, retry in enumerate(range(max_retry)):
-        print(f"[{idx + 1}/{max_retry}] Trying to download {url} to {filepath}...")
-        response = requests.get(url)
-        if (response.ok):
-            with open(filepath, 'wb') as f: 
-                f.write(response.content)
-            print(f"Done.")
-            return
-        print(f"Failed to download {url} with response code: {response.status_code}")
-
-    raise ConnectionError(f"Failed to download {url} with max {max_retry} retries.")
+    part_path = f'{filepath}.part'
+    with tracing.span('download', url=url) as attributes:
+        # Download the file with retrying.
+        for idx, retry in enumerate(range(max_retry)):
+            attributes['attempts'] = idx + 1
+            if idx > 0:
+                delay = backoff * 2 ** (idx - 1) * random.uniform(0.5, 1.5)
+                tracing.log(f"Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+            # Resume from the bytes downloaded by the previous attempts, if any.
+            resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+            tracing.log(f"[{idx + 1}/{max_retry}] Trying to download {url} to {filepath}" +
+                        (f" from byte {resume_from}..." if resume_from else "..."))
+            try:
+                with _session().get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code == 416 and resume_from:
+                        # The partial file holds every byte only if it is as large as the file, e.g. 'bytes */1234'.
+                        if response.headers.get('Content-Range', '').rpartition('/')[2] == str(resume_from):
+                            os.replace(part_path, filepath)
+                            tracing.log(f"Done.")
+                            return
+                        tracing.log(f"The partial file of {url} does not match the file, restarting the download.")
+                        os.remove(part_path)
+                        continue
+                    if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                        raise ConnectionError(f"Failed to download {url} with response code: {response.status_code}")
+                    if not response.ok:
+                        tracing.log(f"Failed to download {url} with response code: {response.status_code}")
+                        continue
+                    # A server ignoring the Range header sends the whole file again.
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    expected_size = _expected_size(response)
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                size = os.path.getsize(part_path)
+                attributes['bytes'] = size
+                # A connection dropped mid-body may just end the stream, keep the partial file to resume it.
+                if expected_size is not None and size != expected_size:
+                    tracing.log(f"Downloaded {size} of the {expected_size} bytes of {url}.")
+                    if size > expected_size:
+                        os.remove(part_path)
+                    continue
+                os.replace(part_path, filepath)
+                tracing.log(f"Done.")
+                return
+            except requests.RequestException as e:
+                tracing.log(f"Failed to download {url} with error: {e}")
+
+        raise ConnectionError(f"Failed to download {url} with max {max_retry} retries.")
+
+def _expected_size(response: requests.Response) -> int | None:
+    """
+    Returns:
+        int | None: The size of the whole file once the response is written, None if the headers do not tell it,
+            e.g. for a compressed response, whose length is not the one of the decoded bytes written.
+    """
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+def download_links(filepath_urls: Dict[str, str], max_workers: int = 8, **kwargs) -> Dict[str, Exception]:
+    """
+    Download many files concurrently over the shared HTTP session.
+
+    Args:
+        filepath_urls (Dict[str, str]): The URL to download to each filepath, a URL may be saved to several filepaths.
+        max_workers (int): The max number of concurrent downloads.
+        **kwargs (dict): The args used by download_link, e.g. max_retry or timeout.
+
+    Returns:
+        Dict[str, Exception]: The error of each filepath failed to download, empty when all succeeded.
+    """
+    def download(filepath_url: tuple) -> Exception | None:
+        filepath, url = filepath_url
+        try:
+            download_link(url, filepath, **kwargs)
+        except ConnectionError as e:
+            return e
+        return None
+
+    filepath_url_list = list(filepath_urls.items())
+    errors = map_concurrently(download, filepath_url_list, max_workers)
+    return {filepath: error for (filepath, _), error in zip(filepath_url_list, errors) if error is not None}
+
+def map_concurrently(func: Callable[[Any], Any], items: List[Any], max_workers: int = 1) -> List[Any]:
+    """
+    Apply a function to every item with a bounded thread pool, e.g. to overlap the waits of network calls.
+
+    Args:
+        func (Callable[[Any], Any]): The function to apply.
+        items (List[Any]): The items to apply the function on.
+        max_workers (int): The max number of concurrent calls. 1 runs the calls one after another.
+
+    Returns:
+        List[Any]: The results in the order of items.
+
+    Raises:
+        ValueError: when max_workers <= 0.
+    """
+    if max_workers <= 0:
+        raise ValueError(f"Invalid max workers: {max_workers}")
+    if max_workers == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
 
 if __name__ == '__main__':
     download_link(
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List
+
+# The prices in USD per 1K prompt and completion tokens of the models.
+MODEL_PRICES: Dict[str, tuple] = {
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'text-embedding-ada-002': (0.0001, 0.0),
+}
+
+
+class CostBudgetExceededError(RuntimeError):
+    """Raised when the estimated cost of the API calls of a run exceeds its budget."""
+
+
+class Tracer(object):
+    """Records timed spans of the pipeline stages and the token usage of the API calls.
+
+    Each span and usage record is appended as one JSON line to the trace file, if any, and only aggregated
+    in memory into a summary table of the run. The log messages of the pipeline are printed only when verbose.
+    """
+
+    # The tracer the pipeline records to, e.g. replaced once at the start of a run.
+    current_: 'Tracer'
+
+    def __init__(self, trace_path: str | None = None, verbose: bool = True, budget: float | None = None):
+        """
+        Args:
+            trace_path (str | None): The JSONL file the records are appended to. If None, then they are only aggregated.
+            verbose (bool): Whether to print the log messages.
+            budget (float | None): The max estimated cost in USD of the run. If None, then unlimited.
+
+        Raises:
+            ValueError: when budget <= 0.
+        """
+        if budget is not None and budget <= 0:
+            raise ValueError(f"Invalid budget: {budget}")
+        self.verbose_: bool = verbose
+        self.budget_: float | None = budget
+        # The count, total and max seconds of the spans of each stage, and their last durations for the median.
+        self.stages_: Dict[str, Dict[str, float]] = {}
+        self.durations_: Dict[str, Deque[float]] = {}
+        self.max_durations_: int = 1000
+        self.usage_: Dict[str, Dict[str, float]] = {}
+        self.cost_: float = 0.0
+        self.lock_ = threading.Lock()
+        # The stack of the open spans of each thread, to link a span to its parent.
+        self.local_ = threading.local()
+        self.trace_file_ = None
+        if trace_path:
+            folder = os.path.dirname(trace_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.trace_file_ = open(trace_path, 'a')
+
+    def log(self, *args):
+        if self.verbose_:
+            print(*args)
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **attributes) -> Iterator[Dict[str, Any]]:
+        """
+        Time the code in the context as a span of a stage.
+
+        Args:
+            stage (str): The stage, e.g. 'download', 'parse', 'split', 'embed', 'retrieve', 'summarize' or 'compose'.
+            **attributes: The attributes of the span, e.g. the title of the paper.
+
+        Yields:
+            Dict[str, Any]: The attributes, which the code in the context may add to.
+        """
+        stack = self.local_.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(stage)
+        start, start_time = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            if error:
+                attributes['error'] = error
+            self.record_span(stage, time.perf_counter() - start_time, start=start, parent=parent, **attributes)
+
+    def record_span(self, stage: str, duration: float, **attributes):
+        """
+        Record a span timed elsewhere, e.g. in a worker process.
+        """
+        record = {'type': 'span', 'stage': stage, 'duration': duration,
+                  'thread': threading.current_thread().name, **attributes}
+        with self.lock_:
+            stage_stats = self.stages_.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stage_stats['count'] += 1
+            stage_stats['total_seconds'] += duration
+            stage_stats['max_seconds'] = max(stage_stats['max_seconds'], duration)
+            self.durations_.setdefault(stage, deque(maxlen=self.max_durations_)).append(duration)
+            self._write(record)
+
+    def record_usage(self, model: str, prompt_tokens: int, completion_tokens: int = 0, **attributes):
+        """
+        Record the tokens of an API call and add its estimated cost to the run.
+
+        Raises:
+            CostBudgetExceededError: when the estimated cost of the run exceeds the budget.
+        """
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        record = {'type': 'usage', 'model': model, 'prompt_tokens': prompt_tokens,
+                  'completion_tokens': completion_tokens, 'cost': cost, **attributes}
+        with self.lock_:
+            usage = self.usage_.setdefault(model, {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0})
+            usage['calls'] += 1
+            usage['prompt_tokens'] += prompt_tokens
+            usage['completion_tokens'] += completion_tokens
+            usage['cost'] += cost
+            self.cost_ += cost
+            self._write(record)
+            total_cost = self.cost_
+        if self.budget_ is not None and total_cost > self.budget_:
+            raise CostBudgetExceededError(f"The estimated cost ${total_cost:.4f} exceeds the budget ${self.budget_:.4f}.")
+
+    def _write(self, record: Dict[str, Any]):
+        if self.trace_file_:
+            self.trace_file_.write(json.dumps(record, default=str) + '\n')
+            self.trace_file_.flush()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The count, total, p50 of the last spans and max seconds of the spans of each stage,
+                the calls, tokens and cost of each model, and the total cost.
+        """
+        with self.lock_:
+            stages = {stage: {
+                'count': int(stage_stats['count']),
+                'total_seconds': stage_stats['total_seconds'],
+                'p50_seconds': float(np.percentile(self.durations_[stage], 50)),
+                'max_seconds': stage_stats['max_seconds'],
+            } for stage, stage_stats in self.stages_.items()}
+            return {'stages': stages, 'models': {model: dict(usage) for model, usage in self.usage_.items()}, 'cost': self.cost_}
+
+    def summary(self) -> str:
+        """
+        Returns:
+            str: The stats as a table of stages followed by a table of models.
+        """
+        stats = self.stats()
+        lines = [f"{'stage':<12} {'count':>7} {'total s':>10} {'p50 s':>9} {'max s':>9}"]
+        for stage, stage_stats in sorted(stats['stages'].items(), key=lambda item: -item[1]['total_seconds']):
+            lines.append(f"{stage:<12} {stage_stats['count']:>7} {stage_stats['total_seconds']:>10.3f} "
+                         f"{stage_stats['p50_seconds']:>9.3f} {stage_stats['max_seconds']:>9.3f}")
+        lines.append('')
+        lines.append(f"{'model':<24} {'calls':>7} {'prompt tok':>11} {'compl. tok':>11} {'cost $':>9}")
+        for model, usage in sorted(stats['models'].items()):
+            lines.append(f"{model:<24} {usage['calls']:>7} {usage['prompt_tokens']:>11} "
+                         f"{usage['completion_tokens']:>11} {usage['cost']:>9.4f}")
+        lines.append(f"{'total':<24} {'':>7} {'':>11} {'':>11} {stats['cost']:>9.4f}")
+        return '\n'.join(lines)
+
+    def close(self):
+        with self.lock_:
+            if self.trace_file_:
+                self.trace_file_.close()
+                self.trace_file_ = None
+
+
+class CollectingTracer(Tracer):
+    """A tracer also keeping its records in a list, e.g. in a worker process, for its parent process to record them."""
+
+    def __init__(self, verbose: bool = True):
+        super().__init__(verbose=verbose)
+        self.records_: List[Dict[str, Any]] = []
+
+    def _write(self, record: Dict[str, Any]):
+        self.records_.append(record)
+        super()._write(record)
+
+
+Tracer.current_ = Tracer()
+
+
+def log(*args):
+    """Print the log message if the current tracer is verbose."""
+    Tracer.current_.log(*args)
+
+
+def span(stage: str, **attributes):
+    """Time the code in the context as a span of a stage of the current tracer."""
+    return Tracer.current_.span(stage, **attributes)
+
+
+def record_usage(model: str, prompt_tokens: int, completion_tokens: int = 0, **attributes):
+    """Record the tokens of an API call in the current tracer."""
+    Tracer.current_.record_usage(model, prompt_tokens, completion_tokens, **attributes)
+
+
+def record_embedding_usage(model: str, texts: List[str]):
+    """Record the tokens of the texts sent to an embedding model, when it is a priced API model."""
+    if model in MODEL_PRICES:
+        record_usage(model, sum(count_tokens(model, text) for text in texts))
+
+
+class ApproximateEncoding(object):
+    """A stand-in of a tiktoken encoding, cutting a text into tokens of 4 characters, about the mean of English text."""
+
+    CHARS_PER_TOKEN_: int = 4
+
+    def encode(self, text: str, **kwargs) -> List[str]:
+        return [text[start:start + self.CHARS_PER_TOKEN_] for start in range(0, len(text), self.CHARS_PER_TOKEN_)]
+
+    def decode(self, tokens: List[str]) -> str:
+        return ''.join(tokens)
+
+
+_ENCODINGS: Dict[str, Any] = {}
+
+
+def encoding_for_model(model: str):
+    """
+    Get the tokenizer of a model, or an ApproximateEncoding when tiktoken does not know the model
+    or cannot load its BPE file, e.g. offline as in the benchmark.
+
+    Returns:
+        tiktoken.Encoding | ApproximateEncoding: The tokenizer, loaded once per model.
+    """
+    if model not in _ENCODINGS:
+        import tiktoken
+        try:
+            _ENCODINGS[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _ENCODINGS[model] = ApproximateEncoding()
+        except (OSError, ValueError) as e:
+            log(f"Failed to load the tokenizer of {model}, estimating its tokens from the characters instead: {e}")
+            _ENCODINGS[model] = ApproximateEncoding()
+    return _ENCODINGS[model]
+
+
+def count_tokens(model: str, text: str) -> int:
+    """
+    Count the tokens of a text with the tokenizer of a model, or estimate them as a quarter of the characters
+    when the tokenizer of the model is unknown or cannot be loaded.
+    """
+    return len(encoding_for_model(model).encode(text, disallowed_special=()))